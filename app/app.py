@@ -1,10 +1,14 @@
 import subprocess
 import json
 import os
+import re
+import threading
 import nbformat
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, send_from_directory, abort, Response
 from pathlib import Path
 import logging
+from pipeline_worker import PipelineWorker
+from jobs import JobRunner
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -13,6 +17,9 @@ logger = logging.getLogger(__name__)
 #app = Flask(__name__)
 app = Flask(__name__, template_folder='templates')
 
+# Long-lived process running the steps in-process (pipeline_worker: true in config.json)
+pipeline_worker = PipelineWorker()
+
 def get_config():
     """Load and validate configuration with dynamic path resolution"""
     try:
@@ -82,6 +89,80 @@ def create_default_config():
         
     return default_config
 
+# Map step numbers to their respective Python scripts
+script_map = {
+    1: 'step1.py',
+    2: 'step2.py',
+    3: 'step3.py',
+    4: 'step4.py',
+    5: 'step5.py',
+    6: 'step6.py',
+    7: 'step7.py',
+    8: 'undo.py',  # Example for undo functionality
+    9: 'backup.py',  # Example for backup functionality
+    10: 'refine.py'  # Step 4 and 5 rounds in one process
+}
+
+# `python stepN.py` processes of the running jobs, by step, so they can be cancelled
+running_processes = {}
+
+def run_step_job(step, on_event, should_cancel, force_refresh=False):
+    """Run a step for a background job, passing its output lines and progress bars to on_event as they come."""
+    # Run the step's main() in the persistent worker: no interpreter start-up or imports per click
+    if get_config().get('pipeline_worker', False):
+        result = pipeline_worker.run_step(step, on_event)
+        logger.info(f"Step {step} ran in the pipeline worker: {result['status']} in {result.get('seconds', 0):.2f}s")
+        return result
+
+    # Execute the corresponding Python script, unbuffered so its prints arrive while it runs
+    command = ['python', script_map[step]]
+    if force_refresh:
+        command.append('--force_refresh')
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               env={**os.environ, 'PYTHONUNBUFFERED': '1'})
+    running_processes[step] = process
+    if should_cancel():
+        process.terminate()
+
+    # stderr carries the tqdm bars, redrawn after each '\r': the last one is the progress
+    stderr_text = []
+    def read_stderr():
+        for chunk in iter(lambda: os.read(process.stderr.fileno(), 4096), b''):
+            text = chunk.decode('utf-8', errors='replace')
+            stderr_text.append(text)
+            segments = [segment for segment in re.split(r'[\r\n]', text) if segment.strip()]
+            if segments:
+                on_event('progress', segments[-1])
+    stderr_reader = threading.Thread(target=read_stderr, daemon=True)
+    stderr_reader.start()
+
+    outputs = []
+    for raw_line in process.stdout:
+        line = raw_line.decode('utf-8', errors='replace').rstrip('\r\n')
+        outputs.append(line)
+        on_event('line', line)
+    process.wait()
+    stderr_reader.join()
+    running_processes.pop(step, None)
+
+    # Check if the script executed successfully
+    if process.returncode == 0:
+        return {'status': 'success', 'outputs': outputs}
+    return {'status': 'error', 'outputs': outputs,
+            'message': ''.join(stderr_text).strip() or 'Unknown error occurred.'}
+
+def cancel_step_job(job):
+    """Stop the running step of a job, in the pipeline worker or as a script."""
+    process = running_processes.get(job.step)
+    if process is not None:
+        process.terminate()
+    else:
+        pipeline_worker.cancel(job.step)
+
+# Steps clicked in the web UI run as background jobs; job_workers of them at once
+job_runner = JobRunner(run_step_job, cancel_step_job,
+                       max_workers=get_config().get('job_workers', 1) if os.path.exists('config.json') else 1)
+
 @app.route('/')
 def index():
     config = get_config()
@@ -101,7 +182,8 @@ def update_config():
             'imode', 'parquet_size_factor', 'randomness_percentage', 
             'parquet_unit_width', 'force_refresh',  # Add force_refresh
             'merge_diff', 'split_diff', 'optional_tesserae',
-            'mosaic_anime', 'tessera_width', 'tessera_height'  # Add tessera_width/height
+            'mosaic_anime', 'tessera_width', 'tessera_height',  # Add tessera_width/height
+            'refine_max_rounds'
         ]
         type_validations = {
             'imode': int,
@@ -114,7 +196,8 @@ def update_config():
             'mosaic_anime': bool,
             'tessera_width': int,
             'tessera_height': int,
-            'force_refresh': bool
+            'force_refresh': bool,
+            'refine_max_rounds': int
         }
         
         # Validate and update keys
@@ -142,50 +225,85 @@ def update_config():
 
 @app.route('/run_step/<int:step>', methods=['POST'])
 def run_step(step):
+    """Queue the step as a background job; its output follows on /jobs/<id>/events."""
     try:
         # Get the force_refresh parameter from the request
         data = request.get_json()
         force_refresh = data.get('force_refresh', False)
 
-        # Map step numbers to their respective Python scripts
-        script_map = {
-            1: 'step1.py',
-            2: 'step2.py',
-            3: 'step3.py',
-            4: 'step4.py',
-            5: 'step5.py',
-            6: 'step6.py',
-            7: 'step7.py',
-            8: 'undo.py',  # Example for undo functionality
-            9: 'backup.py'  # Example for backup functionality
-        }
-
         # Check if the requested step exists in the map
         if step not in script_map:
             return jsonify({'status': 'error', 'message': f'Step {step} not found.'}), 404
 
-        # Execute the corresponding Python script
-        script_path = script_map[step]
-        command = ['python', script_path]
+        job, created = job_runner.submit(step, force_refresh=force_refresh)
+        return jsonify({'status': job.status, 'job_id': job.id, 'deduplicated': not created}), 202
+
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 
-        # Add force_refresh as an argument if needed
-        if force_refresh:
-            command.append('--force_refresh')
+@app.route('/jobs')
+def jobs():
+    """The known jobs, newest first."""
+    return jsonify([job.summary() for job in sorted(job_runner.jobs(), key=lambda job: job.created, reverse=True)])
 
-        # Run the script and capture the output
-        result = subprocess.run(command, capture_output=True, text=True)
 
-        # Check if the script executed successfully
-        if result.returncode == 0:
-            outputs = result.stdout.splitlines()
-            return jsonify({'status': 'success', 'outputs': outputs})
-        else:
-            error_message = result.stderr.strip() or 'Unknown error occurred.'
-            return jsonify({'status': 'error', 'message': error_message}), 500
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_runner.get(job_id)
+    if job is None:
+        abort(404)
+    summary = job.summary()
+    summary['outputs'] = [text for kind, text in job.events if kind == 'line']
+    return jsonify(summary)
 
-    except Exception as e:
-        return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if job_runner.get(job_id) is None:
+        abort(404)
+    cancelled = job_runner.cancel(job_id)
+    return jsonify({'status': job_runner.get(job_id).status, 'cancelled': cancelled})
+
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-sent events of a job: its output lines, progress bars and end; a reconnecting
+    EventSource resumes after the last event it got (Last-Event-ID)."""
+    if job_runner.get(job_id) is None:
+        abort(404)
+    start = int(request.headers.get('Last-Event-ID', 0) or 0)
+
+    def stream():
+        position = start
+        for event in job_runner.events(job_id, start):
+            if event is None:
+                yield ': keepalive\n\n'
+                continue
+            kind, text = event
+            if kind != 'progress':
+                position += 1
+                yield f'id: {position}\n'
+            yield f'event: {kind}\ndata: {json.dumps(text)}\n\n'
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/viewer/<name>')
+def viewer(name):
+    """Deep zoom viewer for a mosaic written by step 7 with mosaic_deep_zoom on."""
+    config = get_config()
+    if not os.path.exists(os.path.join(config['output_path'], f"{name}.dzi")):
+        abort(404)
+    return render_template('viewer.html', name=name)
+
+
+@app.route('/mosaics/<path:filename>')
+def mosaics(filename):
+    """Serve files (e.g. the .dzi and its tiles) from the mosaics folder."""
+    config = get_config()
+    return send_from_directory(config['output_path'], filename)
 
 
 @app.route('/test', methods=['POST'])
@@ -0,0 +1,174 @@
+#batch - steps 3 to 7 for many motifs against the same tesserae library
+#each motif gets its own parquets/candidates files (index-n-log/batch/<motif>/) and mosaic (mosaics/batch/<motif>/);
+#the tesserae index is read once and handed to every worker, each worker rendering several motifs in turn
+import argparse
+import contextlib
+import csv
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+#common helper functions for this project, utils.py saved in the same folder
+from utils import log_message, setup_logging, resolve_workers
+from utils_csv_io import read_tesserae_index, read_parquet_array
+from config import CONFIG
+
+MOTIF_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+BATCH_STEPS = (3, 4, 5, 6, 7)
+SUMMARY_FIELDS = ['motif', 'status', 'parquets', 'step3', 'step4', 'step5', 'step6', 'step7',
+                  'total_seconds', 'noise_db', 'mosaic']
+
+
+def find_motifs(paths):
+    """Motif images among paths: files as given, folders searched (not recursively) for images."""
+    motifs = []
+    for path in paths:
+        if os.path.isdir(path):
+            motifs += sorted(os.path.join(path, name) for name in os.listdir(path)
+                             if name.lower().endswith(MOTIF_EXTENSIONS))
+        elif os.path.isfile(path):
+            motifs.append(path)
+        else:
+            log_message(f"Batch: {path} not found, skipped")
+    return motifs
+
+
+def motif_settings(motifs, render_workers):
+    """Per-motif CONFIG overrides: where its parquets, candidates and mosaic go."""
+    settings = []
+    names = set()
+    for motif in motifs:
+        name = os.path.splitext(os.path.basename(motif))[0]
+        while name in names:     # a.jpg and a.png
+            name += "_"
+        names.add(name)
+        work_folder = os.path.join(CONFIG["index_folder"], "batch", name)
+        settings.append((name, {
+            "image_path": os.path.abspath(motif),
+            "parquets_csv_path": os.path.join(work_folder, "parquets.csv"),
+            "candidates_output_path": os.path.join(work_folder, "candidates_index.csv"),
+            "output_path": os.path.join(CONFIG["output_path"], "batch", name),
+            "render_workers": render_workers,
+        }))
+    return settings
+
+
+def init_worker(app_dir):
+    """Set up a batch worker: headless matplotlib, and the tesserae index in memory (inherited
+    from the parent where processes are forked, read once per worker otherwise)."""
+    os.chdir(app_dir)
+    os.environ["MPLBACKEND"] = "Agg"
+    read_tesserae_index(CONFIG["tesserae_index_path"])
+
+
+def render_motif(name, overrides):
+    """Run steps 3-7 for one motif in this worker; returns its row of the summary table."""
+    import importlib
+    import matplotlib.pyplot as plt
+    import step7
+
+    dict.update(CONFIG, overrides)      # CONFIG is read-only to the steps; the batch points it at this motif
+    work_folder = os.path.dirname(CONFIG["parquets_csv_path"])
+    os.makedirs(work_folder, exist_ok=True)
+    os.makedirs(CONFIG["output_path"], exist_ok=True)
+
+    row = {"motif": name, "status": "success"}
+    step7.last_mosaic_scores.clear()
+    start = time.perf_counter()
+    # the steps' prints and tqdm bars go to the motif's own log instead of interleaving on the console
+    with open(os.path.join(work_folder, "batch.log"), 'w', encoding='utf-8') as step_log, \
+            contextlib.redirect_stdout(step_log), contextlib.redirect_stderr(step_log):
+        for step in BATCH_STEPS:
+            step_start = time.perf_counter()
+            try:
+                importlib.import_module(f"step{step}").main()
+            except BaseException as e:    # a failing motif must not stop the batch
+                print(f"ERROR: step {step}: {e}")
+                row["status"] = f"step {step} failed: {e}"
+                break
+            finally:
+                row[f"step{step}"] = round(time.perf_counter() - step_start, 2)
+                plt.close('all')
+        row["total_seconds"] = round(time.perf_counter() - start, 2)
+        if os.path.exists(CONFIG["parquets_csv_path"]):
+            row["parquets"] = len(read_parquet_array(CONFIG["parquets_csv_path"]))
+
+    scores = step7.last_mosaic_scores
+    if scores:
+        row["noise_db"] = round(scores["noise_db"], 2)
+        row["mosaic"] = scores["output_path"]
+    elif row["status"] == "success":
+        row["status"] = "no mosaic, see batch.log"
+    return row
+
+
+def print_summary(rows, fields=SUMMARY_FIELDS[:-1]):
+    widths = {field: max(len(field), *(len(str(row.get(field, ''))) for row in rows)) for field in fields}
+    print("  ".join(field.ljust(width) for field, width in widths.items()))
+    for row in rows:
+        print("  ".join(str(row.get(field, '')).ljust(width) for field, width in widths.items()))
+
+
+def run_batch(motifs, workers=0):
+    """Render every motif; returns the summary rows in motif order."""
+    budget = resolve_workers(workers)
+    pool_size = max(1, min(budget, len(motifs)))
+    # the cores a worker does not take go to its step7 rendering pool
+    settings = motif_settings(motifs, max(1, budget // pool_size))
+
+    read_tesserae_index(CONFIG["tesserae_index_path"])
+    log_message(f"Batch: {len(motifs)} motifs with {pool_size} workers (core budget {budget})")
+
+    rows = {}
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    with ProcessPoolExecutor(max_workers=pool_size, initializer=init_worker, initargs=(app_dir,)) as executor:
+        futures = {executor.submit(render_motif, name, overrides): name for name, overrides in settings}
+        for done, future in enumerate(as_completed(futures), 1):
+            name = futures[future]
+            try:
+                row = future.result()
+            except Exception as e:     # the worker process itself died
+                row = {"motif": name, "status": f"worker failed: {e}"}
+            rows[name] = row
+            log_message(f"Batch [{done}/{len(motifs)}] {name}: {row['status']} in {row.get('total_seconds', 0):.2f}s"
+                        f", noise {row.get('noise_db', '-')} dB")
+    return [rows[name] for name, _ in settings]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run steps 3-7 for several motifs against the same tesserae.")
+    parser.add_argument("motifs", nargs="*",
+                        help="motif images and/or folders of them (default: the motif folder)")
+    parser.add_argument("--workers", type=int, default=CONFIG.get("batch_workers", 0),
+                        help="core budget, 0 for one per CPU core")
+    args = parser.parse_args()
+
+    setup_logging(CONFIG["log_file"])
+    start_time = datetime.now()
+    log_message(f"Batch - motifs through steps 3-7... @{start_time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+    motifs = find_motifs(args.motifs or [os.path.dirname(CONFIG["image_path"])])
+    if not motifs:
+        log_message("Batch: no motifs found")
+        return
+    if not os.path.exists(CONFIG["tesserae_index_path"]):
+        log_message(f"Batch: tesserae index {CONFIG['tesserae_index_path']} not found, run steps 1 and 2 first")
+        return
+
+    rows = run_batch(motifs, args.workers)
+    print_summary(rows)
+    summary_path = os.path.join(CONFIG["index_folder"], "batch", f"summary_{start_time.strftime('%Y%m%d_%H%M%S')}.csv")
+    os.makedirs(os.path.dirname(summary_path), exist_ok=True)
+    with open(summary_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    log_message(f"Batch summary saved to: {summary_path}")
+
+    end_time = datetime.now()
+    log_message(f"Batch - {len(motifs)} motifs... done @{end_time.strftime('%Y-%m-%d %H:%M:%S')}")
+    log_message(f"===Total execution time: {(end_time - start_time).total_seconds():.2f} seconds===" )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+#benchmarks - reproducible timings of the step functions on synthetic tiles and motifs: python -m benchmarks
+from .synthetic import make_tile_library, make_motif
+from .suite import SCALES, run_suite, compare_results
@@ -0,0 +1,44 @@
+#python -m benchmarks [--scales tiny small ...] [--baseline results.json] - run from the app folder
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+os.environ.setdefault("MPLBACKEND", "Agg")    # step7 imports pyplot; nothing is shown
+
+from config import CONFIG
+from .suite import SCALES, run_suite, compare_results, print_comparison, save_results
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Time the step functions on synthetic tile libraries and motifs.")
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=["tiny", "small"])
+    parser.add_argument("--repeat", type=int, default=1, help="timed runs per function (the best is kept)")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes for cropping and rendering")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic inputs and of steps 3 and 6")
+    parser.add_argument("--work-folder", default=os.path.join(CONFIG["index_folder"], "benchmarks", "work"),
+                        help="where the synthetic libraries are generated (and kept for the next run)")
+    parser.add_argument("--output", help="results JSON (default: index-n-log/benchmarks/results_<time>.json)")
+    parser.add_argument("--baseline", help="results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="relative slow-down reported as a regression (default 0.10)")
+    args = parser.parse_args()
+
+    document = run_suite(args.scales, args.work_folder, max(1, args.repeat), args.workers, args.seed)
+    output = args.output or os.path.join(CONFIG["index_folder"], "benchmarks",
+                                         f"results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    save_results(document, output)
+    print(f"Benchmark results saved to: {output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        rows = compare_results(document, baseline, args.tolerance)
+        print_comparison(rows)
+        if any(verdict == "regression" for *_, verdict in rows):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+#benchmark suite - times the core function of each step on synthetic inputs at several scales
+#results are JSON (seconds, peak traced memory, items) and can be compared against a stored baseline
+import contextlib
+import json
+import os
+import platform
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import PIL
+
+from utils import clear_file_memo
+from config import CONFIG
+from .synthetic import make_tile_library, make_motif
+
+# tiles in the library, motif size, parquet_size_factor and the (small) tessera width of each scale
+SCALES = {
+    "tiny": {"tiles": 40, "motif": (600, 400), "parquet_size_factor": 10, "tessera_width": 60},
+    "small": {"tiles": 200, "motif": (1200, 800), "parquet_size_factor": 8, "tessera_width": 60},
+    "medium": {"tiles": 800, "motif": (2400, 1600), "parquet_size_factor": 6, "tessera_width": 60},
+    "large": {"tiles": 2000, "motif": (4800, 3200), "parquet_size_factor": 5, "tessera_width": 60},
+}
+
+def measure(run, setup=None, repeat=1):
+    """
+    Time run(*setup()) repeat times and once more under tracemalloc for the peak memory;
+    setup() is not timed. Returns (result, best seconds, all seconds, peak MB). The peak
+    covers Python and NumPy allocations; Pillow's image buffers are not traced.
+    """
+    seconds = []
+    for _ in range(repeat):
+        clear_file_memo()
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        result = run(*args)
+        seconds.append(time.perf_counter() - start)
+    clear_file_memo()
+    args = setup() if setup else ()
+    tracemalloc.start()
+    try:
+        run(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, min(seconds), seconds, peak / 2**20
+
+
+def scale_config(folder, scale, seed=0):
+    """CONFIG overrides pointing the steps at the scale's synthetic files, with the output deterministic."""
+    tessera_width = scale["tessera_width"]
+    return {
+        "base_path": folder,
+        "tile_folder": os.path.join(folder, "tiles"),
+        "tesserae_folder": os.path.join(folder, "tesserae"),
+        "image_path": os.path.join(folder, "motif", "input.jpg"),
+        "output_path": os.path.join(folder, "mosaics"),
+        "parquets_csv_path": os.path.join(folder, "index-n-log", "parquets.csv"),
+        "tesserae_index_path": os.path.join(folder, "index-n-log", "tesserae_index.csv"),
+        "candidates_output_path": os.path.join(folder, "index-n-log", "candidates_index.csv"),
+        "tessera_width": tessera_width,
+        "tessera_height": tessera_width * 2 // 3,
+        "parquet_size_factor": scale["parquet_size_factor"],
+        "optional_tesserae": False,
+        "random_seed": seed,
+        "mosaic_anime": False,
+        "mosaic_deep_zoom": False,
+        "mosaic_strip_height": 0,
+    }
+
+
+def run_scale(name, scale, work_folder, repeat=1, workers=1, seed=0):
+    """Benchmark every step function on one scale; returns {function: measurements}."""
+    import step1, step2, step3, step4, step5, step6, step7
+    import utils_motif_stats
+    from utils_csv_io import read_parquet_array, save_parquet_csv, read_parquets_csv_stepiv
+
+    folder = os.path.join(work_folder, name)
+    overrides = scale_config(folder, scale, seed)
+    overrides["render_workers"] = workers
+    dict.update(CONFIG, overrides)
+    make_tile_library(CONFIG["tile_folder"], scale["tiles"], seed=seed)
+    make_motif(CONFIG["image_path"], *scale["motif"], seed=seed)
+    os.makedirs(CONFIG["output_path"], exist_ok=True)
+    os.makedirs(os.path.dirname(CONFIG["parquets_csv_path"]), exist_ok=True)
+
+    tess_size = [CONFIG["tessera_width"], CONFIG["tessera_height"]]
+    width_parquet = CONFIG["parquet_unit_width"] * CONFIG["parquet_size_factor"]
+    height_parquet = (width_parquet // 3) * 2
+    csv_path = CONFIG["parquets_csv_path"]
+    image_path = CONFIG["image_path"]
+
+    # setups: the motif is decoded, and the tesserae rendered, inside the timed call every time
+    def fresh_motif_stats():
+        utils_motif_stats._loaded.clear()
+        return ()
+
+    def split_input():
+        fresh_motif_stats()
+        return (read_parquet_array(csv_path),)
+
+    def merge_input():
+        fresh_motif_stats()
+        return (split.copy(),)
+
+    def fresh_tessera_cache():
+        step7._shared_cache = None
+        return ()
+
+    results = {}
+    def record(function, run, setup=None, items=None):
+        # the steps' own prints and progress bars would drown the table
+        with open(os.devnull, 'w') as quiet, contextlib.redirect_stdout(quiet), contextlib.redirect_stderr(quiet):
+            result, best, seconds, peak = measure(run, setup, repeat)
+        results[function] = {"seconds": round(best, 4), "runs": [round(s, 4) for s in seconds],
+                             "peak_mb": round(peak, 2), "items": items(result) if items else None}
+        print(f"{name:>6} {function:<45} {best:8.3f}s {peak:8.1f} MB")
+        return result
+
+    record("crop_tiles_and_save",
+           lambda: step1.crop_tiles_and_save(CONFIG["tile_folder"], CONFIG["tesserae_folder"], tess_size, workers),
+           items=lambda count: count)
+    tesserae_paths = step2.get_all_image_paths(CONFIG["tesserae_folder"])
+    record("generate_tess_index",
+           lambda: step2.generate_tess_index(tesserae_paths, CONFIG["tesserae_index_path"], CONFIG.get("index_batch_size", 256)),
+           items=lambda _: len(tesserae_paths))
+    record("analyze_target",
+           lambda: step3.analyze_target(0, CONFIG["randomness_percentage"] / 100.0, image_path,
+                                        width_parquet, height_parquet, csv_path, seed=seed),
+           setup=fresh_motif_stats, items=lambda result: len(result[2]))
+    split = record("parquet_split", lambda parquets: step4.parquet_split(parquets, image_path, CONFIG["split_diff"]),
+                   setup=split_input, items=len)
+    merged = record("parquet_merge", lambda parquets: step5.parquet_merge(parquets, image_path, CONFIG["merge_diff"]),
+                    setup=merge_input, items=len)
+    save_parquet_csv(merged, csv_path)
+    record("prepare_mosaic_prioritized_sorted_filtered",
+           lambda parquets: step6.prepare_mosaic_prioritized_sorted_filtered(
+               parquets, CONFIG["tesserae_index_path"], CONFIG["candidates_output_path"],
+               CONFIG["tessera_width"] / width_parquet, seed),
+           setup=lambda: (read_parquets_csv_stepiv(csv_path),), items=lambda _: len(merged))
+    mosaic_path = os.path.join(CONFIG["output_path"], "mosaic.jpg")
+    record("create_mosaic", lambda: step7.create_mosaic(CONFIG["candidates_output_path"], mosaic_path),
+           setup=fresh_tessera_cache,
+           items=lambda _: step7.last_mosaic_scores.get("tesserae"))
+    results["create_mosaic"]["noise_db"] = round(step7.last_mosaic_scores.get("noise_db", 0.0), 3)
+    return results
+
+
+def run_suite(scales, work_folder, repeat=1, workers=1, seed=0):
+    """Benchmark the named scales; returns the results document."""
+    document = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count(), "numpy": np.__version__, "pillow": PIL.__version__},
+        "settings": {"repeat": repeat, "workers": workers, "seed": seed},
+        "scales": {},
+    }
+    for name in scales:
+        document["scales"][name] = {"definition": SCALES[name],
+                                    "functions": run_scale(name, SCALES[name], work_folder, repeat, workers, seed)}
+    return document
+
+
+def compare_results(current, baseline, tolerance=0.10, min_seconds=0.01):
+    """
+    Rows (scale, function, baseline s, current s, ratio, verdict) for every function timed in
+    both documents; slower by more than tolerance is a regression, faster by more a gain.
+    Differences under min_seconds are timer noise and count as the same.
+    """
+    rows = []
+    for scale, entry in current["scales"].items():
+        base_entry = baseline.get("scales", {}).get(scale)
+        if base_entry is None:
+            continue
+        for function, measured in entry["functions"].items():
+            base = base_entry["functions"].get(function)
+            if base is None or not base["seconds"]:
+                continue
+            ratio = measured["seconds"] / base["seconds"]
+            if abs(measured["seconds"] - base["seconds"]) < min_seconds:
+                verdict = "same"
+            else:
+                verdict = "regression" if ratio > 1 + tolerance else "faster" if ratio < 1 - tolerance else "same"
+            rows.append((scale, function, base["seconds"], measured["seconds"], ratio, verdict))
+    return rows
+
+
+def print_comparison(rows):
+    print(f"{'scale':>6} {'function':<45} {'baseline':>9} {'current':>9} {'ratio':>6}")
+    for scale, function, base, current, ratio, verdict in rows:
+        print(f"{scale:>6} {function:<45} {base:8.3f}s {current:8.3f}s {ratio:6.2f} {verdict}")
+
+
+def save_results(document, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2)
@@ -0,0 +1,79 @@
+#synthetic inputs for the benchmarks: a tile library in the folder layout step 2 classifies
+#(priority/N, optional/N, nocrop/N, unused, plain folders) and a motif; the same seed gives the same files
+import json
+import os
+import numpy as np
+from PIL import Image
+
+TILE_SIZES = [(640, 480), (480, 640), (1024, 683), (683, 1024), (800, 800), (300, 200)]
+FOLDER_MIX = {'included': 0.5, 'priority': 0.2, 'optional': 0.1, 'nocrop': 0.1, 'unused': 0.1}
+
+
+def tile_folder_for(category, rng):
+    """Subfolder of a tile in the given category, e.g. priority/02 or included/3."""
+    if category == 'unused':
+        return 'unused'
+    if category == 'included':
+        return os.path.join('included', str(rng.integers(1, 4)))
+    return os.path.join(category, f"{rng.integers(1, 4):02d}")
+
+
+def synthetic_image(rng, width, height, blocks=6):
+    """A colour gradient with a few flat rectangles on it, so colours and quadrants differ."""
+    corners = rng.integers(0, 256, size=(2, 2, 3)).astype(np.float32)
+    ys = np.linspace(0, 1, height, dtype=np.float32)[:, None, None]
+    xs = np.linspace(0, 1, width, dtype=np.float32)[None, :, None]
+    pixels = (corners[0, 0] * (1 - ys) * (1 - xs) + corners[0, 1] * (1 - ys) * xs
+              + corners[1, 0] * ys * (1 - xs) + corners[1, 1] * ys * xs)
+    for _ in range(blocks):
+        x1, y1 = rng.integers(0, width), rng.integers(0, height)
+        x2, y2 = min(width, x1 + rng.integers(width // 8, width // 2 + 1)), min(height, y1 + rng.integers(height // 8, height // 2 + 1))
+        pixels[y1:y2, x1:x2] = rng.integers(0, 256, size=3)
+    return Image.fromarray(pixels.astype(np.uint8))
+
+
+def make_tile_library(folder, count, sizes=TILE_SIZES, mix=FOLDER_MIX, seed=0):
+    """
+    Write count JPEG tiles under folder, their sizes drawn from sizes and their subfolders
+    from mix ({category: share}). An existing library made with the same arguments is kept.
+    Returns the tile paths.
+    """
+    recipe = {"count": count, "sizes": [list(size) for size in sizes], "mix": mix, "seed": seed}
+    recipe_path = os.path.join(folder, "synthetic.json")
+    if os.path.exists(recipe_path):
+        with open(recipe_path, 'r') as f:
+            existing = json.load(f)
+        if existing["recipe"] == recipe:
+            return [os.path.join(folder, path) for path in existing["tiles"]]
+
+    rng = np.random.default_rng(seed)
+    categories = list(mix)
+    shares = np.array([mix[category] for category in categories], dtype=np.float64)
+    tiles = []
+    for number in range(count):
+        category = categories[rng.choice(len(categories), p=shares / shares.sum())]
+        width, height = sizes[rng.integers(len(sizes))]
+        relative_path = os.path.join(tile_folder_for(category, rng), f"tile{number:05d}.jpg")
+        path = os.path.join(folder, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        synthetic_image(rng, width, height).save(path, 'JPEG', quality=90)
+        tiles.append(relative_path)
+
+    with open(recipe_path, 'w') as f:
+        json.dump({"recipe": recipe, "tiles": tiles}, f, indent=2)
+    return [os.path.join(folder, path) for path in tiles]
+
+
+def make_motif(path, width, height, seed=0):
+    """Write a synthetic motif of width x height, unless the same one is already there."""
+    recipe_path = os.path.splitext(path)[0] + ".json"
+    recipe = {"width": width, "height": height, "seed": seed}
+    if os.path.exists(path) and os.path.exists(recipe_path):
+        with open(recipe_path, 'r') as f:
+            if json.load(f) == recipe:
+                return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    synthetic_image(np.random.default_rng(seed), width, height, blocks=40).save(path, 'JPEG', quality=95)
+    with open(recipe_path, 'w') as f:
+        json.dump(recipe, f)
+    return path
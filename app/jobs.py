@@ -0,0 +1,148 @@
+#background jobs for the web UI: a step click queues a job and returns at once; a small thread pool
+#runs the jobs and their output lines and tqdm progress are kept as events for the SSE stream
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+FINISHED = ('success', 'error', 'cancelled')
+
+
+class Job:
+    """One run of a step: its status, the events (output lines, end) it produced and its progress."""
+
+    def __init__(self, job_id, step, options=None):
+        self.id = job_id
+        self.step = step
+        self.options = options or {}
+        self.status = 'queued'
+        self.message = None
+        self.events = []             # (kind, text): 'line' or 'end'
+        self.progress = ''           # the latest progress bar, not kept as events
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_requested = False
+
+    def summary(self):
+        return {
+            'id': self.id,
+            'step': self.step,
+            'status': self.status,
+            'message': self.message,
+            'progress': self.progress,
+            'lines': sum(1 for kind, _ in self.events if kind == 'line'),
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class JobRunner:
+    """
+    Runs steps in the background with at most max_workers at once. run_step(step, on_event,
+    should_cancel, **options) does the work and returns {'status', 'outputs', 'message'};
+    cancel_running(job) stops a running job. A step that is already queued or running is not queued again:
+    submit() hands back the existing job.
+    """
+
+    def __init__(self, run_step, cancel_running=None, max_workers=1, keep=50):
+        self._run_step = run_step
+        self._cancel_running = cancel_running
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._changed = threading.Condition()
+        self._keep = keep
+
+    def submit(self, step, **options):
+        with self._changed:
+            for job in self._jobs.values():
+                if job.step == step and job.status in ('queued', 'running'):
+                    return job, False
+            job = Job(str(next(self._ids)), step, options)
+            self._jobs[job.id] = job
+            self._forget_old()
+        self._executor.submit(self._run, job)
+        return job, True
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        return list(self._jobs.values())
+
+    def cancel(self, job_id):
+        """Cancel a queued job, or stop a running one; False if the job has already finished."""
+        with self._changed:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED:
+                return False
+            job.cancel_requested = True
+            if job.status == 'queued':
+                self._finish(job, 'cancelled', 'Cancelled before it started')
+                return True
+        if self._cancel_running is not None:
+            self._cancel_running(job)
+        return True
+
+    def events(self, job_id, start=0, keepalive=15):
+        """Yield the job's events from position start on, plus ('progress', text) whenever the
+        progress changes, waiting for news until the job ends; None after keepalive seconds
+        without news, so a stream can send a comment."""
+        job = self._jobs[job_id]
+        position = start
+        progress = ''
+        while True:
+            with self._changed:
+                if position >= len(job.events) and job.progress == progress and job.status not in FINISHED:
+                    self._changed.wait(timeout=keepalive)
+                new_events = job.events[position:]
+                position += len(new_events)
+                if job.progress != progress:
+                    progress = job.progress
+                    new_events.insert(0, ('progress', progress))
+                done = job.status in FINISHED and position >= len(job.events)
+            if not new_events and not done:
+                yield None
+            for event in new_events:
+                yield event
+            if done:
+                return
+
+    def _add_event(self, job, kind, text):
+        with self._changed:
+            if kind == 'progress':
+                job.progress = text
+            else:
+                job.events.append((kind, text))
+            self._changed.notify_all()
+
+    def _finish(self, job, status, message=None):
+        job.status = status
+        job.message = message
+        job.finished = time.time()
+        job.events.append(('end', status))
+        self._changed.notify_all()
+
+    def _run(self, job):
+        with self._changed:
+            if job.status != 'queued':
+                return
+            job.status = 'running'
+            job.started = time.time()
+            self._changed.notify_all()
+        try:
+            result = self._run_step(job.step, lambda kind, text: self._add_event(job, kind, text),
+                                    lambda: job.cancel_requested, **job.options)
+            status = 'cancelled' if job.cancel_requested else result['status']
+            message = 'Cancelled while running' if job.cancel_requested else result.get('message')
+        except Exception as e:
+            status, message = 'error', str(e)
+        with self._changed:
+            self._finish(job, status, message)
+
+    def _forget_old(self):
+        finished = [job for job in self._jobs.values() if job.status in FINISHED]
+        for job in sorted(finished, key=lambda job: job.created)[:max(0, len(finished) - self._keep)]:
+            del self._jobs[job.id]
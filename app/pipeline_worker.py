@@ -0,0 +1,198 @@
+#pipeline worker - one long-lived process that imports the steps once and runs their main() on request
+#the web UI sends it step numbers over a pipe instead of starting `python stepN.py` for every click;
+#the motif, tesserae index and parquets read by the steps stay loaded (memo_by_files, load_motif_stats)
+#and are re-read only when their files change, and config.json is re-read when it changes
+import atexit
+import contextlib
+import importlib
+import io
+import multiprocessing
+import multiprocessing.util    # its exit handler joins the worker, so it must be registered before close()
+import os
+import signal
+import threading
+import time
+import traceback
+
+STEP_MODULES = {
+    1: 'step1',
+    2: 'step2',
+    3: 'step3',
+    4: 'step4',
+    5: 'step5',
+    6: 'step6',
+    7: 'step7',
+    8: 'undo',
+    9: 'backup',
+    10: 'refine'
+}
+
+
+class EventStream(io.TextIOBase):
+    """
+    A stdout/stderr stand-in sending what the step writes back over the pipe as it comes:
+    stdout as ('line', text) for each line, stderr (tqdm bars, redrawn after '\r') as
+    ('progress', text), at most every min_interval seconds. The lines are also collected.
+    """
+
+    def __init__(self, connection, kind, min_interval=0.0):
+        self.connection = connection
+        self.kind = kind
+        self.min_interval = min_interval
+        self.lines = []
+        self._pending = ''
+        self._last_sent = 0.0
+
+    def write(self, text):
+        self._pending += text
+        separators = '\n' if self.kind == 'line' else '\r\n'
+        cut = max(self._pending.rfind(separator) for separator in separators)
+        if cut >= 0:
+            complete, self._pending = self._pending[:cut], self._pending[cut + 1:]
+            if self.kind == 'line':
+                for line in complete.split('\n'):
+                    self.lines.append(line)
+                    self.connection.send(('event', 'line', line))
+            else:
+                latest = complete.replace('\n', '\r').split('\r')
+                latest = next((part for part in reversed(latest) if part.strip()), '')
+                now = time.monotonic()
+                if latest and now - self._last_sent >= self.min_interval:
+                    self._last_sent = now
+                    self.connection.send(('event', 'progress', latest))
+        return len(text)
+
+    def flush_pending(self):
+        if self._pending:
+            self.write('\n')
+
+
+def worker_loop(connection, app_dir, overrides=None):
+    """Body of the worker process: run one step per request until the pipe closes or None arrives.
+    overrides are CONFIG values applied on top of config.json, also after it is re-read."""
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()    # own process group, so PipelineWorker can end the step's pools with the worker
+    os.chdir(app_dir)
+    os.environ["MPLBACKEND"] = "Agg"    # plt.show() in the steps must not open windows
+    import matplotlib.pyplot as plt
+    import config
+    from utils import file_signature
+
+    dict.update(config.CONFIG, overrides or {})
+    config_signature = file_signature([config.CONFIG_FILE])
+    while True:
+        try:
+            step = connection.recv()
+        except EOFError:
+            break
+        if step is None:
+            break
+
+        output = EventStream(connection, 'line')
+        progress = EventStream(connection, 'progress', min_interval=0.2)
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(progress):
+                signature = file_signature([config.CONFIG_FILE])
+                if signature != config_signature:
+                    config.reload_config()
+                    dict.update(config.CONFIG, overrides or {})
+                    config_signature = signature
+                importlib.import_module(STEP_MODULES[step]).main()
+                output.flush_pending()
+            result = {'status': 'success', 'outputs': output.lines}
+        except BaseException as e:     # a step calling sys.exit() must not end the worker
+            output.flush_pending()
+            result = {'status': 'error', 'outputs': output.lines,
+                      'message': traceback.format_exc().strip() or str(e)}
+        finally:
+            plt.close('all')
+        result['seconds'] = time.perf_counter() - start
+        connection.send(('result', result))
+
+
+class PipelineWorker:
+    """
+    Handle on the worker process, owned by the Flask app. The process is started on the
+    first step and restarted if it has died; steps run one at a time. It is not a daemon,
+    as steps 1 and 7 start process pools of their own, and is stopped by close() at exit.
+    """
+
+    def __init__(self, app_dir=None, overrides=None):
+        self.app_dir = app_dir or os.path.dirname(os.path.abspath(__file__))
+        self.overrides = overrides
+        self._lock = threading.Lock()
+        self._process = None
+        self._connection = None
+        self.running_step = None
+        atexit.register(self.close)
+
+    def _start(self):
+        context = multiprocessing.get_context('spawn')
+        self._connection, child_connection = context.Pipe()
+        self._process = context.Process(target=worker_loop, args=(child_connection, self.app_dir, self.overrides),
+                                        name='pipeline-worker', daemon=False)
+        self._process.start()
+        child_connection.close()
+
+    @staticmethod
+    def _kill(process):
+        """End the worker together with any pool processes of the step it is running."""
+        if hasattr(os, 'killpg'):
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+                return
+            except OSError:     # the worker has not made its process group yet
+                pass
+        process.terminate()
+
+    def run_step(self, step, on_event=None):
+        """Run step (a STEP_MODULES number) in the worker; returns a dict with status, outputs and
+        message. on_event(kind, text) gets the output lines and progress while the step runs."""
+        if step not in STEP_MODULES:
+            return {'status': 'error', 'message': f'Step {step} not found.'}
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                self._start()
+            self.running_step = step
+            try:
+                self._connection.send(step)
+                while True:
+                    message = self._connection.recv()
+                    if message[0] == 'result':
+                        return message[1]
+                    if on_event is not None:
+                        on_event(message[1], message[2])
+            except (EOFError, OSError) as e:
+                # the worker died inside the step (e.g. out of memory, or cancel()); the next step starts a new one
+                self._process.join(timeout=1)
+                self._process = None
+                return {'status': 'error', 'message': f'Pipeline worker stopped during step {step}: {e}'}
+            finally:
+                self.running_step = None
+
+    def cancel(self, step):
+        """Stop step, if it is the one running in the worker, by ending the worker process."""
+        process = self._process
+        if self.running_step == step and process is not None and process.is_alive():
+            self._kill(process)
+
+    def close(self, timeout=5):
+        """Stop the worker: ask it to finish and wait up to timeout seconds, then end it. A
+        step still running (the lock is held) is not waited for."""
+        process = self._process
+        if process is None:
+            return
+        if process.is_alive() and self._lock.acquire(timeout=0.1):
+            try:
+                self._connection.send(None)
+                process.join(timeout)
+            except OSError:
+                pass
+            finally:
+                self._lock.release()
+        if process.is_alive():
+            self._kill(process)
+            process.join(timeout)
+        self._process = None
+
@@ -0,0 +1,107 @@
+#refine - repeated splitting (step4) and merging (step5) rounds in one process
+#the parquets stay in memory between the passes; parquets.csv and its masking.jpg are written once at the end
+import os
+import time
+from datetime import datetime
+from PIL import Image, ImageDraw
+
+#common helper functions for this project, utils.py saved in the same folder
+from utils import *
+from utils_csv_io import *
+from utils_motif_stats import load_motif_stats
+from step4 import parquet_split
+from step5 import parquet_merge
+from config import CONFIG
+
+
+def layout_key(parquets):
+    """Order-independent fingerprint of the parquet rectangles."""
+    return hash(frozenset(map(tuple, parquets['coordinates'][:, [0, 2]].reshape(-1, 4).tolist())))
+
+
+def refine_parquets(parquets, image_path, split_diff, merge_diff, max_rounds):
+    """
+    Split and then merge the parquets, round after round, until a round leaves the number
+    of parquets unchanged, a round ends on a layout seen before (splitting and merging undoing
+    each other) or max_rounds is reached. Returns (parquets, rounds), rounds being one dict of
+    counts and seconds per round.
+    """
+    rounds = []
+    seen_layouts = {layout_key(parquets)}
+    for round_number in range(1, max_rounds + 1):
+        count_before = len(parquets)
+        round_start = time.perf_counter()
+        parquets = parquet_split(parquets, image_path, split_diff)
+        count_split = len(parquets)
+        split_seconds = time.perf_counter() - round_start
+        parquets = parquet_merge(parquets, image_path, merge_diff)
+        count_merged = len(parquets)
+        rounds.append({
+            "round": round_number,
+            "before": count_before,
+            "after_split": count_split,
+            "after_merge": count_merged,
+            "split_seconds": split_seconds,
+            "merge_seconds": time.perf_counter() - round_start - split_seconds,
+        })
+        log_message(f"Round {round_number}: {count_before} -> split {count_split} -> merge {count_merged} parquets "
+                    f"(split {rounds[-1]['split_seconds']:.2f}s, merge {rounds[-1]['merge_seconds']:.2f}s)")
+        if count_merged == count_before:
+            log_message(f"Converged after {round_number} rounds")
+            break
+        layout = layout_key(parquets)
+        if layout in seen_layouts:
+            log_message(f"Round {round_number} repeats an earlier layout, stopping")
+            break
+        seen_layouts.add(layout)
+    else:
+        log_message(f"Stopped at the limit of {max_rounds} rounds")
+    return parquets, rounds
+
+
+def main():
+    setup_logging(CONFIG["log_file"])
+
+    start_time = datetime.now()
+    max_rounds = CONFIG.get("refine_max_rounds", 5)
+    log_message(f"Refine - splitting threshold:{CONFIG['split_diff']} merging threshold:{CONFIG['merge_diff']} "
+                f"up to {max_rounds} rounds... @{start_time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+    base_path, ext = os.path.splitext(CONFIG["parquets_csv_path"])
+    masking_jpg_path = f"{base_path}.jpg"
+    csv_backup_path = f"{base_path}_last{ext}"
+    masking_jpg_backup_path = f"{base_path}_last.jpg"
+
+    backup_file(CONFIG["parquets_csv_path"], csv_backup_path)
+    backup_file(masking_jpg_path, masking_jpg_backup_path)
+
+    try:
+        parquets = read_parquet_array(CONFIG["parquets_csv_path"])
+        refined, rounds = refine_parquets(parquets, CONFIG["image_path"], CONFIG["split_diff"],
+                                          CONFIG["merge_diff"], max_rounds)
+
+        current_time = datetime.now().strftime("@%H:%M:%S @%Y-%m-%d ")
+        log_message(f"Parquet index file of {len(refined)} saving...{current_time}")
+        save_parquet_csv(refined, CONFIG["parquets_csv_path"])
+
+        # Create visualization, once for all rounds and without the matplotlib window
+        try:
+            img = load_motif_stats(CONFIG["image_path"]).image()
+            draw = ImageDraw.Draw(img)
+            for (x1, y1), (x2, y2), (x3, y3), (x4, y4) in refined["coordinates"].tolist():
+                draw.rectangle([x1, y1, x3, y3], outline="blue", width=2)
+            img.save(masking_jpg_path, 'JPEG', quality=30)
+            log_message(f"Masking visualization saved to: {masking_jpg_path}")
+        except Exception as e:
+            log_message(f"Visualization error: {str(e)}")
+
+    except Exception as e:
+        log_message(f"Error in refine execution: {str(e)}")
+        raise
+
+    end_time = datetime.now()
+    log_message(f"Refine - {len(rounds)} rounds, {len(parquets)} -> {len(refined)} parquets... done @{end_time.strftime('%Y-%m-%d %H:%M:%S')}")
+    log_message(f"===Total execution time: {(end_time - start_time).total_seconds():.2f} seconds===" )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#content-addressed stage cache for steps 3-7: a step's outputs are stored under a hash of its inputs
+#(file contents, the CONFIG keys it reads, the code) in index-n-log/stage-cache/ and restored on a hit
+import functools
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+from utils import log_message, memo_by_files
+from utils_csv_io import backup_file
+from config import CONFIG
+
+CACHE_VERSION = 2
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _masking_jpg():
+    return os.path.splitext(CONFIG["parquets_csv_path"])[0] + ".jpg"
+
+def _tesserae_index_files():
+    index = CONFIG["tesserae_index_path"]
+    return [index, os.path.splitext(index)[0] + '.npy']
+
+def _mosaic_files(mosaic_path):
+    """The mosaic step 7 wrote and its companions (progress GIF, deep zoom pyramid)."""
+    base = os.path.splitext(mosaic_path)[0]
+    return [mosaic_path, f"{base}_progress.gif", f"{base}.dzi", f"{base}_files"]
+
+
+class Stage:
+    """
+    What a step reads and writes. inputs() lists the files whose contents go into the key,
+    keys the CONFIG keys it reads; outputs(result) lists the files it writes, given what its
+    main() returned. Steps drawing random numbers (seeded) are only cached with random_seed
+    set. With copy=False the outputs are big and stay where they are: the cache only records
+    them, and a hit needs them unchanged.
+    """
+
+    def __init__(self, name, code, inputs, keys, outputs, seeded=False, backups=False, copy=True):
+        self.name = name
+        self.code = code
+        self.inputs = inputs
+        self.keys = keys
+        self.outputs = outputs
+        self.seeded = seeded
+        self.backups = backups
+        self.copy = copy
+
+
+STAGES = {
+    3: Stage("Step3", ["step3.py"], lambda: [CONFIG["image_path"]],
+             ["imode", "parquet_size_factor", "parquet_unit_width", "randomness_percentage"],
+             lambda result: [CONFIG["parquets_csv_path"], _masking_jpg()], seeded=True, backups=True),
+    4: Stage("Step4", ["step4.py"], lambda: [CONFIG["parquets_csv_path"], CONFIG["image_path"]],
+             ["split_diff", "parquet_unit_width"],
+             lambda result: [CONFIG["parquets_csv_path"], _masking_jpg()], backups=True),
+    5: Stage("Step5", ["step5.py"], lambda: [CONFIG["parquets_csv_path"], CONFIG["image_path"]],
+             ["merge_diff", "parquet_size_factor", "parquet_unit_width"],
+             lambda result: [CONFIG["parquets_csv_path"], _masking_jpg()], backups=True),
+    6: Stage("Step6", ["step6.py", "utils_matching.py"],
+             lambda: [CONFIG["parquets_csv_path"], CONFIG["image_path"]] + _tesserae_index_files(),
+             ["parquet_size_factor", "parquet_unit_width", "tessera_width", "tessera_height",
+              "threshold_percentage", "prioritized_by_chance", "vectorized_priority", "matching_engine",
+              "tessera_reuse_cap", "assignment_candidates", "assignment_overflow_penalty", "colour_index"],
+             lambda result: [CONFIG["candidates_output_path"]], seeded=True),
+    7: Stage("Step7", ["step7.py", "utils_image_io.py"],
+             lambda: [CONFIG["candidates_output_path"], CONFIG["tesserae_index_path"] + '.hash'],
+             ["mosaic_anime", "anime_fps", "anime_size_downsize", "anime_streaming", "anime_delta_frames",
+              "mosaic_jpg_quality", "mosaic_strip_height", "mosaic_deep_zoom", "deep_zoom_tile_size"],
+             lambda result: _mosaic_files(result) if result else [], copy=False),
+}
+
+
+def file_digest(path):
+    """MD5 of a file's contents (None if it is missing), recomputed only when the file changes."""
+    def digest():
+        if not os.path.exists(path):
+            return None
+        hash_md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                hash_md5.update(block)
+        return hash_md5.hexdigest()
+    return memo_by_files(('digest', path), [path], digest)
+
+def stage_key(step):
+    """Hash of everything the step's outputs depend on, or None if it cannot be cached."""
+    stage = STAGES[step]
+    seed = CONFIG.get("random_seed")
+    if stage.seeded and seed is None:
+        return None
+    description = {
+        "version": CACHE_VERSION,
+        "step": step,
+        "code": {name: file_digest(os.path.join(APP_DIR, name))
+                 for name in stage.code + ["utils.py", "utils_csv_io.py", "utils_motif_stats.py"]},
+        "inputs": [file_digest(path) for path in stage.inputs()],
+        "config": {key: CONFIG.get(key) for key in stage.keys},
+        "seed": seed if stage.seeded else None,
+    }
+    return hashlib.md5(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _entry_dir(step, key):
+    return os.path.join(CONFIG["index_folder"], "stage-cache", f"step{step}", key)
+
+def _mosaic_scores():
+    """step7.last_mosaic_scores (step7 is __main__ when run as a script)."""
+    module = sys.modules.get("step7") or sys.modules["__main__"]
+    return getattr(module, "last_mosaic_scores", {})
+
+def _signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _copy(source, destination):
+    if os.path.isdir(source):
+        shutil.rmtree(destination, ignore_errors=True)
+        shutil.copytree(source, destination)
+    else:
+        shutil.copyfile(source, destination)    # a fresh mtime, so readers see the file as changed
+
+
+def restore(step, key):
+    """Put the cached outputs of the step back in place; returns the entry's manifest, or None if
+    there is no usable entry."""
+    stage = STAGES[step]
+    entry = _entry_dir(step, key)
+    try:
+        with open(os.path.join(entry, "manifest.json"), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    outputs = manifest["outputs"]
+    if not stage.copy:
+        # big outputs are reused where they are, as long as nobody has changed them since
+        if not all(os.path.exists(path) and _signature(path) == signature for path, signature in outputs):
+            return None
+    elif not all(os.path.exists(os.path.join(entry, stored)) for stored, position in outputs):
+        return None
+
+    if stage.backups:
+        base_path, ext = os.path.splitext(CONFIG["parquets_csv_path"])
+        backup_file(CONFIG["parquets_csv_path"], f"{base_path}_last{ext}")
+        backup_file(_masking_jpg(), f"{base_path}_last.jpg")
+    if stage.copy:
+        # into the step's current output paths, wherever CONFIG points them now
+        targets = stage.outputs(None)
+        for stored, position in outputs:
+            _copy(os.path.join(entry, stored), targets[position])
+    os.utime(entry)     # most recently used
+    log_message(f"{stage.name} - inputs unchanged, outputs restored from the stage cache ({key[:12]})")
+    for line in manifest.get("notes", []):
+        print(line)
+    if step == 7 and manifest.get("scores"):
+        _mosaic_scores().update(manifest["scores"])
+    return manifest
+
+
+def _signatures(paths):
+    return {path: _signature(path) if os.path.exists(path) else None for path in paths}
+
+def store(step, key, result, before):
+    """Keep the outputs the step has just written under its key; before holds their signatures from before it ran."""
+    stage = STAGES[step]
+    paths = [(position, path) for position, path in enumerate(stage.outputs(result)) if os.path.exists(path)]
+    # a step that failed leaves its old outputs behind: store nothing then
+    if not paths or any(before.get(path) == _signature(path) for _, path in paths):
+        return
+    entry = _entry_dir(step, key)
+    tmp_entry = f"{entry}.{os.getpid()}.tmp"     # two processes may store the same entry at once
+    shutil.rmtree(tmp_entry, ignore_errors=True)
+    os.makedirs(tmp_entry)
+    manifest = {"outputs": [], "notes": [], "result": result}
+    for position, path in paths:
+        if stage.copy:
+            stored = f"{position}_{os.path.basename(path)}"
+            _copy(path, os.path.join(tmp_entry, stored))
+            manifest["outputs"].append([stored, position])
+        else:
+            manifest["outputs"].append([path, _signature(path)])
+    if step == 7:
+        scores = _mosaic_scores()
+        if scores.get("output_path") == result:
+            manifest["scores"] = dict(scores)
+            manifest["notes"].append(f"Normalized Mosaic Noise: {scores['noise_db']:.2f} dB")
+        manifest["notes"].append(f"Mosaic saved to: {result}")
+        if os.path.exists(os.path.splitext(result)[0] + ".dzi"):
+            manifest["notes"].append(f"VIEWER: /viewer/{os.path.basename(os.path.splitext(result)[0])}")
+    with open(os.path.join(tmp_entry, "manifest.json"), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(tmp_entry, entry)
+    prune(step)
+
+
+def prune(step):
+    """Keep the stage_cache_entries most recently used entries of the step."""
+    folder = os.path.dirname(_entry_dir(step, "x"))
+    entries = sorted((os.path.join(folder, name) for name in os.listdir(folder) if not name.endswith(".tmp")),
+                     key=os.path.getmtime, reverse=True)
+    for entry in entries[CONFIG.get("stage_cache_entries", 8):]:
+        shutil.rmtree(entry, ignore_errors=True)
+
+
+def cached_stage(step):
+    """Decorator for a step's main(): skip it when the stage cache holds outputs for the same inputs."""
+    def decorate(main):
+        @functools.wraps(main)
+        def run():
+            if not CONFIG.get("stage_cache", False):
+                return main()
+            key = stage_key(step)
+            manifest = restore(step, key) if key is not None else None
+            if manifest is not None:
+                return manifest.get("result")
+            before = _signatures(STAGES[step].outputs(None)) if STAGES[step].copy else {}
+            result = main()
+            if key is not None:
+                try:
+                    store(step, key, result, before)
+                except OSError as e:
+                    log_message(f"Stage cache: could not store {STAGES[step].name} outputs: {e}")
+            return result
+        return run
+    return decorate
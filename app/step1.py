@@ -3,12 +3,16 @@ os.environ["NUMEXPR_MAX_THREADS"] = "16"
 
 from datetime import datetime
 import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 from PIL import Image
+import numpy as np
 import shutil
 
 # Import the centralized configuration
 from config import CONFIG  # Import the read-only CONFIG object
+import step2
 
 #common helper functions for this project, utils.py saved in the same folder
 from utils import *
@@ -45,16 +49,39 @@ def clear_tesserae_folders(tesserae_folder):
         shutil.rmtree(tesserae_folder)
     os.makedirs(tesserae_folder)
 
-def crop_and_resize_image(img, aspect_ratio, tess_size):
-    """Crop and resize image to specified aspect ratio and size."""
+# Reducing resize: shrink by an integer factor with a box filter first when the
+# tessera is more than REDUCING_GAP times smaller than the crop, then resample.
+REDUCING_GAP = 3.0
+
+def centre_crop_size(width, height, aspect_ratio):
+    """Size of the largest centred crop of the given aspect ratio."""
+    if width / height > aspect_ratio:
+        return int(height * aspect_ratio), height
+    return width, int(width / aspect_ratio)
+
+def draft_for_tessera(img, aspect_ratio, tess_size):
+    """Let the JPEG decoder scale down by 1/2, 1/4 or 1/8 (DCT scaling) as far as the
+    centre crop still covers the tessera size. Must be called before the image is loaded;
+    non-JPEG images are left untouched."""
+    if img.format != 'JPEG':
+        return
+    width, height = img.size
+    target = tess_size if width > height else tess_size[::-1]
+    crop_width, crop_height = centre_crop_size(width, height, aspect_ratio)
+    if crop_width < target[0] or crop_height < target[1]:
+        return
+    # draft() picks the largest scale whose decoded size is still >= the requested size
+    requested = (-(-width * target[0] // crop_width), -(-height * target[1] // crop_height))
+    img.draft(img.mode, requested)
+
+def crop_and_resize_image(img, aspect_ratio, tess_size, original_size=None):
+    """Crop and resize image to specified aspect ratio and size.
+
+    original_size is the size of the tile on disk when img was decoded at a reduced
+    (draft) scale; the "too small" check is always made against the tile on disk."""
     try:
         width, height = img.size
-        if width / height > aspect_ratio:
-            new_height = height
-            new_width = int(new_height * aspect_ratio)
-        else:
-            new_width = width
-            new_height = int(new_width / aspect_ratio)
+        new_width, new_height = centre_crop_size(width, height, aspect_ratio)
 
         left = (width - new_width) // 2
         top = (height - new_height) // 2
@@ -63,29 +90,43 @@ def crop_and_resize_image(img, aspect_ratio, tess_size):
 
         cropped_img = img.crop((left, top, right, bottom))
         cropped_width, cropped_height = cropped_img.size
+        if original_size is not None:
+            width, height = original_size
+            cropped_width, cropped_height = centre_crop_size(width, height, aspect_ratio)
 
         if (width > height and (cropped_width < tess_size[0] or cropped_height < tess_size[1])) or \
            (width <= height and (cropped_width < tess_size[1] or cropped_height < tess_size[0])):
             return None, "Tile image is too small"
         else:
-            resized_img = cropped_img.resize(tess_size if width > height else tess_size[::-1])
+            resized_img = cropped_img.resize(tess_size if width > height else tess_size[::-1],
+                                             reducing_gap=REDUCING_GAP)
             return resized_img, None
 
     except Exception as e:
         raise Exception(f"Error cropping and resizing image: {e}")
 
-def process_image(image_path, tesserae_folder, tile_folder, tess_size):
-    """Process a single image - crop, resize, and save to the appropriate subfolder."""
+def tessera_path_for(image_path, tesserae_folder, tile_folder):
+    """Return the tessera (.png) path a tile image is cropped to, mirroring the tile folder tree."""
+    relative_path = os.path.relpath(os.path.dirname(image_path), tile_folder)
+    filename = os.path.splitext(os.path.basename(image_path))[0] + '.png'
+    return os.path.join(tesserae_folder, relative_path, filename)
+
+def crop_tile(image_path, tesserae_folder, tile_folder, tess_size, draft=None,
+              with_colours=False):
+    """Crop, resize and save a single tile. Returns (success, message, colours) instead of
+    logging, so it can run inside a worker process. With draft, JPEG tiles are decoded at
+    reduced scale. With with_colours, colours is ((width, height), average and quadrant
+    colours) of the tessera, computed from the in-memory image as step 2 would from the PNG.
+    draft=None takes jpeg_draft from CONFIG at call time."""
+    if draft is None:
+        draft = CONFIG.get("jpeg_draft", True)
     try:
         img = Image.open(image_path)
         width, height = img.size
 
-        # Determine the relative path of the image in the tile folder
-        relative_path = os.path.relpath(os.path.dirname(image_path), tile_folder)
-
         # Create the corresponding subfolder in the tesserae folder
-        dest_folder = os.path.join(tesserae_folder, relative_path)
-        os.makedirs(dest_folder, exist_ok=True)
+        save_path = tessera_path_for(image_path, tesserae_folder, tile_folder)
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
 
         # Crop and resize the image
         if width > height:
@@ -93,32 +134,104 @@ def process_image(image_path, tesserae_folder, tile_folder, tess_size):
         else:
             aspect_ratio = 2 / 3
 
-        cropped_resized_img, error = crop_and_resize_image(img, aspect_ratio, tess_size)
+        if draft:
+            draft_for_tessera(img, aspect_ratio, tess_size)
+        cropped_resized_img, error = crop_and_resize_image(img, aspect_ratio, tess_size, (width, height))
         
         if error:
-            log_message(f"\nSkipping {image_path}: {error}")
-            return False
+            return False, f"\nSkipping {image_path}: {error}", None
 
         # Save the processed image
-        filename = os.path.splitext(os.path.basename(image_path))[0] + '.png'
-        save_path = os.path.join(dest_folder, filename)
         cropped_resized_img.save(save_path, 'PNG')
-        return True
+        colours = None
+        if with_colours:
+            colours = (cropped_resized_img.size, colour_stats(np.asarray(cropped_resized_img.convert('RGB'))))
+        return True, None, colours
     except Exception as e:
-        log_message(f"Error processing {image_path}: {e}")
-        return False
+        return False, f"Error processing {image_path}: {e}", None
 
-def crop_tiles_and_save(tile_folder, tesserae_folder, tess_size):
-    """Main function to process all images in the tile folder."""
-    clear_tesserae_folders(tesserae_folder)
-    log_message(f"Tesserae folder cleared at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+def process_image(image_path, tesserae_folder, tile_folder, tess_size):
+    """Process a single image - crop, resize, and save to the appropriate subfolder."""
+    success, message, _ = crop_tile(image_path, tesserae_folder, tile_folder, tess_size)
+    if message:
+        log_message(message)
+    return success
+
+def _crop_tile_job(job):
+    """Process-pool entry point: job is the (image_path, tesserae_folder, tile_folder, tess_size,
+    draft, with_colours) tuple."""
+    return crop_tile(*job)
+
+def crop_tiles_parallel(image_paths, tesserae_folder, tile_folder, tess_size, workers, colours=None,
+                        desc="Crop-n-Resizing images"):
+    """Crop a list of tiles with a process pool. Returns the number of tesserae saved.
+
+    Tiles sharing a tessera name (e.g. a.jpg and a.png in one folder) are cropped afterwards
+    in walk order in this process, so the last one wins exactly as in a serial run."""
+    targets = {}
+    for image_path in image_paths:
+        targets.setdefault(tessera_path_for(image_path, tesserae_folder, tile_folder), []).append(image_path)
+    colliding = {p for paths in targets.values() if len(paths) > 1 for p in paths}
+    pooled = [p for p in image_paths if p not in colliding]
+
+    draft = CONFIG.get("jpeg_draft", True)
+    with_colours = colours is not None
+
+    def record(image_path, result):
+        success, message, tile_colours = result
+        if message:
+            log_message(message)
+        if success and with_colours:
+            colours[image_path] = tile_colours
+        return success
 
-    image_paths = get_all_image_paths(tile_folder)
     success_count = 0
+    chunksize = max(1, len(pooled) // (workers * 16))
+    jobs = ((image_path, tesserae_folder, tile_folder, tess_size, draft, with_colours) for image_path in pooled)
+    with ProcessPoolExecutor(max_workers=workers) as executor, \
+         tqdm(total=len(image_paths), desc=desc) as pbar:
+        for image_path, result in zip(pooled, executor.map(_crop_tile_job, jobs, chunksize=chunksize)):
+            success_count += record(image_path, result)
+            pbar.update(1)
+        for image_path in image_paths:
+            if image_path in colliding:
+                result = crop_tile(image_path, tesserae_folder, tile_folder, tess_size, draft, with_colours)
+                success_count += record(image_path, result)
+                pbar.update(1)
+    return success_count
+
+def crop_tiles(image_paths, tesserae_folder, tile_folder, tess_size, workers=1, colours=None):
+    """Crop a list of tiles, serially or with a process pool. Returns the number of tesserae saved.
 
+    If colours is a dict, it is filled with image_path -> ((width, height), colours) for every
+    tessera saved (see crop_tile)."""
+    workers = resolve_workers(workers)
+    if workers > 1 and len(image_paths) > 1:
+        log_message(f"Cropping with {workers} worker processes")
+        return crop_tiles_parallel(image_paths, tesserae_folder, tile_folder, tess_size, workers, colours)
+
+    success_count = 0
     for image_path in tqdm(image_paths, desc="Crop-n-Resizing images"):
-        if process_image(image_path, tesserae_folder, tile_folder, tess_size):
+        success, message, tile_colours = crop_tile(image_path, tesserae_folder, tile_folder, tess_size,
+                                                   with_colours=colours is not None)
+        if message:
+            log_message(message)
+        if success:
             success_count += 1
+            if colours is not None:
+                colours[image_path] = tile_colours
+    return success_count
+
+def crop_tiles_and_save(tile_folder, tesserae_folder, tess_size, workers=1, colours=None):
+    """Main function to process all images in the tile folder.
+
+    workers > 1 (or 0 for one per core) crops the tiles in a process pool; the tesserae
+    written are identical to a serial run. colours is filled as in crop_tiles."""
+    clear_tesserae_folders(tesserae_folder)
+    log_message(f"Tesserae folder cleared at: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+
+    image_paths = get_all_image_paths(tile_folder)
+    success_count = crop_tiles(image_paths, tesserae_folder, tile_folder, tess_size, workers, colours)
 
     total_size_mb = get_folder_size(tesserae_folder)
     log_message(f"Total size of tesserae folder: {total_size_mb:.2f} MB")
@@ -126,6 +239,112 @@ def crop_tiles_and_save(tile_folder, tesserae_folder, tess_size):
     log_message(f"Skipped {len(image_paths) - success_count} image(s) due to errors or small size.")
     return success_count
 
+def scan_tile_folder(tile_folder, tess_size):
+    """Build the per-file manifest entries {relative path: {size, mtime, tessera_size}} of the tile folder."""
+    tiles = {}
+    for image_path in get_all_image_paths(tile_folder):
+        stat = os.stat(image_path)
+        tiles[os.path.relpath(image_path, tile_folder)] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "tessera_size": list(tess_size)
+        }
+    return tiles
+
+def load_tile_manifest(manifest_path):
+    """Load the tile manifest of the last run, or None if it is missing or unreadable."""
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)["tiles"]
+    except (OSError, ValueError, KeyError) as e:
+        if os.path.exists(manifest_path):
+            log_message(f"Ignoring unreadable tile manifest {manifest_path}: {e}")
+        return None
+
+def attach_colours(tiles, tile_folder, colours):
+    """Record the tessera dimensions and colours returned by crop_tiles in the manifest entries."""
+    for image_path, (dimensions, tile_colours) in colours.items():
+        entry = tiles.get(os.path.relpath(image_path, tile_folder))
+        if entry is not None:
+            entry["dimensions"] = list(dimensions)
+            entry["colours"] = [list(colour) for colour in tile_colours]
+    return tiles
+
+def same_tile(entry, previous):
+    """True if a tile is unchanged since the manifest entry of the last run."""
+    return previous is not None and all(
+        entry[key] == previous.get(key) for key in ("size", "mtime", "tessera_size"))
+
+def save_tile_manifest(manifest_path, tiles):
+    with open(manifest_path, 'w') as f:
+        json.dump({"tiles": tiles}, f)
+
+def full_rebuild_reason(tiles, tesserae_folder, tess_size):
+    """Return why the tesserae must be rebuilt from scratch, or None if an incremental update will do."""
+    if tiles is None:
+        return "No tile manifest found"
+    if not os.path.isdir(tesserae_folder):
+        return "Tesserae folder missing"
+    if any(entry.get("tessera_size") != list(tess_size) for entry in tiles.values()):
+        return f"Tessera size changed to {tess_size[0]}x{tess_size[1]}"
+    return None
+
+def update_tesserae(tile_folder, tesserae_folder, tess_size, previous, workers=1, colours=None):
+    """Bring the tesserae folder in line with the tile folder using the manifest of the last run:
+    crop new or changed tiles and delete tesserae whose source tile is gone.
+    Returns the manifest entries for the current tile folder. With colours (a dict, as in
+    crop_tiles), the entries keep the colours recorded for tiles that were not re-cropped."""
+    current = scan_tile_folder(tile_folder, tess_size)
+    changed = [rel for rel, entry in current.items() if not same_tile(entry, previous.get(rel))]
+    removed = [rel for rel in previous if rel not in current]
+    if not changed and not removed:
+        log_message("No tile added, changed or removed. Tesserae are up to date.")
+        to_crop = []
+    else:
+        stale_targets = {
+            tessera_path_for(os.path.join(tile_folder, rel), tesserae_folder, tile_folder)
+            for rel in changed + removed
+        }
+        # Re-crop every tile writing to a stale tessera, so name clashes (a.jpg/a.png) resolve as in a full run
+        image_paths = get_all_image_paths(tile_folder)
+        to_crop = [p for p in image_paths if tessera_path_for(p, tesserae_folder, tile_folder) in stale_targets]
+
+        deleted_count = 0
+        for target in stale_targets:
+            if os.path.exists(target):
+                os.remove(target)
+                deleted_count += 1
+
+        success_count = crop_tiles(to_crop, tesserae_folder, tile_folder, tess_size, workers, colours)
+        log_message(f"Tiles new or changed: {len(changed)}, removed: {len(removed)}")
+        log_message(f"Cropped and resized {success_count} of {len(to_crop)} images, {deleted_count} stale tesserae deleted.")
+
+    if colours is not None:
+        recropped = {os.path.relpath(p, tile_folder) for p in to_crop}
+        for rel, entry in current.items():
+            if rel not in recropped and "colours" in previous.get(rel, {}):
+                entry["dimensions"] = previous[rel]["dimensions"]
+                entry["colours"] = previous[rel]["colours"]
+        attach_colours(current, tile_folder, colours)
+    return current
+
+def write_fused_tesserae_index(tiles, tile_folder, tesserae_folder, index_file):
+    """Write the tesserae index (and the step 2 hash next to it) from the colours recorded
+    while cropping, so step 2 finds it up to date without decoding the tesserae again.
+    Tesserae without recorded colours are decoded by step2.generate_tess_index as usual."""
+    known_colours = {}
+    for rel, entry in tiles.items():   # walk order: with a name clash the last tile cropped wins
+        if "colours" in entry:
+            tessera_path = tessera_path_for(os.path.join(tile_folder, rel), tesserae_folder, tile_folder)
+            known_colours[os.path.normpath(tessera_path)] = (
+                tuple(entry["dimensions"]), tuple(tuple(colour) for colour in entry["colours"]))
+
+    tesserae_paths = step2.get_all_image_paths(tesserae_folder)
+    step2.generate_tess_index(tesserae_paths, index_file, CONFIG.get("index_batch_size", 256), known_colours)
+    with open(index_file + '.hash', 'w') as hashfile:
+        hashfile.write(step2.calculate_folder_hash(tesserae_paths))
+    log_message(f"Tesserae index written in the same pass: {index_file}")
+
 def check_folder_changes(tile_folder, tile_hash_file_path):
     """Check if tile folder has changed since last run."""
     all_image_paths = get_all_image_paths(tile_folder)
@@ -158,25 +377,49 @@ def main():
         tile_hash_file_path
     )
 
-    if CONFIG["force_refresh"]:
-        log_message("Force refresh enabled. Regenerating tesserae.")
+    # Per-file manifest (path, size, mtime, tessera size) kept next to tile_folder.hash
+    tile_manifest_path = os.path.join(CONFIG["hash_file_directory"], 'tile_folder.manifest.json')
+    previous_tiles = load_tile_manifest(tile_manifest_path)
+    rebuild_reason = full_rebuild_reason(previous_tiles, CONFIG["tesserae_folder"], tess_dimension)
+
+    # Fused mode: colours are computed from the in-memory tesserae and the index is written here
+    colours = {} if CONFIG.get("fused_indexing", False) else None
+
+    if CONFIG["force_refresh"] or rebuild_reason:
+        log_message("Force refresh enabled. Regenerating tesserae." if CONFIG["force_refresh"]
+                    else f"{rebuild_reason}. Regenerating tesserae.")
         crop_tiles_and_save(
             CONFIG["tile_folder"], 
             CONFIG["tesserae_folder"], 
-            tess_dimension
+            tess_dimension,
+            CONFIG.get("crop_workers", 0),
+            colours
         )
+        current_tiles = scan_tile_folder(CONFIG["tile_folder"], tess_dimension)
+        if colours is not None:
+            attach_colours(current_tiles, CONFIG["tile_folder"], colours)
+            write_fused_tesserae_index(current_tiles, CONFIG["tile_folder"], CONFIG["tesserae_folder"],
+                                       CONFIG["tesserae_index_path"])
+        save_tile_manifest(tile_manifest_path, current_tiles)
         # Save the new hash after regeneration
         current_hash = calculate_folder_hash(get_all_image_paths(CONFIG["tile_folder"]))
         with open(tile_hash_file_path, 'w') as hashfile:
             hashfile.write(current_hash)
     elif has_changes:
-        log_message("Changes detected in the tile folder. Regenerating tesserae.")
-        crop_tiles_and_save(
+        log_message("Changes detected in the tile folder. Updating tesserae incrementally.")
+        current_tiles = update_tesserae(
             CONFIG["tile_folder"], 
             CONFIG["tesserae_folder"], 
-            tess_dimension
+            tess_dimension,
+            previous_tiles,
+            CONFIG.get("crop_workers", 0),
+            colours
         )
-        # Save the new hash after regeneration
+        if colours is not None:
+            write_fused_tesserae_index(current_tiles, CONFIG["tile_folder"], CONFIG["tesserae_folder"],
+                                       CONFIG["tesserae_index_path"])
+        save_tile_manifest(tile_manifest_path, current_tiles)
+        # Save the new hash after the update
         with open(tile_hash_file_path, 'w') as hashfile:
             hashfile.write(current_hash)
     else:
@@ -22,10 +22,6 @@ def get_all_image_paths(root_folder):
                 image_paths.append(os.path.join(root, file))
     return image_paths
 
-def classify_orientation(image):
-    width, height = image.size
-    return "landscape" if width > height else "portrait"
-
 def calculate_folder_hash(image_paths):
     hash_md5 = hashlib.md5()
     for image_path in sorted(image_paths):
@@ -33,90 +29,129 @@ def calculate_folder_hash(image_paths):
         hash_md5.update(str(os.path.getmtime(image_path)).encode('utf-8'))
     return hash_md5.hexdigest()
 
-def process_image_quadrants(img, original_dimensions):
-    top_left = img.crop((0, 0, original_dimensions[0] // 2, original_dimensions[1] // 2))
-    top_right = img.crop((original_dimensions[0] // 2, 0, original_dimensions[0], original_dimensions[1] // 2))
-    bottom_left = img.crop((0, original_dimensions[1] // 2, original_dimensions[0] // 2, original_dimensions[1]))
-    bottom_right = img.crop((original_dimensions[0] // 2, original_dimensions[1] // 2, original_dimensions[0], original_dimensions[1]))
+def classify_tessera(image_path):
+    """Classify a tessera by its subfolder (priority/N, optional/N, nocrop/N, unused).
+    Returns (priority, icropable, iused, category); category is None when the numeric
+    subfolder cannot be parsed and the defaults are kept."""
+    iused = 1     # Default using img except it is the folder unused
+    priority = 0  # Default priority 0 for other subfolders the will be assigned to the lowest 
+    icropable = 1 # Default image can be cropped from 3x2 to 4x3, except images in the folder nocrop
+    category = None
+    image_path_parts = image_path.split(os.sep)  # Split path into components
     
-    return (
-        calculate_average_color(top_left),
-        calculate_average_color(top_right),
-        calculate_average_color(bottom_left),
-        calculate_average_color(bottom_right)
-    )
-
-def generate_tess_index(tesserae_paths, index_file):
+    try:
+        # Check if the image is in a priority subfolder
+        if 'priority' in image_path_parts:
+            priority_index = image_path_parts.index('priority') + 1
+            priority_suffix = int(image_path_parts[priority_index])  # Extract numeric suffix from subfolder
+            priority = priority_suffix               #they take +ve priority
+            category = 'priority'
+        # Check if the image is in an optional subfolder
+        elif 'optional' in image_path_parts:
+            optional_index = image_path_parts.index('optional') + 1
+            optional_suffix = int(image_path_parts[optional_index])  # Extract numeric suffix from subfolder
+            priority = (0 + optional_suffix)*(-1)     #optional images take -ve priority
+            category = 'optional'
+        # Check if the image is in a nocrop subfolder
+        elif 'nocrop' in image_path_parts:                
+            priority_index = image_path_parts.index('nocrop') + 1
+            priority_suffix = int(image_path_parts[priority_index])  # Extract numeric suffix from subfolder
+            priority = priority_suffix               #they take +ve priority
+            icropable = 0
+            category = 'nocrop'
+        elif 'unused' in image_path_parts:
+            iused = 0
+            category = 'unused'
+        else: category = 'included'
+        
+    except (ValueError, IndexError):
+        # Fallback to default priority if parsing fails
+        pass
+
+    return priority, icropable, iused, category
+
+def load_tessera_pixels(image_path):
+    """Decode a tessera once into an RGB uint8 array of shape (height, width, 3)."""
+    with Image.open(image_path) as img:
+        return np.asarray(img.convert('RGB'))
+
+def tessera_colour_stats(image_path):
+    """Average colour and the four quadrant colours of a single tessera."""
+    return colour_stats(load_tessera_pixels(image_path))
+
+def iter_tesserae_stats(image_paths, batch_size=256):
+    """Yield (image_path, (width, height), colours) for each tessera, in order.
+
+    Tesserae are loaded batch_size at a time and every group of same-sized ones (all of
+    them after step 1) is reduced as a single 4-D array by batch_colour_stats."""
+    batch_size = max(1, batch_size)
+    for start in range(0, len(image_paths), batch_size):
+        batch = image_paths[start:start + batch_size]
+        pixels = [load_tessera_pixels(image_path) for image_path in batch]
+
+        same_size = {}
+        for i, array in enumerate(pixels):
+            same_size.setdefault(array.shape, []).append(i)
+        colours = [None] * len(batch)
+        for indices in same_size.values():
+            stats = batch_colour_stats(np.stack([pixels[i] for i in indices]))
+            for i, stat in zip(indices, stats.tolist()):
+                colours[i] = tuple(tuple(colour) for colour in stat)
+
+        for image_path, array, colour in zip(batch, pixels, colours):
+            yield image_path, (array.shape[1], array.shape[0]), colour
+
+def generate_tess_index(tesserae_paths, index_file, batch_size=256, known_colours=None):
+    """Write the tesserae index for tesserae_paths. known_colours maps a normalised tessera
+    path to ((width, height), colours) already computed (step 1 fused mode); only the other
+    tesserae are decoded."""
     index_data = []
     landscape_count = 0
     portrait_count = 0
-    priority_count = 0
-    optional_count = 0
-    nocrop_count = 0
-    included_count = 0
-    unused_count = 0
-    for image_path in tqdm(tesserae_paths, desc="Registering tesserae metadata"):
-        # Determine priority based on subfolder structure
-        iused = 1     # Default using img except it is the folder unused
-        priority = 0  # Default priority 0 for other subfolders the will be assigned to the lowest 
-        icropable = 1 # Default image can be cropped from 3x2 to 4x3, except images in the folder nocrop
-        image_path_parts = image_path.split(os.sep)  # Split path into components
-        
-        try:
-            # Check if the image is in a priority subfolder
-            if 'priority' in image_path_parts:
-                priority_index = image_path_parts.index('priority') + 1
-                priority_suffix = int(image_path_parts[priority_index])  # Extract numeric suffix from subfolder
-                priority = priority_suffix               #they take +ve priority
-                priority_count += 1
-            # Check if the image is in an optional subfolder
-            elif 'optional' in image_path_parts:
-                optional_index = image_path_parts.index('optional') + 1
-                optional_suffix = int(image_path_parts[optional_index])  # Extract numeric suffix from subfolder
-                priority = (0 + optional_suffix)*(-1)     #optional images take -ve priority
-                optional_count += 1          
-            # Check if the image is in a nocrop subfolder
-            elif 'nocrop' in image_path_parts:                
-                priority_index = image_path_parts.index('nocrop') + 1
-                priority_suffix = int(image_path_parts[priority_index])  # Extract numeric suffix from subfolder
-                priority = priority_suffix               #they take +ve priority
-                icropable = 0
-                nocrop_count += 1 
-            elif 'unused' in image_path_parts:
-                iused = 0
-                unused_count +=1
-            else: included_count += 1
-            
-        except (ValueError, IndexError):
-            # Fallback to default priority if parsing fails
-            pass
+    counts = {'priority': 0, 'optional': 0, 'nocrop': 0, 'included': 0, 'unused': 0}
+
+    # Classify by subfolder first, so only the tesserae that go into the index are decoded
+    selected = []
+    for image_path in tesserae_paths:
+        priority, icropable, iused, category = classify_tessera(image_path)
+        if category:
+            counts[category] += 1
 
         if CONFIG["optional_tesserae"]: 
             if priority<0: priority=(-1)*priority
         
         if (priority >= 0) and (iused == 1):
-            img = Image.open(image_path).convert('RGBA')
-      
-            original_dimensions = img.size
-            avg_color = calculate_average_color(img)
-            quadrant_colors = process_image_quadrants(img, original_dimensions)
-            orientation = classify_orientation(img)        
-            if orientation == "landscape": landscape_count += 1
-            else: portrait_count += 1
-   
-            index_data.append([
-                image_path, avg_color, original_dimensions, orientation,
-                *quadrant_colors,
-                priority, icropable  # priority, cropable
-            ])
+            selected.append((image_path, priority, icropable))
+
+    known_colours = known_colours or {}
+    decoded = iter_tesserae_stats([image_path for image_path, _, _ in selected
+                                   if os.path.normpath(image_path) not in known_colours], batch_size)
+    def all_stats():
+        for image_path, _, _ in selected:
+            known = known_colours.get(os.path.normpath(image_path))
+            yield (image_path, *known) if known else next(decoded)
+
+    stats_iter = all_stats()
+    for (image_path, original_dimensions, colours), (_, priority, icropable) in zip(
+            tqdm(stats_iter, total=len(selected), desc="Registering tesserae metadata"), selected):
+        avg_color, *quadrant_colors = colours
+        orientation = "landscape" if original_dimensions[0] > original_dimensions[1] else "portrait"
+        if orientation == "landscape": landscape_count += 1
+        else: portrait_count += 1
+
+        index_data.append([
+            image_path, avg_color, original_dimensions, orientation,
+            *quadrant_colors,
+            priority, icropable  # priority, cropable
+        ])
 
     #new integration of write_tesserae_index_file imported from utils_csv_io.py
-    write_tesserae_index_file(index_file, index_data)  
+    write_tesserae_index_file(index_file, index_data, CONFIG.get("binary_tesserae_index", True))  
     
     stats = {
         "Tile Orientation": f"Landscape: {landscape_count}, Portrait: {portrait_count}",
-        "Tile Categories": f"Priority: {priority_count},  NoCrop: {nocrop_count}, Included: {included_count}",
-        "Auxiliary Tiles": f"Optional: {optional_count}, Unused: {unused_count}"
+        "Tile Categories": f"Priority: {counts['priority']},  NoCrop: {counts['nocrop']}, Included: {counts['included']}",
+        "Auxiliary Tiles": f"Optional: {counts['optional']}, Unused: {counts['unused']}"
     }
     for category, value in stats.items():
         log_message(f"{category}: {value}")
@@ -158,7 +193,7 @@ def main():
 
     if check_for_changes(CONFIG["tesserae_index_path"], current_hash, refresh):
         log_message("Changes detected or forced refresh. Regenerating tesserae index.")
-        generate_tess_index(tesserae_paths, CONFIG["tesserae_index_path"])
+        generate_tess_index(tesserae_paths, CONFIG["tesserae_index_path"], CONFIG.get("index_batch_size", 256))
         with open(CONFIG["tesserae_index_path"] + '.hash', 'w') as hashfile:
             hashfile.write(current_hash)
     else:
@@ -5,20 +5,102 @@ os.environ["NUMEXPR_MAX_THREADS"] = "16"
 from PIL import Image, ImageDraw
 import csv
 import random
+import numpy as np
 import shutil
 import matplotlib.pyplot as plt
-from tqdm import tqdm
 from datetime import datetime
 
 from config import CONFIG
+from stage_cache import cached_stage
 
 #common helper functions for this project, utils.py saved in the same folder
-from utils import calculate_average_color 
 from utils import log_message
 from utils import setup_logging
-from utils import average_colour_n_fallback
+from utils_motif_stats import load_motif_stats
 from utils_csv_io import backup_file
 from utils_csv_io import save_parquet_csv
+from utils_csv_io import parquet_array
+
+
+def parquet_lattice(imode, ratio, img_width, img_height, width_parquet, height_parquet):
+    """
+    Corners of the parquet lattice covering the motif, as NumPy arrays in row-major order:
+    (x1, y1, x3, y3, landscape). The first row is laid out along x (imode 1), along y
+    (imode -1) or twisted between landscape and portrait (imode 0); every further row is the
+    previous one moved by a row step plus a random shift. Draws from `random` in the same
+    order as the dict-per-cell layout did, so a seed gives the same lattice.
+    """
+    middle_x = img_width // 2 - width_parquet // 2
+    middle_y = img_height // 2 - height_parquet // 2
+    x_off = random.randint(0, width_parquet-1)
+    y_off = random.randint(0, width_parquet-1)
+
+    # First parquet
+    if imode == 1:
+        x1, y1 = -middle_x - 2 * img_width + x_off, -middle_y + y_off
+    elif imode == -1:
+        x1, y1 = -middle_x + x_off, -middle_y - 2 * img_width + y_off
+    else:
+        x1, y1 = middle_x*2 + x_off, -middle_y*2 + y_off
+
+    columns = max(1, 4 * (img_width // width_parquet))
+    rows = max(1, 4 * (img_height // height_parquet))
+    steps = np.arange(columns, dtype=np.int64)
+
+    # Unit row
+    if imode == 1:
+        row_x1 = x1 + steps * width_parquet
+        row_y1 = np.full(columns, y1, dtype=np.int64)
+        landscape = np.ones(columns, dtype=bool)
+    elif imode == -1:
+        row_x1 = np.full(columns, x1, dtype=np.int64)
+        row_y1 = y1 + steps * width_parquet
+        landscape = np.zeros(columns, dtype=bool)
+    else:
+        # itwist starts at 1, goes up by one per parquet and by one more on a random twist;
+        # a landscape parquet hangs up-right from the last bottom-right corner, a portrait down-left
+        twists = np.array([random.random() > ratio for _ in range(1, columns)], dtype=np.int64)
+        landscape = np.ones(columns, dtype=bool)
+        landscape[1:] = (1 + (steps[1:] - 1) + np.cumsum(twists)) % 2 == 0
+        corner_x = x1 + width_parquet + np.cumsum(np.where(landscape, width_parquet, 0)) - width_parquet
+        corner_y = y1 + height_parquet + np.cumsum(np.where(landscape, 0, width_parquet))
+        row_x1 = np.where(landscape, corner_x - width_parquet, corner_x - height_parquet)
+        row_y1 = np.where(landscape, corner_y - height_parquet, corner_y - width_parquet)
+    row_width = np.where(landscape, width_parquet, height_parquet)
+    row_height = np.where(landscape, height_parquet, width_parquet)
+
+    # Row offsets: one row step, plus a random shift along the row for imode 1 / -1
+    row_shift = np.zeros(rows, dtype=np.int64)
+    for row in range(1, rows):
+        if random.random() > ratio:
+            row_shift[row] = 0
+        else: row_shift[row] = random.randint(4*width_parquet//10, 7*width_parquet//10)
+    shifts = np.cumsum(row_shift)
+    step = np.arange(rows, dtype=np.int64) * height_parquet
+    if imode == 1:
+        dx, dy = shifts, step
+    elif imode == -1:
+        dx, dy = step, shifts
+    else:
+        dx, dy = -step, step
+
+    x1 = (dx[:, None] + row_x1[None, :]).ravel()
+    y1 = (dy[:, None] + row_y1[None, :]).ravel()
+    x3 = x1 + np.tile(row_width, rows)
+    y3 = y1 + np.tile(row_height, rows)
+    return x1, y1, x3, y3, np.tile(landscape, rows)
+
+
+def lattice_priorities(x1, y1, x3, y3, inside, img_width, img_height):
+    """Matching priority per parquet: 2^15 across a third line, 2^14 with a corner in the centre third, else 2^13; 0 on the edge."""
+    priority = np.full(len(x1), pow(2, 13), dtype=np.int64)
+    centre = lambda x, y: (img_width/3 < x) & (x < 2*img_width/3) & (img_height/3 < y) & (y < 2*img_height/3)
+    priority[centre(x1, y1) | centre(x3, y3)] = pow(2, 14)
+    on_third = ((x1 <= img_width/3) & (img_width/3 <= x3)) | ((x1 <= 2*img_width/3) & (2*img_width/3 <= x3)) | \
+               ((y1 <= img_height/3) & (img_height/3 <= y3)) | ((y1 <= 2*img_height/3) & (2*img_height/3 <= y3))
+    priority[on_third] = pow(2, 15)
+    priority[inside < 4] = 0     ###assign parquet on the edge priority to lowest
+    return priority
 
 
 def analyze_target(imode, ratio, image_path, width_parquet, height_parquet, csv_path, seed=None):
@@ -34,236 +116,33 @@ def analyze_target(imode, ratio, image_path, width_parquet, height_parquet, csv_
         # Validate image dimensions
         if img_width == 0 or img_height == 0:
             raise ValueError("Invalid image dimensions (0x0). Check the input image.")
-        
-        middle_x = img_width // 2 - width_parquet // 2
-        middle_y = img_height // 2 - height_parquet // 2
-        parquets = []
-        x_off = random.randint(0, width_parquet-1)
-        y_off = random.randint(0, width_parquet-1)
-        
-        # Initial parquet setup
-        if imode == 1:
-            x1, y1 = -middle_x - 2 * img_width + x_off, -middle_y + y_off   
-        elif imode == -1: 
-            x1, y1 = -middle_x + x_off, -middle_y - 2 * img_width + y_off   
-        else:
-            x1, y1 = middle_x*2 + x_off, -middle_y*2 + y_off   
-        
-        first_parquet = {
-            "average_color": (0, 0, 0),
-            "on_the_edge": 0,            
-            "priority": 0,
-            "top_left_color": (0, 0, 0),
-            "top_right_color": (0, 0, 0),
-            "bottom_left_color": (0, 0, 0),
-            "bottom_right_color": (0, 0, 0)
-        }
-        
-        # Orientation-specific coordinate setup
-        if imode != -1:
-            first_parquet["coordinates"] = [
-                (x1, y1),
-                (x1 + width_parquet, y1),
-                (x1 + width_parquet, y1 + height_parquet),
-                (x1, y1 + height_parquet)                
-            ]
-            first_parquet["orientation"] = "landscape"
-        else:
-            first_parquet["coordinates"] = [
-                (x1, y1),
-                (x1 + height_parquet, y1),
-                (x1 + height_parquet, y1 + width_parquet),
-                (x1, y1 + width_parquet)                
-            ]
-            first_parquet["orientation"] = "portrait"
-        
-        parquets.append(first_parquet)
-        unit_row = [first_parquet]
-        itwist = 1
-        
-        # Generate parquet grid
-        for col in range(1, 4 * (img_width // width_parquet)):
-            last = unit_row[-1]["coordinates"]
-            new_parquet = {
-                "average_color": (0, 0, 0),
-                "on_the_edge": 0,   
-                "priority": 0,
-                "top_left_color": (0, 0, 0),
-                "top_right_color": (0, 0, 0),
-                "bottom_left_color": (0, 0, 0),
-                "bottom_right_color": (0, 0, 0)
-            }
-            
-            if imode == 1:
-                new_parquet["coordinates"] = [
-                    (last[0][0] + width_parquet, last[0][1]),
-                    (last[1][0] + width_parquet, last[1][1]),
-                    (last[2][0] + width_parquet, last[2][1]),
-                    (last[3][0] + width_parquet, last[3][1])
-                ]
-                new_parquet["orientation"] = "landscape"
-            elif imode == -1:
-                new_parquet["coordinates"] = [
-                    (last[0][0], last[0][1] + width_parquet),
-                    (last[1][0], last[1][1] + width_parquet),
-                    (last[2][0], last[2][1] + width_parquet),
-                    (last[3][0], last[3][1] + width_parquet)
-                ]
-                new_parquet["orientation"] = "portrait"
-            else:
-                if random.random() > ratio:
-                    itwist += 1               
-                if itwist % 2 == 0:
-                    new_parquet["coordinates"] = [
-                        (last[2][0] + 0, last[2][1] - height_parquet),
-                        (last[2][0] + width_parquet, last[2][1] - height_parquet),
-                        (last[2][0] + width_parquet, last[2][1] + 0),
-                        (last[2][0] + 0, last[2][1] + 0)
-                    ]
-                    new_parquet["orientation"] = "landscape"
-                else:
-                    new_parquet["coordinates"] = [
-                        (last[2][0] - height_parquet, last[2][1] + 0),
-                        (last[2][0] + 0, last[2][1] + 0),
-                        (last[2][0] + 0, last[2][1] + width_parquet),
-                        (last[2][0] - height_parquet, last[2][1] + width_parquet)
-                    ]
-                    new_parquet["orientation"] = "portrait"
-                itwist += 1
-            parquets.append(new_parquet)
-            unit_row.append(new_parquet)
-        
-        current_row = unit_row.copy()
-        for row in range(1, 4 * (img_height // height_parquet)):
-            if random.random() > ratio:
-              row_shift = 0               
-            else: row_shift = random.randint(4*width_parquet//10, 7*width_parquet//10)
-            
-            new_row = []
-            for p in current_row:
-                coords = p["coordinates"]
-                if imode == 1:
-                    new_parquet = {
-                        "coordinates": [
-                            (coords[0][0] + row_shift, coords[0][1] + height_parquet),
-                            (coords[1][0] + row_shift, coords[1][1] + height_parquet),
-                            (coords[2][0] + row_shift, coords[2][1] + height_parquet),
-                            (coords[3][0] + row_shift, coords[3][1] + height_parquet)
-                        ],
-                        "average_color": (0, 0, 0),
-                        "on_the_edge": 1,
-                        "orientation": "landscape",
-                        "priority": 0,
-                        "top_left_color": (0, 0, 0),
-                        "top_right_color": (0, 0, 0),
-                        "bottom_left_color": (0, 0, 0),
-                        "bottom_right_color": (0, 0, 0)
-                    }
-                elif imode == -1:
-                    new_parquet = {
-                        "coordinates": [
-                            (coords[0][0] + height_parquet, coords[0][1] + row_shift),
-                            (coords[1][0] + height_parquet, coords[1][1] + row_shift),
-                            (coords[2][0] + height_parquet, coords[2][1] + row_shift),
-                            (coords[3][0] + height_parquet, coords[3][1] + row_shift)
-                        ],
-                        "average_color": (0, 0, 0),
-                        "on_the_edge": 1,
-                        "orientation": "portrait",
-                        "priority": 0,
-                        "top_left_color": (0, 0, 0),
-                        "top_right_color": (0, 0, 0),
-                        "bottom_left_color": (0, 0, 0),
-                        "bottom_right_color": (0, 0, 0)
-                    }
-                else: 
-                    new_parquet = {
-                        "coordinates": [
-                            (coords[0][0] - height_parquet, coords[0][1] + height_parquet),
-                            (coords[1][0] - height_parquet, coords[1][1] + height_parquet),
-                            (coords[2][0] - height_parquet, coords[2][1] + height_parquet),
-                            (coords[3][0] - height_parquet, coords[3][1] + height_parquet)
-                        ],
-                        "average_color": (0, 0, 0),
-                        "on_the_edge": 1,
-                        "orientation": p["orientation"],
-                        "priority": 0,
-                        "top_left_color": (0, 0, 0),
-                        "top_right_color": (0, 0, 0),
-                        "bottom_left_color": (0, 0, 0),
-                        "bottom_right_color": (0, 0, 0)
-                    }
-                parquets.append(new_parquet)
-                new_row.append(new_parquet)
-            current_row = new_row
-        
-        # Crop and filter parquets
-        filtered = []
-        p_priority = 0     ###
-        for p in tqdm(parquets, "Cropping the parquets on the edge"):
-            (x1, y1), (x2, y2), (x3, y3), (x4, y4) = p["coordinates"]
-            inside = sum([
-                0 <= x < img_width and 0 <= y < img_height
-                for x, y in [(x1, y1), (x2, y2), (x3, y3), (x4, y4)]
-            ])
-            on_the_edge = 0 if inside > 3 else 1
 
-            p_priority = pow(2, 13)
+        x1, y1, x3, y3, landscape = parquet_lattice(imode, ratio, img_width, img_height, width_parquet, height_parquet)
+        total = len(x1)
 
-            if img_width/3 < x1 < 2*img_width/3 and img_height/3 < y1 < 2*img_height/3: p_priority = pow(2, 14) 
-            if img_width/3 < x3 < 2*img_width/3 and img_height/3 < y3 < 2*img_height/3: p_priority = pow(2, 14)
-            
-            if x1<= img_width/3 <=x3: p_priority = pow(2, 15)           
-            if x1<= 2*img_width/3 <=x3: p_priority = pow(2, 15)
-            if y1<= img_height/3 <=y3: p_priority = pow(2, 15)
-            if y1<= 2*img_height/3 <=y3: p_priority = pow(2, 15)
+        # Keep the parquets with a corner on the motif and something left to crop, before building any dict
+        inside = sum(((0 <= x) & (x < img_width) & (0 <= y) & (y < img_height)).astype(np.int64)
+                     for x, y in [(x1, y1), (x3, y1), (x3, y3), (x1, y3)])
+        keep = (inside > 0) & (np.minimum(x3, img_width) > np.maximum(x1, 0)) & \
+               (np.minimum(y3, img_height) > np.maximum(y1, 0))
+        x1, y1, x3, y3, landscape, inside = (a[keep] for a in (x1, y1, x3, y3, landscape, inside))
+        priority = lattice_priorities(x1, y1, x3, y3, inside, img_width, img_height)
 
-#            if x1<= img_width/3 <=x3 and y1<= img_height/3 <=y3: p_priority = pow(2, 16)
-#            if x1<= 2*img_width/3 <=x3 and y1<= img_height/3 <=y3: p_priority = pow(2, 16)
-#            if x1<= img_width/3 <=x3 and y1<= 2*img_height/3 <=y3: p_priority = pow(2, 16)    
-#            if x1<= 2*img_width/3 <=x3 and y1<= 2*img_height/3 <=y3: p_priority = pow(2, 16)
-                
-            if inside > 0:
-                if on_the_edge == 1: p_priority = 0         ###assign parquet on the edge priority to lowest 
-                
-                crop_x1 = max(x1, 0)
-                crop_y1 = max(y1, 0)
-                crop_x2 = min(x3, img_width)
-                crop_y2 = min(y3, img_height)
-                cropped = img.crop((crop_x1, crop_y1, crop_x2, crop_y2))
-                avg_color = calculate_average_color(cropped)
-                width, height = cropped.size
-                if width == 0 or height == 0:
-                    continue
+        boxes = np.stack([np.maximum(x1, 0), np.maximum(y1, 0),
+                          np.minimum(x3, img_width), np.minimum(y3, img_height)], axis=1)
+        filtered = parquet_array(len(x1))
+        filtered['coordinates'] = np.stack([x1, y1, x3, y1, x3, y3, x1, y3], axis=1).reshape(-1, 4, 2)
+        filtered['on_the_edge'] = inside < 4
+        filtered['landscape'] = landscape
+        filtered['priority'] = priority
 
-            
-                
-                tl = cropped.crop((0, 0, width//2, height//2))
-                avg_tl = average_colour_n_fallback(tl)
-                tr = cropped.crop((width//2, 0, width, height//2))
-                avg_tr = average_colour_n_fallback(tr)
-                bl = cropped.crop((0, height//2, width//2, height))
-                avg_bl = average_colour_n_fallback(bl)
-                br = cropped.crop((width//2, height//2, width, height))
-                avg_br = average_colour_n_fallback(br)
-                filtered.append({
-                    "coordinates": [
-                        (x1, y1), (x2, y2), (x3, y3), (x4, y4)  # experimental
-                    ],
-                    "average_color": avg_color,
-                    "on_the_edge": on_the_edge,
-                    "orientation": p["orientation"],
-                    "priority": p_priority,                   
-                    "top_left_color": avg_tl,
-                    "top_right_color": avg_tr,
-                    "bottom_left_color": avg_bl,
-                    "bottom_right_color": avg_br
-                })
+        # Average and quadrant colours of every parquet from the motif's summed-area tables
+        load_motif_stats(image_path).fill_parquet_colours(filtered, boxes)
         
         # Save CSV  
         current_time = datetime.now().strftime("@%H:%M:%S @%Y-%m-%d ")
         # In analyze_target, after filtering
-        print(f"Filtered {len(filtered)} parquets out of {len(parquets)} total")
+        print(f"Filtered {len(filtered)} parquets out of {total} total")
         print(f"Parquet index file of {len(filtered)} saving...{current_time}")
         
         # Call the new function to save the CSV from utils_csv_io.py
@@ -275,6 +154,7 @@ def analyze_target(imode, ratio, image_path, width_parquet, height_parquet, csv_
         print(f"Error: {str(e)}")
         return False, None, None
 
+@cached_stage(3)
 def main():
     setup_logging(CONFIG["log_file"])
     
@@ -306,7 +186,8 @@ def main():
             CONFIG["image_path"], 
             width_parquet, 
             height_parquet, 
-            CONFIG["parquets_csv_path"]
+            CONFIG["parquets_csv_path"],
+            seed=CONFIG.get("random_seed")
         )
 
         
@@ -318,14 +199,13 @@ def main():
         # visualization and saving to jpg file
         #save_visualization(CONFIG["image_path"], parquets, masking_jpg_path)
         try:
-            if not parquets:  # Check if parquets is empty or None
+            if parquets is None or len(parquets) == 0:  # Check if parquets is empty or None
                 log_message("No parquets to visualize. Saving placeholder image.")
                 Image.new('RGB', (100, 100), color='gray').save(masking_jpg_path)
             else:
-                img = Image.open(CONFIG["image_path"]).convert("RGB")
+                img = load_motif_stats(CONFIG["image_path"]).image()
                 draw = ImageDraw.Draw(img)
-                for p in parquets:
-                    (x1, y1), (x2, y2), (x3, y3), (x4, y4) = p["coordinates"]
+                for (x1, y1), (x2, y2), (x3, y3), (x4, y4) in parquets["coordinates"].tolist():
                     draw.rectangle([x1, y1, x3, y3], outline="blue", width=2)
                 img.save(masking_jpg_path, 'JPEG', quality=50)
                 log_message(f"Visualization saved to: {masking_jpg_path}")
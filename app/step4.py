@@ -6,89 +6,84 @@ import matplotlib.pyplot as plt
 from PIL import Image, ImageDraw
 import csv
 from datetime import datetime
-import math
 import random
+import numpy as np
 from tqdm import tqdm
 
 #common helper functions for this project, utils.py saved in the same folder
 from utils import *
 from utils_csv_io import *
+from utils_motif_stats import load_motif_stats
 from config import CONFIG
+from stage_cache import cached_stage
 
 def snap_to_grid(value, grid_size=1):
     """Snap a value to the nearest grid point."""
     return round(value / grid_size) * grid_size
 
-def meets_min_dimensions(width, height, orientation):
+def min_dimensions_mask(widths, heights, landscape):
+    """Whether each parquet is at least 4 parquet units wide by 2/3 of that high (turned for
+    portrait), over arrays of widths, heights and orientations (True for landscape)."""
     MIN_WIDTH_LANDSCAPE = 4*CONFIG["parquet_unit_width"]   #says 24
     MIN_HEIGHT_LANDSCAPE = 2*(MIN_WIDTH_LANDSCAPE//3)      #says 16
-    MIN_WIDTH_PORTRAIT = MIN_HEIGHT_LANDSCAPE
-    MIN_HEIGHT_PORTRAIT = MIN_WIDTH_LANDSCAPE
-    if orientation == "landscape":
-        return width >= MIN_WIDTH_LANDSCAPE and height >= MIN_HEIGHT_LANDSCAPE
-    elif orientation == "portrait":
-        return width >= MIN_WIDTH_PORTRAIT and height >= MIN_HEIGHT_PORTRAIT
-    return False  # or True, depending on what makes sense for your context
+    return np.where(landscape,
+                    (widths >= MIN_WIDTH_LANDSCAPE) & (heights >= MIN_HEIGHT_LANDSCAPE),
+                    (widths >= MIN_HEIGHT_LANDSCAPE) & (heights >= MIN_WIDTH_LANDSCAPE))
 
 
 def parquet_split(parquets, main_image_path, ithres):
     try:
         main_img = Image.open(main_image_path)
         img_width, img_height = main_img.size
-        updated_parquets = []
+        motif_stats = load_motif_stats(main_image_path)
+        if not isinstance(parquets, np.ndarray):
+            parquets = parquets_to_array(parquets)
+
+        # Which parquets to split, as array masks
+        corners = parquets['coordinates']
+        widths = corners[:, 1, 0] - corners[:, 0, 0]
+        heights = corners[:, 2, 1] - corners[:, 0, 1]
+
+        #check if its dimension great than the minimum says 12x8 (or 8x12 portrait) if not skip splitting
+        big_enough = min_dimensions_mask(widths, heights, parquets['landscape'])
+        min_sized_parquet_count = int(np.count_nonzero(~big_enough))
+
+        # Aspect ratio 3:2 or 2:3, within a relative tolerance (as math.isclose)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            aspect_ratio = widths / heights
+        tolerance = 1e-2
+        ratio_ok = np.zeros(len(parquets), dtype=bool)
+        for target in (3/2, 2/3):
+            ratio_ok |= np.abs(aspect_ratio - target) <= tolerance * np.maximum(np.abs(aspect_ratio), target)
+
+        # Color variation between the four quadrants
+        quadrants = [parquets[name].astype(np.int64) for name in
+                     ("top_left_color", "top_right_color", "bottom_left_color", "bottom_right_color")]
+        max_distance = np.zeros(len(parquets), dtype=np.int64)
+        for a in range(4):
+            for b in range(a + 1, 4):
+                max_distance = np.maximum(max_distance, ((quadrants[a] - quadrants[b]) ** 2).sum(axis=1))
+        threshold = 3 * (ithres**2)
+        to_split = big_enough & ratio_ok & (max_distance > threshold)
+
+        coordinates = corners.tolist()
+        landscape = parquets['landscape'].tolist()
+        priorities = parquets['priority'].tolist()
+        sub_coords, sub_edge, sub_landscape, sub_priority, sub_boxes = [], [], [], [], []
+        sub_rows = {}       # parquet position -> positions of its sub-parquets
         split_count = 0
-        min_sized_parquet_count = 0
-        for parquet in tqdm(parquets, desc="Splitting parquets"):
+        for position in tqdm(np.flatnonzero(to_split).tolist(), desc="Splitting parquets"):
 
             # Split logic with edge handling
-            (x1, y1), (x2, y2), (x3, y3), (x4, y4) = parquet["coordinates"]
+            (x1, y1), (x2, y2), (x3, y3), (x4, y4) = coordinates[position]
             original_width = x2 - x1
             original_height = y3 - y1
-            
-            #check if its dimension great than the minimum says 12x8 (or 8x12 portrait) if not skip splitting
-            if not meets_min_dimensions(original_width, original_height, parquet["orientation"]):
-                updated_parquets.append(parquet)
-                min_sized_parquet_count +=1
-                continue
-
-            # **New Aspect Ratio Check**     
-            #aspect_ratio = original_width / original_height    #it is a float?????
-            #if aspect_ratio not in [1.5, 2/3]:  # 3:2 or 2:3   #better checking needed.... 
-            #    updated_parquets.append(parquet)
-            #    continue
-
-            aspect_ratio = original_width / original_height 
-            accepted_ratios = (3/2, 2/3)
-            tolerance = 1e-2                #relative tolerance
-            if not any(math.isclose(aspect_ratio, target, rel_tol=tolerance) for target in accepted_ratios):
-                updated_parquets.append(parquet)
-                continue
-
            
-            # Existing color variation check
-            tl = parquet["top_left_color"]
-            tr = parquet["top_right_color"]
-            bl = parquet["bottom_left_color"]
-            br = parquet["bottom_right_color"]
-            distances = [
-                sum((a - b)**2 for a, b in zip(tl, tr)),
-                sum((a - b)**2 for a, b in zip(tl, bl)),
-                sum((a - b)**2 for a, b in zip(tl, br)),
-                sum((a - b)**2 for a, b in zip(tr, bl)),
-                sum((a - b)**2 for a, b in zip(tr, br)),
-                sum((a - b)**2 for a, b in zip(bl, br))
-            ]
-            max_distance = max(distances)
-            threshold = 3 * (ithres**2)
-            if max_distance <= threshold:
-                updated_parquets.append(parquet)
-                continue
-            
             # Use floating-point arithmetic for splitting
             split_x = original_width / 2
             split_y = original_height / 2
 
-            sub_parquets = []
+            first_sub = len(sub_coords)
             for i in range(2):
                 for j in range(2):
                     # Original coordinates (unclamped)
@@ -121,23 +116,10 @@ def parquet_split(parquets, main_image_path, ithres):
                     if crop_x1 >= crop_x2 or crop_y1 >= crop_y2:
                         continue
 
-                    # Calculate colors using clamped coordinates
-                    cropped = main_img.crop((crop_x1, crop_y1, crop_x2, crop_y2))
-                    avg_color = average_colour_n_fallback(cropped)
-                    width, height = cropped.size
-                    if width == 0 or height == 0:
+                    # Colors are calculated from the clamped coordinates after the loop, in one batch
+                    if round(crop_x2) - round(crop_x1) <= 0 or round(crop_y2) - round(crop_y1) <= 0:
                         continue
 
-                    # Quadrant colors
-                    tl_q = cropped.crop((0, 0, width // 2, height // 2))
-                    avg_tl = average_colour_n_fallback(tl_q)
-                    tr_q = cropped.crop((width // 2, 0, width, height // 2))
-                    avg_tr = average_colour_n_fallback(tr_q)
-                    bl_q = cropped.crop((0, height // 2, width // 2, height))
-                    avg_bl = average_colour_n_fallback(bl_q)
-                    br_q = cropped.crop((width // 2, height // 2, width, height))
-                    avg_br = average_colour_n_fallback(br_q)
-
                     # Determine on_the_edge status
                     inside_corners = sum(
                         0 <= x < img_width and 0 <= y < img_height
@@ -146,28 +128,37 @@ def parquet_split(parquets, main_image_path, ithres):
                     )
                     on_the_edge_sub = 1 if inside_corners < 4 else 0
 
-                    sub_parquets.append({
-                        "coordinates": [
-                            (new_x1, new_y1),
-                            (new_x2, new_y1),
-                            (new_x2, new_y2),
-                            (new_x1, new_y2)
-                        ],
-                        "average_color": avg_color,
-                        "on_the_edge": on_the_edge_sub,
-                        "orientation": parquet["orientation"],
-                        "priority": parquet["priority"]//4,    #downgrade its priority for matching
-                        "top_left_color": avg_tl,
-                        "top_right_color": avg_tr,
-                        "bottom_left_color": avg_bl,
-                        "bottom_right_color": avg_br
-                    })
-
-            if sub_parquets:
-                updated_parquets.extend(sub_parquets)
+                    sub_coords.append([
+                        (new_x1, new_y1),
+                        (new_x2, new_y1),
+                        (new_x2, new_y2),
+                        (new_x1, new_y2)
+                    ])
+                    sub_edge.append(on_the_edge_sub)
+                    sub_landscape.append(landscape[position])
+                    sub_priority.append(priorities[position]//4)    #downgrade its priority for matching
+                    sub_boxes.append((crop_x1, crop_y1, crop_x2, crop_y2))
+
+            if len(sub_coords) > first_sub:
+                sub_rows[position] = range(first_sub, len(sub_coords))
                 split_count += 1
+
+        sub_parquets = parquet_array(len(sub_coords))
+        if sub_coords:
+            sub_parquets['coordinates'] = sub_coords
+            sub_parquets['on_the_edge'] = sub_edge
+            sub_parquets['landscape'] = sub_landscape
+            sub_parquets['priority'] = sub_priority
+            motif_stats.fill_parquet_colours(sub_parquets, sub_boxes)
+
+        # Each split parquet is replaced by its sub-parquets, in place
+        order = []
+        for position in range(len(parquets)):
+            if position in sub_rows:
+                order.extend(len(parquets) + row for row in sub_rows[position])
             else:
-                updated_parquets.append(parquet)
+                order.append(position)
+        updated_parquets = np.concatenate([parquets, sub_parquets])[order]
 
         main_img.close()
         print(f"Split {split_count} parquets into four-quarters ")
@@ -181,6 +172,7 @@ def parquet_split(parquets, main_image_path, ithres):
 
 
 
+@cached_stage(4)
 def main():
     setup_logging(CONFIG["log_file"])
  
@@ -198,7 +190,7 @@ def main():
     
     try:
         # Read input parquets from CSV (now as floats) now moved to utils_csv_io.py
-        parquets = read_parquets_csv(CONFIG["parquets_csv_path"])
+        parquets = read_parquet_array(CONFIG["parquets_csv_path"])
         
         # Perform parquet splitting
         filtered = parquet_split(parquets, CONFIG["image_path"], CONFIG["split_diff"])
@@ -212,10 +204,9 @@ def main():
 
         # Create visualization
         try:
-            img = Image.open(CONFIG["image_path"]).convert("RGB")
+            img = load_motif_stats(CONFIG["image_path"]).image()
             draw = ImageDraw.Draw(img)
-            for p in filtered:
-                (x1, y1), (x2, y2), (x3, y3), (x4, y4) = p["coordinates"]
+            for (x1, y1), (x2, y2), (x3, y3), (x4, y4) in filtered["coordinates"].tolist():
                 draw.rectangle([x1, y1, x3, y3], outline="red", width=2)
             img.save(masking_jpg_path, 'JPEG', quality=30)
             log_message(f"Masking visualization saved to: {masking_jpg_path}")
@@ -1,7 +1,9 @@
 #Step5 merge parquets
 from PIL import Image, ImageDraw
 import csv
+import math
 import os
+import numpy as np
 import shutil
 os.environ["NUMEXPR_MAX_THREADS"] = "16"
 import matplotlib.pyplot as plt
@@ -11,12 +13,15 @@ from datetime import datetime
 #common helper functions for this project, utils.py saved in the same folder
 from utils import *
 from utils_csv_io import *
+from utils_motif_stats import load_motif_stats
 
 from config import CONFIG
+from stage_cache import cached_stage
 
-def get_merged_coords(p1, p2):
-    (p1_x1, p1_y1), (p1_x2, p1_y1_), (p1_x2_, p1_y2), (p1_x1_, p1_y2_) = p1["coordinates"]
-    (p2_x1, p2_y1), (p2_x2, p2_y1_), (p2_x2_, p2_y2), (p2_x1_, p2_y2_) = p2["coordinates"]
+def get_merged_coords(c1, c2):
+    """Corners and orientation of the parquet merging the parquets with corners c1 and c2, or (None, None)."""
+    (p1_x1, p1_y1), (p1_x2, p1_y1_), (p1_x2_, p1_y2), (p1_x1_, p1_y2_) = c1
+    (p2_x1, p2_y1), (p2_x2, p2_y1_), (p2_x2_, p2_y2), (p2_x1_, p2_y2_) = c2
     
     # Horizontal merge check
     if abs(p1_y1 - p2_y1) < 1e-6 and abs(p1_y2 - p2_y2) < 1e-6:
@@ -77,6 +82,47 @@ def snap_to_grid(value, grid_size=1):
     return round(value / grid_size) * grid_size
 
 
+def _edge_keys(*values, tolerance=1e-6):
+    """Keys of every unit cell a value within the tolerance of the given ones can fall in."""
+    keys = [()]
+    for value in values:
+        cells = {math.floor(value - tolerance), math.floor(value + tolerance)}
+        keys = [key + (cell,) for key in keys for cell in cells]
+    return keys
+
+
+def build_edge_index(coordinates):
+    """
+    Index the parquets (given by their corners) by their edges, snapped to unit cells: left and right edges keyed by
+    (y1, y2, x), top and bottom edges keyed by (x1, x2, y). Two parquets can only be merged
+    by get_merged_coords when one's edge meets the other's opposite edge over its full length.
+    """
+    index = {side: {} for side in ("left", "right", "top", "bottom")}
+    for position, corners in enumerate(coordinates):
+        (x1, y1), (x2, _), (_, y2), _ = corners
+        index["left"].setdefault((math.floor(y1), math.floor(y2), math.floor(x1)), []).append(position)
+        index["right"].setdefault((math.floor(y1), math.floor(y2), math.floor(x2)), []).append(position)
+        index["top"].setdefault((math.floor(x1), math.floor(x2), math.floor(y1)), []).append(position)
+        index["bottom"].setdefault((math.floor(x1), math.floor(x2), math.floor(y2)), []).append(position)
+    return index
+
+
+def edge_neighbours(index, corners):
+    """Positions of the parquets sharing a full edge with the parquet (a superset, checked by get_merged_coords)."""
+    (x1, y1), (x2, _), (_, y2), _ = corners
+    lookups = [
+        ("left", (y1, y2, x2)),     # parquets to the right
+        ("right", (y1, y2, x1)),    # parquets to the left
+        ("top", (x1, x2, y2)),      # parquets below
+        ("bottom", (x1, x2, y1)),   # parquets above
+    ]
+    neighbours = set()
+    for side, values in lookups:
+        for key in _edge_keys(*values):
+            neighbours.update(index[side].get(key, ()))
+    return neighbours
+
+
 def meets_max_dimensions(width, height, orientation):
     #######conditions to skip merging a pair of parquets 
     MAX_WIDTH_LANDSCAPE = CONFIG["parquet_unit_width"] * CONFIG["parquet_size_factor"] 
@@ -93,22 +139,31 @@ def meets_max_dimensions(width, height, orientation):
 def parquet_merge(parquets, main_image_path, ithreshold):
     main_img = Image.open(main_image_path)
     img_width, img_height = main_img.size
-    merged_parquets = []
+    motif_stats = load_motif_stats(main_image_path)
+    if not isinstance(parquets, np.ndarray):
+        parquets = parquets_to_array(parquets)
+    coordinates = parquets['coordinates'].tolist()
+    colours = parquets['average_color'].tolist()
+    priorities = parquets['priority'].tolist()
+    merged_coords_list, merged_edge, merged_landscape, merged_priority = [], [], [], []
+    merged_boxes = []
     processed = set()
     merge_count = 0
     max_sized_parquet_count = 0
+    edge_index = build_edge_index(coordinates)
     
     for i in tqdm(range(len(parquets)), desc="Merging parquets"):
         if i in processed:
             continue
 
-        p1 = parquets[i]
-        for j in range(i + 1, len(parquets)):
-            if j in processed:
+        c1 = coordinates[i]
+        # Only parquets sharing an edge can merge; taking them in index order keeps the greedy first match
+        for j in sorted(edge_neighbours(edge_index, c1)):
+            if j <= i or j in processed:
                 continue
 
-            p2 = parquets[j]
-            merged_coords, orientation = get_merged_coords(p1, p2)
+            c2 = coordinates[j]
+            merged_coords, orientation = get_merged_coords(c1, c2)
             if not merged_coords:
                 continue
          
@@ -134,10 +189,8 @@ def parquet_merge(parquets, main_image_path, ithreshold):
                 continue
 
             # Validate area conservation
-            p1_area = (p1["coordinates"][1][0] - p1["coordinates"][0][0]) * \
-                      (p1["coordinates"][2][1] - p1["coordinates"][0][1])
-            p2_area = (p2["coordinates"][1][0] - p2["coordinates"][0][0]) * \
-                      (p2["coordinates"][2][1] - p2["coordinates"][0][1])
+            p1_area = (c1[1][0] - c1[0][0]) * (c1[2][1] - c1[0][1])
+            p2_area = (c2[1][0] - c2[0][0]) * (c2[2][1] - c2[0][1])
             merged_area = (snapped_coords[1][0] - snapped_coords[0][0]) * \
                           (snapped_coords[2][1] - snapped_coords[0][1])  # Use snapped_coords here
 
@@ -145,16 +198,15 @@ def parquet_merge(parquets, main_image_path, ithreshold):
                 continue
 
             # Color distance check
-            color_dist = sum((a - b)**2 for a, b in zip(p1["average_color"], p2["average_color"]))
+            color_dist = sum((a - b)**2 for a, b in zip(colours[i], colours[j]))
             if color_dist > 3 * (ithreshold ** 2):
                 continue
 
-            # Crop and calculate colors
-            cropped = main_img.crop((crop_x1, crop_y1, crop_x2, crop_y2))
-            avg_color = average_colour_n_fallback(cropped)
-            width_c, height_c = cropped.size
+            # Size of the crop, as Pillow rounds the box
+            width_c = round(crop_x2) - round(crop_x1)
+            height_c = round(crop_y2) - round(crop_y1)
          
-            if width_c == 0 or height_c == 0:
+            if width_c <= 0 or height_c <= 0:
                 continue
 
             #check if its dimension great than the minimum says 12x8 (or 8x12 portrait) if not skip splitting
@@ -163,34 +215,29 @@ def parquet_merge(parquets, main_image_path, ithreshold):
                 max_sized_parquet_count += 1
                 continue
             
-            # Quadrant colors
-            tl = cropped.crop((0, 0, width_c // 2, height_c // 2))
-            tr = cropped.crop((width_c // 2, 0, width_c, height_c // 2))
-            bl = cropped.crop((0, height_c // 2, width_c // 2, height_c))
-            br = cropped.crop((width_c // 2, height_c // 2, width_c, height_c))
-
-            merged_parquet = {
-                "coordinates": snapped_coords,  # Use snapped_coords here
-                "average_color": avg_color,
-                "on_the_edge": on_the_edge_merged,
-                "orientation": orientation,
-                "priority": max(p1["priority"], p2["priority"])*2,
-                "top_left_color": average_colour_n_fallback(tl),
-                "top_right_color": average_colour_n_fallback(tr),
-                "bottom_left_color": average_colour_n_fallback(bl),
-                "bottom_right_color": average_colour_n_fallback(br)
-            }
+            # Average and quadrant colors are filled in after the loop from the motif's summed-area tables
+            merged_coords_list.append(snapped_coords)
+            merged_edge.append(on_the_edge_merged)
+            merged_landscape.append(orientation == "landscape")
+            merged_priority.append(max(priorities[i], priorities[j])*2)
+            merged_boxes.append((crop_x1, crop_y1, crop_x2, crop_y2))
 
             processed.add(i)
             processed.add(j)
-            merged_parquets.append(merged_parquet)
             merge_count += 1
             break
 
+    merged_parquets = parquet_array(len(merged_coords_list))
+    if merged_coords_list:
+        merged_parquets['coordinates'] = merged_coords_list
+        merged_parquets['on_the_edge'] = merged_edge
+        merged_parquets['landscape'] = merged_landscape
+        merged_parquets['priority'] = merged_priority
+        motif_stats.fill_parquet_colours(merged_parquets, merged_boxes)
+
     # Add unprocessed parquets
-    for i in range(len(parquets)):
-        if i not in processed:
-            merged_parquets.append(parquets[i])
+    unprocessed = [i for i in range(len(parquets)) if i not in processed]
+    merged_parquets = np.concatenate([merged_parquets, parquets[unprocessed]])
 
     main_img.close()
     print(f"Merged {merge_count} pairs of parquets")
@@ -203,6 +250,7 @@ def snap_to_grid(value, grid_size=1):
     return round(value / grid_size) * grid_size
 
 
+@cached_stage(5)
 def main():
     setup_logging(CONFIG["log_file"])
     
@@ -219,7 +267,7 @@ def main():
 
     
     try:
-        parquets = read_parquets_csv(CONFIG["parquets_csv_path"])
+        parquets = read_parquet_array(CONFIG["parquets_csv_path"])
         merged = parquet_merge(parquets, CONFIG["image_path"], CONFIG["merge_diff"])
         
         current_time = datetime.now().strftime("@%H:%M:%S @%Y-%m-%d ")
@@ -232,10 +280,9 @@ def main():
                 
         # Create visualization
         try:
-            img = Image.open(CONFIG["image_path"]).convert("RGB")
+            img = load_motif_stats(CONFIG["image_path"]).image()
             draw = ImageDraw.Draw(img)
-            for p in merged:
-                (x1, y1), (x2, y2), (x3, y3), (x4, y4) = p["coordinates"]
+            for (x1, y1), (x2, y2), (x3, y3), (x4, y4) in merged["coordinates"].tolist():
                 draw.rectangle([x1, y1, x3, y3], outline="green", width=2)
             img.save(masking_jpg_path, 'JPEG', quality=30)
             print(f"Masking visualization saved to: {masking_jpg_path}")
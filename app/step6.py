@@ -8,11 +8,14 @@ import matplotlib.pyplot as plt
 from PIL import Image, ImageDraw
 from tqdm import tqdm
 from datetime import datetime
+import numpy as np
 
 #common helper functions for this project, utils.py saved in the same folder
 from utils import *
 from utils_csv_io import *
+from utils_matching import TesseraColourIndex, nearest_candidates, capacitated_assignment
 from config import CONFIG
+from stage_cache import cached_stage
 
 
 def calculate_color_distance(color1, color2):
@@ -87,30 +90,186 @@ def calculate_brightness(rgb):
         raise ValueError(f"Unexpected type for 'average_color': {type(rgb)}")
 
 
-def prepare_mosaic_prioritized_sorted_filtered(parquets, tesserae_index_path, candidates_output_path, scale_up):
+def assign_priority_tesserae_vectorized(parquets, tesserae, priority_groups, sorted_priorities, used_parquets, candidates,
+                                        threshold_percentage, prioritized_by_chance):
+    """
+    Part 1 of prepare_mosaic_prioritized_sorted_filtered with the parquets held in arrays
+    (colours, priorities, aspect ratios and an availability mask): each tessera's distances,
+    dynamic threshold and candidate filtering are array operations. Picks the same parquets,
+    and draws the same random numbers, as the per-parquet loop.
+    tesserae is the structured index array and priority_groups maps each priority to its
+    positions in it; only the tesserae that get a parquet are turned into dictionaries.
+    """
+    if not parquets:
+        return
+    tessera_colours = tesserae['average_color']
+    tessera_cropable = tesserae['cropable']
+    record = tessera_records(tesserae)
+    colours = np.array([parquet["average_color"] for parquet in parquets], dtype=np.float64)
+    priorities = np.array([parquet.get("priority", 0) for parquet in parquets], dtype=np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        aspects = np.array([parquet['width'] for parquet in parquets], dtype=np.float64) / \
+                  np.array([parquet['height'] for parquet in parquets], dtype=np.float64)
+    aspect_ok = (np.abs(aspects - 1.5) < 0.01) | (np.abs(aspects - 2/3) < 0.01)
+    eligible = priorities >= pow(2, 10)
+
+    # Parquets are used up by coordinates, so parquets sharing coordinates go together
+    same_coords = {}
+    for i, parquet in enumerate(parquets):
+        same_coords.setdefault(str(parquet["coordinates"]), []).append(i)
+    available = np.ones(len(parquets), dtype=bool)
+    for coords_str in used_parquets:
+        available[same_coords.get(coords_str, [])] = False
+    order = np.arange(len(parquets))
+
+    for priority in sorted_priorities:
+        group = priority_groups[priority]
+        # by average colour, descending, equal colours keeping index order (as sorted(..., reverse=True))
+        group_colours = tessera_colours[group]
+        group_sorted = group[np.lexsort((-group_colours[:, 2], -group_colours[:, 1], -group_colours[:, 0]))]
+        for position in tqdm(group_sorted.tolist(), desc=f"Priority {priority} tesserae"):
+            valid = available if tessera_cropable[position] != 0 else available & aspect_ok
+            valid_idx = np.flatnonzero(valid)
+            if valid_idx.size == 0:
+                continue  # Skip if no valid candidates
+
+            distances = ((colours[valid_idx] - tessera_colours[position]) ** 2).sum(axis=1)
+            min_d = float(distances.min())
+            max_d = float(distances.max())
+            dynamic_threshold = (max_d - min_d) * (threshold_percentage / 100) + min_d
+
+            within = (distances <= dynamic_threshold) & eligible[valid_idx]
+            if not within.any():
+                continue  # No candidates within threshold
+            candidate_idx = valid_idx[within]
+            candidate_d = distances[within]
+            candidate_prio = priorities[candidate_idx]
+
+            random_number = random.randint(0, 100)
+            if random_number < prioritized_by_chance:
+                # priority (descending), distance (ascending), then parquet order
+                best = np.lexsort((order[candidate_idx], candidate_d, -candidate_prio))[0]
+            else:
+                # distance (ascending), priority (descending), then parquet order
+                best = np.lexsort((order[candidate_idx], -candidate_prio, candidate_d))[0]
+
+            selected_parquet = parquets[candidate_idx[best]]
+            candidates.append(create_candidate_entry(
+                selected_parquet, record(position), float(candidate_d[best])
+            ))
+            coords_str = str(selected_parquet["coordinates"])
+            used_parquets.add(coords_str)
+            available[same_coords[coords_str]] = False
+
+
+def needs_cropable_tessera(parquet):
+    """Parquets whose aspect ratio is neither 3:2 nor 2:3 can only take a cropable tessera."""
+    aspect = parquet['width'] / parquet['height']
+    return not any(abs(aspect - valid) < 0.01 for valid in {1.5, 2/3})
+
+
+def match_priority_zero_greedy(parquets_sorted, priority_zero):
+    """
+    Give each parquet in turn the nearest of the least used priority 0 tesserae
+    (priority_zero being their rows of the structured index array).
+    Returns [(parquet, tessera, distance)].
+    """
+    # Spatial colour index: same least-used-then-nearest choice as find_best_tessera, sublinear per parquet;
+    # it works on the colour and cropable columns and counts the uses itself
+    if CONFIG.get("colour_index", True):
+        colour_index = TesseraColourIndex(priority_zero['average_color'], priority_zero['cropable'] == 1)
+        record = tessera_records(priority_zero)
+        matches = []
+        for parquet in tqdm(parquets_sorted, desc="Priority 0 allocated"):
+            position, distance = colour_index.find_best_tessera(parquet["average_color"], needs_cropable_tessera(parquet))
+            if position is not None:
+                colour_index.add_use(position)
+                matches.append((parquet, record(position), distance))
+        return matches
+
+    # Without the index every tessera is a dictionary carrying its 'usage_count'
+    tesserae = tesserae_index_array_to_dicts(priority_zero)
+    for tessera in tesserae:
+        tessera['usage_count'] = 0
+    
+    # Assign sorted remaining parquets using priority 0 tesserae with minimal reuse
+    matches = []
+    for parquet in tqdm(parquets_sorted, desc="Priority 0 allocated"):
+        # Filter tesserae based on parquet's aspect ratio
+        candidate_tesserae = tesserae
+        if needs_cropable_tessera(parquet):
+            candidate_tesserae = [t for t in tesserae if t['cropable'] == 1]
+        best_tessera, distance = find_best_tessera(parquet["average_color"], candidate_tesserae)
+        if best_tessera:
+            best_tessera['usage_count'] += 1
+            matches.append((parquet, best_tessera, distance))
+    return matches
+
+
+def match_priority_zero_assignment(parquets_sorted, priority_zero, reuse_cap=0, k=8, overflow_penalty=10000):
+    """
+    Assign the parquets to priority 0 tesserae as one min-cost problem: the total colour
+    distance is minimised with each tessera used at most reuse_cap times (0 = the fewest
+    uses that fit every parquet). Each parquet only considers its k nearest tesserae; one
+    that cannot be fitted under the cap takes its nearest tessera anyway, at a cost of
+    overflow_penalty in the solver. priority_zero holds the tesserae' rows of the structured
+    index array.
+    Returns ([(parquet, tessera, distance)], reuse_cap, number of parquets over the cap).
+    """
+    if not parquets_sorted or not len(priority_zero):
+        return [], reuse_cap, 0
+    cropable_only = [needs_cropable_tessera(parquet) for parquet in parquets_sorted]
+    cropable = (priority_zero['cropable'] == 1).tolist()
+    if not reuse_cap:
+        reuse_cap = math.ceil(len(parquets_sorted) / len(priority_zero))
+        if any(cropable_only) and any(cropable):
+            reuse_cap = max(reuse_cap, math.ceil(sum(cropable_only) / sum(cropable)))
+
+    log_message(f"Priority 0 assignment: {len(parquets_sorted)} parquets, {len(priority_zero)} tesserae, "
+                f"{k} candidates each, reuse cap {reuse_cap}")
+    candidates = nearest_candidates([parquet["average_color"] for parquet in parquets_sorted],
+                                    priority_zero['average_color'], k, cropable_only, cropable)
+    overflow_costs = [costs[0] + overflow_penalty if costs else math.inf for _, costs in candidates]
+    assigned = capacitated_assignment(candidates, [reuse_cap] * len(priority_zero), overflow_costs)
+
+    record = tessera_records(priority_zero)
+    matches = []
+    overflowed = 0
+    for parquet, position, (positions, costs) in zip(parquets_sorted, assigned, candidates):
+        if not positions:
+            continue
+        if position == -1:
+            # over the cap: fall back to the nearest tessera
+            position = positions[0]
+            overflowed += 1
+        tessera = record(position)
+        matches.append((parquet, tessera, calculate_color_distance(parquet["average_color"], tessera["average_color"])))
+    return matches, reuse_cap, overflowed
+
+
+def prepare_mosaic_prioritized_sorted_filtered(parquets, tesserae_index_path, candidates_output_path, scale_up, seed=None):
     """
     Create a mosaic by assigning tesserae to parquets in two phases with aspect ratio constraints:
     1. Assign non-zero priority tesserae considering cropability and aspect ratios
     2. Assign remaining parquets to priority 0 tesserae with minimal reuse and aspect constraints
+    With a seed, the prioritized-by-chance draws are reproducible.
     """
-    # Load tesserae and initialize usage tracking
-    tesserae = read_tesserae_index_file(tesserae_index_path)
-    if not tesserae:
+    if seed is not None:
+        random.seed(seed)
+
+    # Load tesserae: the structured index array, shared read-only, dictionaries made only for the tesserae used
+    tesserae = read_tesserae_index(tesserae_index_path)
+    if tesserae is None or not len(tesserae):
         print("Failed to load tesserae index.")
         return
     
-    # Separate tesserae into priority groups
-    priority_groups = {}
-    priority_zero = []
-    for tessera in tesserae:
-        prio = tessera['priority']
-        if prio == 0:
-            priority_zero.append(tessera)
-        else:
-            priority_groups.setdefault(prio, []).append(tessera)
+    # Separate tesserae into priority groups (positions in the index, in index order)
+    priorities = tesserae['priority']
+    priority_zero = tesserae[priorities == 0]
     
     # Sort non-zero priorities in ascending order (1, 2, ...)
-    sorted_priorities = sorted(priority_groups.keys())
+    sorted_priorities = sorted(set(priorities[priorities != 0].tolist()))
+    priority_groups = {prio: np.flatnonzero(priorities == prio) for prio in sorted_priorities}
 
 
     # Get main image dimensions
@@ -137,78 +296,82 @@ def prepare_mosaic_prioritized_sorted_filtered(parquets, tesserae_index_path, ca
     # Part 1: Assign tesserae by priority (1, 2, ...)
     threshold_percentage = CONFIG["threshold_percentage"]  # New parameter from config
 
-    for priority in sorted_priorities:
-        group = priority_groups[priority]
-        group_sorted = sorted(group, key=lambda t: t['average_color'], reverse=True)
-        for tessera in tqdm(group_sorted, desc=f"Priority {priority} tesserae"):
-            valid_aspects = {1.5, 2/3} if tessera['cropable'] == 0 else None
-            valid_parquets = []  # Collect all parquets meeting aspect constraints
-
-            for parquet in parquets:
-                coords_str = str(parquet["coordinates"])
-                if coords_str in used_parquets:
-                    continue
-
-                # Check aspect ratio constraints
-                if valid_aspects is not None:
-                    aspect = parquet['width'] / parquet['height']
-                    if not any(abs(aspect - va) < 0.01 for va in valid_aspects):
+    if CONFIG.get("vectorized_priority", True):
+        assign_priority_tesserae_vectorized(parquets, tesserae, priority_groups, sorted_priorities, used_parquets, candidates,
+                                            threshold_percentage, CONFIG["prioritized_by_chance"])
+    else:
+        for priority in sorted_priorities:
+            group = tesserae_index_array_to_dicts(tesserae[priority_groups[priority]])
+            group_sorted = sorted(group, key=lambda t: t['average_color'], reverse=True)
+            for tessera in tqdm(group_sorted, desc=f"Priority {priority} tesserae"):
+                valid_aspects = {1.5, 2/3} if tessera['cropable'] == 0 else None
+                valid_parquets = []  # Collect all parquets meeting aspect constraints
+
+                for parquet in parquets:
+                    coords_str = str(parquet["coordinates"])
+                    if coords_str in used_parquets:
                         continue
 
-                distance = calculate_color_distance(tessera["average_color"], parquet["average_color"])
-                valid_parquets.append((parquet, distance))
+                    # Check aspect ratio constraints
+                    if valid_aspects is not None:
+                        aspect = parquet['width'] / parquet['height']
+                        if not any(abs(aspect - va) < 0.01 for va in valid_aspects):
+                            continue
 
-            if not valid_parquets:
-                continue  # Skip if no valid candidates
+                    distance = calculate_color_distance(tessera["average_color"], parquet["average_color"])
+                    valid_parquets.append((parquet, distance))
 
-            # Calculate dynamic threshold: (max - min) * (N%)
-            distances = [d for (p, d) in valid_parquets]
-            min_d = min(distances)
-            max_d = max(distances)
-            dynamic_threshold = (max_d - min_d) * (threshold_percentage / 100) + min_d
+                if not valid_parquets:
+                    continue  # Skip if no valid candidates
 
-            # Filter candidates within dynamic threshold
-            #candidate_parquets = [
-            #    (p, d) for (p, d) in valid_parquets
-            #    if d <= dynamic_threshold  # Apply dynamic threshold
-            #]
-
-            # Filter candidates within dynamic threshold AND with priority >= pow(2, 10)   where max pow(2, 15)
-            candidate_parquets = [
-                (p, d) for (p, d) in valid_parquets
-                if d <= dynamic_threshold and p.get("priority", 0) >= pow(2, 10)
-            ]
-            
-            if not candidate_parquets:
-                continue  # No candidates within threshold
+                # Calculate dynamic threshold: (max - min) * (N%)
+                distances = [d for (p, d) in valid_parquets]
+                min_d = min(distances)
+                max_d = max(distances)
+                dynamic_threshold = (max_d - min_d) * (threshold_percentage / 100) + min_d
 
-            # Sort by priority (descending) and distance (ascending)
-            #candidate_parquets.sort(key=lambda x: (-x[0].get('priority', 0), x[1]))
+                # Filter candidates within dynamic threshold
+                #candidate_parquets = [
+                #    (p, d) for (p, d) in valid_parquets
+                #    if d <= dynamic_threshold  # Apply dynamic threshold
+                #]
 
-            # Introduce randomness to balance mosaic quality and parquet priority
-            random_number = random.randint(0, 100)  # Generate a random number between 0 and 100
-            prioritized_by_chance = CONFIG["prioritized_by_chance"]  # Default to 50% if not specified
+                # Filter candidates within dynamic threshold AND with priority >= pow(2, 10)   where max pow(2, 15)
+                candidate_parquets = [
+                    (p, d) for (p, d) in valid_parquets
+                    if d <= dynamic_threshold and p.get("priority", 0) >= pow(2, 10)
+                ]
             
-            if random_number < prioritized_by_chance:
+                if not candidate_parquets:
+                    continue  # No candidates within threshold
+
                 # Sort by priority (descending) and distance (ascending)
-                candidate_parquets.sort(key=lambda x: (-x[0].get('priority', 0), x[1]))
-            else:
-                # Sort by primary key color distance (ascending) and secondary priority (descending)
-                candidate_parquets.sort(key=lambda x: (x[1], -x[0].get('priority', 0)))
+                #candidate_parquets.sort(key=lambda x: (-x[0].get('priority', 0), x[1]))
+
+                # Introduce randomness to balance mosaic quality and parquet priority
+                random_number = random.randint(0, 100)  # Generate a random number between 0 and 100
+                prioritized_by_chance = CONFIG["prioritized_by_chance"]  # Default to 50% if not specified
             
-            # Select top candidate and track delta
-            selected_parquet, selected_distance = candidate_parquets[0]
-            delta = selected_distance - min_d  # Compare to the global minimum
-
-            # Update records
-            #candidates.append(create_candidate_entry(
-            #    selected_parquet, tessera, selected_distance, delta
-            #))
-            candidates.append(create_candidate_entry(
-                selected_parquet, tessera, selected_distance
-            ))
-            used_parquets.add(str(selected_parquet["coordinates"]))
-            tessera['usage_count'] = 1
+                if random_number < prioritized_by_chance:
+                    # Sort by priority (descending) and distance (ascending)
+                    candidate_parquets.sort(key=lambda x: (-x[0].get('priority', 0), x[1]))
+                else:
+                    # Sort by primary key color distance (ascending) and secondary priority (descending)
+                    candidate_parquets.sort(key=lambda x: (x[1], -x[0].get('priority', 0)))
+            
+                # Select top candidate and track delta
+                selected_parquet, selected_distance = candidate_parquets[0]
+                delta = selected_distance - min_d  # Compare to the global minimum
+
+                # Update records
+                #candidates.append(create_candidate_entry(
+                #    selected_parquet, tessera, selected_distance, delta
+                #))
+                candidates.append(create_candidate_entry(
+                    selected_parquet, tessera, selected_distance
+                ))
+                used_parquets.add(str(selected_parquet["coordinates"]))
+                tessera['usage_count'] = 1
 
     
     # Part 2: Assign remaining parquets to priority 0 tesserae
@@ -228,31 +391,27 @@ def prepare_mosaic_prioritized_sorted_filtered(parquets, tesserae_index_path, ca
     )
     
     
-    # Reset usage counts for priority 0 tesserae
-    for tessera in priority_zero:
-        tessera['usage_count'] = 0
-    
-    # Assign sorted remaining parquets using priority 0 tesserae with minimal reuse
-    for parquet in tqdm(remaining_parquets_sorted, desc="Priority 0 allocated"):
-        # Determine aspect ratio constraints for parquet
-        aspect = parquet['width'] / parquet['height']
-        valid_aspect = any(abs(aspect - valid) < 0.01 for valid in {1.5, 2/3})
-        
-        # Filter tesserae based on parquet's aspect ratio
-        candidate_tesserae = priority_zero
-        if not valid_aspect:
-            candidate_tesserae = [t for t in priority_zero if t['cropable'] == 1]
-        
-        best_tessera, distance = find_best_tessera(parquet["average_color"], candidate_tesserae)
-        if best_tessera:
-            best_tessera['usage_count'] += 1
-            candidates.append(create_candidate_entry(parquet, best_tessera, distance))
+    if CONFIG.get("matching_engine", "greedy") == "assignment":
+        greedy_score = sum(distance for _, _, distance in match_priority_zero_greedy(remaining_parquets_sorted, priority_zero))
+        matches, reuse_cap, overflowed = match_priority_zero_assignment(
+            remaining_parquets_sorted, priority_zero,
+            CONFIG.get("tessera_reuse_cap", 0), CONFIG.get("assignment_candidates", 8),
+            CONFIG.get("assignment_overflow_penalty", 10000))
+        score = sum(distance for _, _, distance in matches)
+        change = (score - greedy_score) / greedy_score * 100 if greedy_score else 0.0
+        log_message(f"Priority 0 assignment: total colour score {score:.0f} vs greedy {greedy_score:.0f} ({change:+.1f}%), "
+                    f"reuse cap {reuse_cap}, {overflowed} parquets over the cap")
+    else:
+        matches = match_priority_zero_greedy(remaining_parquets_sorted, priority_zero)
+    for parquet, tessera, distance in matches:
+        candidates.append(create_candidate_entry(parquet, tessera, distance))
     
     # Export results
     export_candidates_to_csv(candidates, candidates_output_path)
 
 
 
+@cached_stage(6)
 def main():
     setup_logging(CONFIG["log_file"])
 
@@ -270,7 +429,8 @@ def main():
     parquets = read_parquets_csv_stepiv(CONFIG["parquets_csv_path"])
     
     if parquets:
-        prepare_mosaic_prioritized_sorted_filtered(parquets, CONFIG["tesserae_index_path"], CONFIG["candidates_output_path"], scaling_up)
+        prepare_mosaic_prioritized_sorted_filtered(parquets, CONFIG["tesserae_index_path"], CONFIG["candidates_output_path"], scaling_up,
+                                                   CONFIG.get("random_seed"))
     
     end_time = datetime.now()
     log_message(f"Step6 - matching tesserae... done @{end_time.strftime('%Y-%m-%d %H:%M:%S')}")
@@ -7,6 +7,8 @@ from tqdm import tqdm
 from datetime import datetime
 import math
 import random
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image, ImageDraw
 Image.MAX_IMAGE_PIXELS = 268435456  # 16,384 x 16,384 pixels (268 million pixels)
 # Or disable the limit entirely (not recommended for untrusted images):
@@ -18,7 +20,9 @@ Image.MAX_IMAGE_PIXELS = 268435456  # 16,384 x 16,384 pixels (268 million pixels
 #common helper functions for this project, utils.py saved in the same folder
 from utils import *
 from utils_csv_io import *
+from utils_image_io import StreamingGifWriter, StripTiffWriter, StripCompositor, DeepZoomWriter, StripTee
 from config import CONFIG
+from stage_cache import cached_stage
 
 
 def get_cropped_tessera_quadrant_colors(tessera):
@@ -104,14 +108,18 @@ def get_best_transform(candidate, current_colors):
     
     return best_transform
 
-def rotate_or_flip_tessera(candidate, tessera):
-    """Optimize tessera orientation by applying transformations to minimize color distance."""
+def orient_tessera(candidate, tessera):
+    """rotate_or_flip_tessera, also returning the quadrant colours and the transform's name."""
     current_colors = get_cropped_tessera_quadrant_colors(tessera)
     best_transform = get_best_transform(candidate, current_colors)
     
     if best_transform and best_transform['method']:
-        return best_transform['method'](tessera)
-    return tessera
+        return best_transform['method'](tessera), current_colors, best_transform['name']
+    return tessera, current_colors, 'original'
+
+def rotate_or_flip_tessera(candidate, tessera):
+    """Optimize tessera orientation by applying transformations to minimize color distance."""
+    return orient_tessera(candidate, tessera)[0]
 
 def prepare_tessera_image(candidate, tessera_path):
     """Load, orient, crop and resize tessera image to match parquet dimensions."""
@@ -148,6 +156,158 @@ def prepare_tessera_image(candidate, tessera_path):
     return tessera.crop((left, top, right, bottom)).resize((width, height))
 
 
+def render_tessera(candidate):
+    """Prepare and orient the tessera for one candidate: (tessera, quadrant colours, transform name)."""
+    tessera = prepare_tessera_image(candidate, candidate['candidate']['image_path'])
+    return orient_tessera(candidate, tessera)
+
+def _render_tessera_job(candidate):
+    """Pool entry point: the rendered tessera as a raw buffer (mode, size, bytes) with its
+    quadrant colours and transform name, or the error."""
+    try:
+        tessera, colours, transform = render_tessera(candidate)
+        return (tessera.mode, tessera.size, tessera.tobytes()), colours, transform, None
+    except Exception as e:
+        return None, None, None, str(e)
+
+class PreparedTesseraCache:
+    """
+    LRU cache of rendered tesserae keyed by (image_path, file signature, width, height,
+    orientation, transform), holding at most budget_bytes of decoded pixels. The quadrant
+    colours of each prepared tessera are kept on the side (they are tiny), so a later
+    placement can pick its transform, and find the finished tile, without decoding the file
+    again. The file signature (size, mtime) makes a tessera re-cropped by step1 a miss.
+    """
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.tiles = OrderedDict()
+        self.colours = {}
+        self.size_bytes = 0
+        self.start_mosaic()
+
+    def start_mosaic(self):
+        """Reset the counters (so summary() is about one mosaic) and re-check the files' signatures."""
+        self.signatures = {}
+        self.peak_bytes = self.size_bytes
+        self.hits = self.misses = self.evictions = 0
+
+    def base_key(self, candidate):
+        image_path = candidate['candidate']['image_path']
+        signature = self.signatures.get(image_path)
+        if signature is None:
+            signature = self.signatures[image_path] = file_signature([image_path])[0]
+        x1, y1 = candidate['coords'][0]
+        x2, y2 = candidate['coords'][2]
+        return (image_path, signature, x2 - x1, y2 - y1, candidate['orientation'])
+
+    def lookup(self, candidate):
+        """The cached tile for this candidate, or None (counted as a miss)."""
+        base_key = self.base_key(candidate)
+        colours = self.colours.get(base_key)
+        if colours is not None:
+            key = base_key + (get_best_transform(candidate, colours)['name'],)
+            tessera = self.tiles.get(key)
+            if tessera is not None:
+                self.tiles.move_to_end(key)
+                self.hits += 1
+                return tessera
+        self.misses += 1
+        return None
+
+    def store(self, candidate, tessera, colours, transform):
+        base_key = self.base_key(candidate)
+        self.colours[base_key] = colours
+        key = base_key + (transform,)
+        nbytes = tessera.width * tessera.height * len(tessera.getbands())
+        if key in self.tiles or nbytes > self.budget_bytes:
+            return
+        self.tiles[key] = tessera
+        self.size_bytes += nbytes
+        while self.size_bytes > self.budget_bytes:
+            _, evicted = self.tiles.popitem(last=False)
+            self.size_bytes -= evicted.width * evicted.height * len(evicted.getbands())
+            self.evictions += 1
+        self.peak_bytes = max(self.peak_bytes, self.size_bytes)
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups * 100 if lookups else 0.0
+        return (f"Tessera cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate), "
+                f"{self.evictions} evictions, peak {self.peak_bytes / 2**20:.1f} of {self.budget_bytes / 2**20:.0f} MB")
+
+_shared_cache = None
+
+def shared_tessera_cache(budget_bytes):
+    """The process's PreparedTesseraCache, kept between mosaics (batch.py renders several per worker),
+    its counters reset for the mosaic about to be rendered."""
+    global _shared_cache
+    if _shared_cache is None or _shared_cache.budget_bytes != budget_bytes:
+        _shared_cache = PreparedTesseraCache(budget_bytes)
+    _shared_cache.start_mosaic()
+    return _shared_cache
+
+def iter_rendered_tesserae(candidates, workers=1, pool="process", in_flight=64, cache=None):
+    """
+    Yield (candidate, tessera, error) for every candidate, in order. With more than one
+    worker the tesserae are rendered by a process (or thread) pool and streamed back as raw
+    buffers; at most in_flight of them are queued or waiting to be pasted at any time.
+    Tiles found in the cache (a PreparedTesseraCache) are not rendered again.
+    """
+    if workers <= 1:
+        for candidate in candidates:
+            tessera = cache.lookup(candidate) if cache is not None else None
+            if tessera is not None:
+                yield candidate, tessera, None
+                continue
+            try:
+                tessera, colours, transform = render_tessera(candidate)
+            except Exception as e:
+                yield candidate, None, str(e)
+                continue
+            if cache is not None:
+                cache.store(candidate, tessera, colours, transform)
+            yield candidate, tessera, None
+        return
+
+    executor_class = ThreadPoolExecutor if pool == "thread" else ProcessPoolExecutor
+    pending = deque()
+    todo = iter(candidates)
+
+    def submit(candidate):
+        tessera = cache.lookup(candidate) if cache is not None else None
+        future = executor.submit(_render_tessera_job, candidate) if tessera is None else None
+        pending.append((candidate, future, tessera))
+
+    with executor_class(max_workers=workers) as executor:
+        for candidate in todo:
+            submit(candidate)
+            if len(pending) >= in_flight:
+                break
+        while pending:
+            candidate, future, tessera = pending.popleft()
+            error = None
+            if future is not None:
+                raw, colours, transform, error = future.result()
+                if raw:
+                    tessera = Image.frombytes(*raw)
+                    if cache is not None:
+                        cache.store(candidate, tessera, colours, transform)
+            for next_candidate in todo:
+                submit(next_candidate)
+                break
+            yield candidate, tessera, error
+
+def paste_downscaled(anime_writer, tessera, paste_pos, downsize):
+    """Paste a tessera, downscaled by downsize, onto the animation canvas."""
+    x, y = paste_pos
+    left, top = round(x / downsize), round(y / downsize)
+    right, bottom = round((x + tessera.width) / downsize), round((y + tessera.height) / downsize)
+    if right > left and bottom > top:
+        anime_writer.paste(tessera.resize((right - left, bottom - top), Image.Resampling.LANCZOS), (left, top))
+
+# scores of the last mosaic create_mosaic() made in this process, for batch.py and sweep runs
+last_mosaic_scores = {}
+
 def create_mosaic(candidates_index_path, output_path):
     """Create final mosaic from candidates index and generate an animated GIF of the process."""    
     candidates = read_candidates_csv(candidates_index_path)
@@ -164,12 +324,43 @@ def create_mosaic(candidates_index_path, output_path):
     
     mosaic_width = max_x - min_x
     mosaic_height = max_y - min_y
-    mosaic = Image.new('RGB', (mosaic_width, mosaic_height))
+
+    # Out-of-core mode: tiles are taken top to bottom and composited one horizontal strip at a
+    # time into a TIFF on disk, so the full canvas is never held in memory
+    strip_height = CONFIG.get("mosaic_strip_height", 0)
+    paste_order = list(range(len(candidates)))
+
+    # Deep Zoom pyramid for the browser viewer, built from the same strips as the poster
+    deep_zoom = None
+    dzi_path = os.path.splitext(output_path)[0] + ".dzi"
+    if CONFIG.get("mosaic_deep_zoom", False):
+        deep_zoom = DeepZoomWriter(dzi_path, mosaic_width, mosaic_height, CONFIG.get("deep_zoom_tile_size", 254),
+                                   quality=CONFIG["mosaic_jpg_quality"])
+
+    if strip_height:
+        paste_order.sort(key=lambda i: candidates[i]['coords'][0][1])
+        candidates = [candidates[i] for i in paste_order]
+        writer = StripTiffWriter(output_path, mosaic_width, mosaic_height, strip_height)
+        compositor = StripCompositor(StripTee(writer, deep_zoom) if deep_zoom else writer,
+                                     mosaic_width, mosaic_height, strip_height)
+        mosaic = None
+        log_message(f"Compositing {mosaic_width}x{mosaic_height} in strips of {strip_height} rows"
+                    f"{' (BigTIFF)' if writer.bigtiff else ''}")
+    else:
+        compositor = None
+        mosaic = Image.new('RGB', (mosaic_width, mosaic_height))
     
     # Prepare for animated GIF (it is 1/CONFIG["anime_size_downsize"] the output mosaic)
     gif_width = mosaic_width // CONFIG["anime_size_downsize"]
     gif_height = mosaic_height // CONFIG["anime_size_downsize"]
     gif_frames = []
+    gif_path = os.path.splitext(output_path)[0] + "_progress.gif"
+
+    # Streaming animation: frames are written as they are made, from a canvas at the GIF's size
+    anime_writer = None
+    if CONFIG["mosaic_anime"] and (CONFIG.get("anime_streaming", True) or compositor is not None):
+        anime_writer = StreamingGifWriter(gif_path, (gif_width, gif_height), duration=250, loop=0,
+                                          delta=CONFIG.get("anime_delta_frames", True))
 
     #frame_interval = 1  # Changed to 1 to capture every tessera placement
     #frame_interval = max(1, len(candidates) // 400)  # Aim for about 400 frames
@@ -177,38 +368,68 @@ def create_mosaic(candidates_index_path, output_path):
 
     total_score = 0.0
     total = len(candidates)
+
+    workers = resolve_workers(CONFIG.get("render_workers", 0))
+    if workers > 1:
+        log_message(f"Rendering tesserae with {workers} workers")
+    cache_mb = CONFIG.get("render_cache_mb", 256)
+    cache = shared_tessera_cache(cache_mb * 2**20) if cache_mb else None
+    rendered = iter_rendered_tesserae(candidates, workers, CONFIG.get("render_pool", "process"),
+                                      max(1, CONFIG.get("render_in_flight", 64)), cache)
     
-    for i, candidate in enumerate(tqdm(candidates, desc="Creating mosaic")):
+    for i, (candidate, tessera, error) in enumerate(tqdm(rendered, total=total, desc="Creating mosaic")):
         try:
-            tessera = prepare_tessera_image(candidate, candidate['candidate']['image_path'])
-            tessera = rotate_or_flip_tessera(candidate, tessera)
+            if error is not None:
+                raise RuntimeError(error)
             
             x1, y1 = candidate['coords'][0]
             paste_pos = (x1 - min_x, y1 - min_y)
-            mosaic.paste(tessera, paste_pos)
+            if compositor is not None:
+                compositor.add(paste_order[i], tessera, paste_pos)
+            else:
+                mosaic.paste(tessera, paste_pos)
+            if anime_writer is not None:
+                paste_downscaled(anime_writer, tessera, paste_pos, CONFIG["anime_size_downsize"])
             
             # Add frame to GIF at specified intervals or for the last candidate
             if i % frame_interval == 0 or i == len(candidates) - 1:
-                # Create downscaled version for GIF
-                gif_frame = mosaic.resize((gif_width, gif_height), Image.Resampling.LANCZOS)
-                gif_frames.append(gif_frame)
+                if anime_writer is not None:
+                    anime_writer.add_frame()
+                elif CONFIG["mosaic_anime"]:
+                    # Create downscaled version for GIF
+                    gif_frame = mosaic.resize((gif_width, gif_height), Image.Resampling.LANCZOS)
+                    gif_frames.append(gif_frame)
             
-            tessera.close()
             total_score += candidate['candidate']['score']
             
         except Exception as e:
             print(f"\nError processing {candidate['candidate']['image_path']}: {str(e)}")
 
+    if cache is not None:
+        log_message(cache.summary())
+    if anime_writer is not None:
+        anime_writer.close()
    
     # Save the final mosaic
-    mosaic.save(output_path, 'JPEG', quality=CONFIG["mosaic_jpg_quality"])
+    if compositor is not None:
+        compositor.close()
+    else:
+        mosaic.save(output_path, 'JPEG', quality=CONFIG["mosaic_jpg_quality"])
+        if deep_zoom is not None:
+            for top in range(0, mosaic_height, deep_zoom.tile_size):
+                deep_zoom.write_strip(mosaic.crop((0, top, mosaic_width, min(top + deep_zoom.tile_size, mosaic_height))))
+            deep_zoom.close()
     print(f"\nMosaic saved to: {output_path}")
+    if deep_zoom is not None:
+        log_message(f"Deep Zoom pyramid saved to: {dzi_path} ({deep_zoom.max_level + 1} levels)")
+        print(f"VIEWER: /viewer/{os.path.basename(os.path.splitext(output_path)[0])}")
 
-    if CONFIG["mosaic_anime"]:
+    if anime_writer is not None:
+        log_message(f"Mosaic animation saved to: {gif_path} ({anime_writer.frames} frames)")
+    elif CONFIG["mosaic_anime"]:
         print(f"Mosaic animation saving...")
         # Save the animated GIF if we collected frames
         if gif_frames:
-            gif_path = os.path.splitext(output_path)[0] + "_progress.gif"
             # Save first frame for longer duration
 
             # NEW: Wrap the GIF-saving process in a tqdm progress bar
@@ -233,11 +454,15 @@ def create_mosaic(candidates_index_path, output_path):
     
     log_message(f"Colour Variance = {avg_score:.2f}")
     log_message(f"Normalized Mosaic Noise: {normalized_score:.2f} dB")
+    last_mosaic_scores.clear()
+    last_mosaic_scores.update({"output_path": output_path, "tesserae": len(candidates),
+                               "colour_variance": avg_score, "noise_db": normalized_score})
 
     return True
 
 
 
+@cached_stage(7)
 def main():
     setup_logging(CONFIG["log_file"])
  
@@ -246,26 +471,36 @@ def main():
     
     candidates_index_path = CONFIG["candidates_output_path"]
      
+    success = False
     if os.path.exists(candidates_index_path):
         print("Starting mosaic composition...")
         current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_filename = f"mosaic_{current_time}.jpg"
-        output_path_filename = CONFIG["output_path"] + "\\" + output_filename
+        extension = "tif" if CONFIG.get("mosaic_strip_height", 0) else "jpg"
+        output_filename = f"mosaic_{current_time}.{extension}"
+        os.makedirs(CONFIG["output_path"], exist_ok=True)
+        output_path_filename = os.path.join(CONFIG["output_path"], output_filename)
         success = create_mosaic(candidates_index_path, output_path_filename)
         if success:
             current_time = datetime.now().strftime("@%H:%M:%S @%Y-%m-%d ")
             print(f"Mosaic composition completed successfully {current_time}")
-            img = Image.open(output_path_filename)
-            plt.figure(figsize=(CONFIG["plt_width"], CONFIG["plt_height"]))
-            plt.imshow(img)
-            plt.axis('on')
-            plt.show()
+            if CONFIG.get("mosaic_deep_zoom", False):
+                pass  # shown in the web UI's deep zoom viewer instead
+            elif extension == "tif":
+                # the poster may not fit in memory, so it is not loaded back for a preview
+                print(f"Out-of-core mosaic written to {output_path_filename}")
+            else:
+                img = Image.open(output_path_filename)
+                plt.figure(figsize=(CONFIG["plt_width"], CONFIG["plt_height"]))
+                plt.imshow(img)
+                plt.axis('on')
+                plt.show()
     else:
         print("Candidates index not found. Skipping final composition.")
 
     end_time = datetime.now()
     log_message(f"Step7 - mosaicing... done @{end_time.strftime('%Y-%m-%d %H:%M:%S')}")
     log_message(f"===Total execution time: {(end_time - start_time).total_seconds():.2f} seconds===" )
+    return output_path_filename if success else None    # for the stage cache
     
 if __name__ == "__main__":
     main()
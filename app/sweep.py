@@ -0,0 +1,140 @@
+#sweep - steps 3 to 7 for every combination of a grid of parquet and matching settings
+#each combination renders a low-resolution mosaic (small tesserae, no animation) with the same seed, so the
+#settings are compared on Normalized Mosaic Noise and runtime alone
+import argparse
+import csv
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+#common helper functions for this project, utils.py saved in the same folder
+from utils import log_message, setup_logging, resolve_workers
+from utils_motif_stats import load_motif_stats
+from batch import init_worker, render_motif, print_summary
+from config import CONFIG
+
+SWEEP_PARAMETERS = ['parquet_size_factor', 'split_diff', 'merge_diff', 'randomness_percentage',
+                    'threshold_percentage', 'prioritized_by_chance']
+
+
+def parse_grid(params, grid_file=None):
+    """{parameter: [values]} from a JSON file and/or name=v1,v2,... arguments."""
+    grid = {}
+    if grid_file:
+        with open(grid_file, 'r') as f:
+            grid.update(json.load(f))
+    for param in params or []:
+        name, _, values = param.partition('=')
+        grid[name.strip()] = [json.loads(value) for value in values.split(',') if value.strip()]
+    for name, values in grid.items():
+        if name not in SWEEP_PARAMETERS:
+            raise ValueError(f"Cannot sweep {name}; choose from {', '.join(SWEEP_PARAMETERS)}")
+        if not isinstance(values, list) or not values:
+            raise ValueError(f"No values for {name}")
+    return grid
+
+
+def combinations(grid):
+    """Every setting of the grid, as dicts, in a fixed order."""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def combination_overrides(settings, seed, tessera_width, sweep_folder, name):
+    """CONFIG overrides for one combination: its settings, the seed, small tesserae and its own files."""
+    work_folder = os.path.join(sweep_folder, name)
+    overrides = dict(settings)
+    overrides.update({
+        "parquets_csv_path": os.path.join(work_folder, "parquets.csv"),
+        "candidates_output_path": os.path.join(work_folder, "candidates_index.csv"),
+        "output_path": work_folder,
+        "random_seed": seed,
+        "tessera_width": tessera_width,
+        "tessera_height": tessera_width * 2 // 3,
+        "mosaic_anime": False,
+        "mosaic_deep_zoom": False,
+        "mosaic_strip_height": 0,
+        "render_workers": 1,
+    })
+    if "randomness_percentage" in settings:
+        overrides["ratio"] = settings["randomness_percentage"] / 100.0
+    return overrides
+
+
+def init_sweep_worker(app_dir):
+    """Batch worker set-up plus the motif statistics, shared read-only by every combination."""
+    init_worker(app_dir)
+    load_motif_stats(CONFIG["image_path"])
+
+
+def run_sweep(grid, seed, workers=0, tessera_width=48, sweep_folder=None):
+    """Render every combination of the grid; returns the rows, lowest noise first."""
+    settings = combinations(grid)
+    pool_size = max(1, min(resolve_workers(workers), len(settings)))
+    sweep_folder = sweep_folder or os.path.join(CONFIG["index_folder"], "sweep", datetime.now().strftime('%Y%m%d_%H%M%S'))
+    jobs = {f"c{number:03d}": combination for number, combination in enumerate(settings, 1)}
+
+    # read once here: forked workers inherit them, spawned ones read them once each
+    load_motif_stats(CONFIG["image_path"])
+    log_message(f"Sweep: {len(settings)} combinations of {', '.join(grid)} with seed {seed} on {pool_size} workers")
+
+    rows = []
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    with ProcessPoolExecutor(max_workers=pool_size, initializer=init_sweep_worker, initargs=(app_dir,)) as executor:
+        futures = {executor.submit(render_motif, name, combination_overrides(combination, seed, tessera_width,
+                                                                             sweep_folder, name)): name
+                   for name, combination in jobs.items()}
+        for done, future in enumerate(as_completed(futures), 1):
+            name = futures[future]
+            try:
+                row = future.result()
+            except Exception as e:     # the worker process itself died
+                row = {"status": f"worker failed: {e}"}
+            row.pop("motif", None)
+            row = {"combination": name, **jobs[name], **row}
+            rows.append(row)
+            log_message(f"Sweep [{done}/{len(jobs)}] {name} {jobs[name]}: noise {row.get('noise_db', '-')} dB "
+                        f"in {row.get('total_seconds', 0):.2f}s")
+    rows.sort(key=lambda row: (row.get("noise_db") is None, row.get("noise_db", 0)))
+    return rows, sweep_folder
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render low-resolution mosaics for a grid of settings and compare them.")
+    parser.add_argument("--param", action="append", metavar="NAME=V1,V2,...",
+                        help=f"values to try for one of: {', '.join(SWEEP_PARAMETERS)}")
+    parser.add_argument("--grid", help="JSON file of {parameter: [values]}")
+    parser.add_argument("--seed", type=int, default=CONFIG.get("random_seed") or 0)
+    parser.add_argument("--workers", type=int, default=CONFIG.get("sweep_workers", 0),
+                        help="worker processes, 0 for one per CPU core")
+    parser.add_argument("--tessera-width", type=int, default=CONFIG.get("sweep_tessera_width", 48),
+                        help="tessera width of the low-resolution mosaics")
+    args = parser.parse_args()
+
+    setup_logging(CONFIG["log_file"])
+    start_time = datetime.now()
+    log_message(f"Sweep - settings grid through steps 3-7... @{start_time.strftime('%Y-%m-%d %H:%M:%S')}")
+
+    grid = parse_grid(args.param, args.grid)
+    if not grid:
+        parser.error("give the settings to sweep with --param or --grid")
+
+    rows, sweep_folder = run_sweep(grid, args.seed, args.workers, args.tessera_width)
+    fields = ['combination'] + list(grid) + ['status', 'parquets', 'total_seconds', 'noise_db', 'mosaic']
+    print_summary(rows, fields[:-1])
+    summary_path = os.path.join(sweep_folder, "summary.csv")
+    os.makedirs(sweep_folder, exist_ok=True)
+    with open(summary_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    log_message(f"Sweep summary saved to: {summary_path}")
+
+    end_time = datetime.now()
+    log_message(f"Sweep - {len(rows)} combinations... done @{end_time.strftime('%Y-%m-%d %H:%M:%S')}")
+    log_message(f"===Total execution time: {(end_time - start_time).total_seconds():.2f} seconds===" )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+#pytest setup: the app's modules import each other by name and read config.json from the working directory
+import os
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+os.chdir(APP_DIR)
@@ -0,0 +1,49 @@
+#DeepZoomWriter: every tile of every level against the image halved level by level
+import math
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils_image_io import DeepZoomWriter
+
+
+@pytest.mark.parametrize("width, height, tile_size, overlap, strip_height", [
+    (101, 67, 16, 1, 7),     # odd sizes and odd strips: rows carried over between strips
+    (64, 64, 16, 0, 64),     # one strip, no overlap
+    (300, 35, 32, 2, 1),     # one row at a time
+])
+def test_tiles_match_the_reduced_image(tmp_path, width, height, tile_size, overlap, strip_height):
+    rng = np.random.default_rng(width)
+    image = Image.fromarray(rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8))
+
+    dzi_path = str(tmp_path / "mosaic.dzi")
+    writer = DeepZoomWriter(dzi_path, width, height, tile_size, overlap, tile_format='png')
+    for top in range(0, height, strip_height):
+        writer.write_strip(image.crop((0, top, width, min(top + strip_height, height))))
+    writer.close()
+
+    descriptor = ET.parse(dzi_path).getroot()
+    assert descriptor.get('TileSize') == str(tile_size) and descriptor.get('Overlap') == str(overlap)
+    size = descriptor.find('{http://schemas.microsoft.com/deepzoom/2008}Size')
+    assert (size.get('Width'), size.get('Height')) == (str(width), str(height))
+
+    max_level = math.ceil(math.log2(max(width, height)))
+    level_image = image
+    for level in range(max_level, -1, -1):
+        level_width, level_height = level_image.size
+        columns, rows = -(-level_width // tile_size), -(-level_height // tile_size)
+        folder = os.path.join(str(tmp_path), "mosaic_files", str(level))
+        assert len(os.listdir(folder)) == columns * rows
+        for row in range(rows):
+            for column in range(columns):
+                box = (max(column * tile_size - overlap, 0), max(row * tile_size - overlap, 0),
+                       min((column + 1) * tile_size + overlap, level_width),
+                       min((row + 1) * tile_size + overlap, level_height))
+                with Image.open(os.path.join(folder, f"{column}_{row}.png")) as tile:
+                    assert np.array_equal(np.asarray(tile.convert('RGB')), np.asarray(level_image.crop(box)))
+        if level:
+            level_image = level_image.reduce(2)
+    assert level_image.size == (1, 1)
@@ -0,0 +1,65 @@
+#capacitated_assignment against a brute-force optimum, nearest_candidates against a full sort
+import itertools
+import random
+
+import numpy as np
+
+from utils_matching import capacitated_assignment, nearest_candidates
+
+
+def brute_force_cost(candidates, capacities, overflow_costs):
+    """Lowest total cost over every assignment of each parquet to a candidate or to the overflow."""
+    choices = [list(zip(*costs_by_tessera)) + [(-1, overflow)]
+               for costs_by_tessera, overflow in zip(candidates, overflow_costs)]
+    best = float('inf')
+    for assignment in itertools.product(*choices):
+        load = [0] * len(capacities)
+        for j, _ in assignment:
+            if j != -1:
+                load[j] += 1
+        if all(l <= c for l, c in zip(load, capacities)):
+            best = min(best, sum(cost for _, cost in assignment))
+    return best
+
+
+def assignment_cost(assigned, candidates, overflow_costs):
+    total = 0
+    for u, j in enumerate(assigned):
+        positions, costs = candidates[u]
+        total += overflow_costs[u] if j == -1 else costs[positions.index(j)]
+    return total
+
+
+def test_capacitated_assignment_is_optimal():
+    rng = random.Random(0)
+    for _ in range(200):
+        n, m = rng.randint(1, 7), rng.randint(1, 4)
+        candidates = []
+        for _ in range(n):
+            positions = rng.sample(range(m), rng.randint(1, m))
+            candidates.append((positions, [rng.randint(0, 20) for _ in positions]))  # small costs: many ties
+        capacities = [rng.randint(1, 2) for _ in range(m)]
+        overflow_costs = [min(costs) + rng.randint(5, 40) for _, costs in candidates]
+
+        assigned = capacitated_assignment(candidates, capacities, overflow_costs)
+        for j in range(m):
+            assert assigned.count(j) <= capacities[j]
+        for u, j in enumerate(assigned):
+            assert j == -1 or j in candidates[u][0]
+        assert assignment_cost(assigned, candidates, overflow_costs) == brute_force_cost(candidates, capacities, overflow_costs)
+
+
+def test_nearest_candidates_match_a_full_sort():
+    rng = np.random.default_rng(0)
+    parquets = rng.integers(0, 256, size=(50, 3)).astype(np.float64)
+    tesserae = rng.integers(0, 256, size=(30, 3)).astype(np.float64)
+    cropable_only = rng.random(50) < 0.3
+    cropable = rng.random(30) < 0.5
+    k = 5
+
+    candidates = nearest_candidates(parquets, tesserae, k, cropable_only, cropable, chunk_size=16)
+    for u, (positions, distances) in enumerate(candidates):
+        allowed = [j for j in range(30) if cropable[j] or not cropable_only[u]]
+        expected = sorted(allowed, key=lambda j: (((parquets[u] - tesserae[j]) ** 2).sum(), j))[:k]
+        assert positions == expected
+        assert np.allclose(distances, [((parquets[u] - tesserae[j]) ** 2).sum() for j in expected])
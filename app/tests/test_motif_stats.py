@@ -0,0 +1,39 @@
+#MotifStats: summed-area means and variances against crop-and-average, including wrapped uint32 tables
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils_motif_stats import MotifStats
+
+
+@pytest.fixture
+def motif():
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, size=(61, 97, 3), dtype=np.uint8))
+
+
+def random_boxes(rng, width, height, count):
+    """Boxes of at least one pixel, some reaching past the motif's edges."""
+    boxes = []
+    for _ in range(count):
+        left, top = int(rng.integers(-10, width)), int(rng.integers(-10, height))
+        boxes.append((left, top, left + int(rng.integers(1, 40)), top + int(rng.integers(1, 40))))
+    return boxes
+
+
+def test_means_and_variances_match_the_crops(motif):
+    stats = MotifStats(motif)
+    for box in random_boxes(np.random.default_rng(1), *motif.size, 200):
+        crop = np.asarray(motif.crop(box)).reshape(-1, 3).astype(np.int64)
+        assert tuple(stats.mean_colour(box)) == tuple(crop.sum(axis=0) // len(crop))
+        assert np.allclose(stats.variance(box), crop.var(axis=0))
+
+
+def test_wrapped_sums_stay_exact(motif):
+    stats = MotifStats(motif)
+    boxes = np.array(random_boxes(np.random.default_rng(2), *motif.size, 200)).T
+    expected = stats._region_sums(stats.sums, *boxes)
+    # a constant added to every entry cancels in a rectangle's sum; this one wraps most entries past 2**32
+    stats.sums += np.uint32(2**32 - 1000)
+    assert stats.sums.dtype == np.uint32
+    assert np.array_equal(stats._region_sums(stats.sums, *boxes), expected)
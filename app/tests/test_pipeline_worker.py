@@ -0,0 +1,40 @@
+#steps 1-7 through the pipeline worker on a synthetic library, with process pools in steps 1 and 7
+import json
+import os
+
+from benchmarks.synthetic import make_tile_library, make_motif
+from config import CONFIG_FILE, load_config
+from pipeline_worker import PipelineWorker
+
+
+def synthetic_config(folder):
+    """CONFIG for config.json with base_path moved to folder, holding a small synthetic library and motif."""
+    with open(CONFIG_FILE, 'r') as f:
+        settings = json.load(f)
+    settings.update({"base_path": folder, "tessera_width": 60, "tessera_height": 40, "parquet_size_factor": 10,
+                     "random_seed": 0, "mosaic_anime": False, "mosaic_strip_height": 0, "mosaic_deep_zoom": False})
+    config_file = os.path.join(folder, "config.json")
+    with open(config_file, 'w') as f:
+        json.dump(settings, f)
+    config = load_config(config_file)
+    make_tile_library(config["tile_folder"], 24, seed=0)
+    make_motif(config["image_path"], 600, 400, seed=0)
+    for path in (config["tesserae_folder"], config["index_folder"], config["output_path"]):
+        os.makedirs(path, exist_ok=True)
+    return config
+
+
+def test_steps_with_process_pools(tmp_path):
+    config = synthetic_config(str(tmp_path))
+    # a daemonic worker cannot start the crop (step 1) and render (step 7) pools
+    config.update({"crop_workers": 2, "render_workers": 2, "render_pool": "process",
+                   "force_refresh": True, "stage_cache": False})
+    worker = PipelineWorker(overrides=config)
+    try:
+        for step in range(1, 8):
+            result = worker.run_step(step)
+            assert result['status'] == 'success', result.get('message')
+    finally:
+        worker.close()
+    assert os.listdir(config["tesserae_folder"])
+    assert [name for name in os.listdir(config["output_path"]) if name.startswith("mosaic_")]
@@ -0,0 +1,92 @@
+#stage cache: a hit restores into the current output paths, changed inputs miss, old entries are pruned
+import os
+import time
+
+import pytest
+
+import stage_cache
+from config import CONFIG
+
+
+@pytest.fixture
+def stage3(tmp_path, monkeypatch):
+    """A stand-in for step3's main() under cached_stage(3), its files in tmp_path; .runs counts real runs."""
+    motif = tmp_path / "motif.jpg"
+    motif.write_bytes(b"motif")
+    for key, value in {"image_path": str(motif), "index_folder": str(tmp_path / "index"),
+                       "parquets_csv_path": str(tmp_path / "a" / "parquets.csv"),
+                       "random_seed": 1, "stage_cache": True, "stage_cache_entries": 2}.items():
+        monkeypatch.setitem(CONFIG, key, value)
+    (tmp_path / "a").mkdir()
+    (tmp_path / "index").mkdir()
+
+    def main():
+        main.runs += 1
+        with open(CONFIG["parquets_csv_path"], 'w') as f:
+            f.write(f"parquets of seed {CONFIG['random_seed']}, run {main.runs}")
+        with open(os.path.splitext(CONFIG["parquets_csv_path"])[0] + ".jpg", 'w') as f:
+            f.write("masking")
+        return "done"
+    main.runs = 0
+    return stage_cache.cached_stage(3)(main), main
+
+
+def read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def test_hit_restores_into_the_current_paths(tmp_path, monkeypatch, stage3):
+    run, main = stage3
+    assert run() == "done" and main.runs == 1
+    original = read(tmp_path / "a" / "parquets.csv")
+
+    # the same inputs with the outputs pointed elsewhere: restored there, the old files untouched
+    (tmp_path / "b").mkdir()
+    monkeypatch.setitem(CONFIG, "parquets_csv_path", str(tmp_path / "b" / "parquets.csv"))
+    (tmp_path / "a" / "parquets.csv").write_text("edited since")
+    assert run() == "done" and main.runs == 1
+    assert read(tmp_path / "b" / "parquets.csv") == original
+    assert read(tmp_path / "b" / "parquets.jpg") == "masking"
+    assert read(tmp_path / "a" / "parquets.csv") == "edited since"
+
+
+def test_changed_input_misses(tmp_path, stage3):
+    run, main = stage3
+    run()
+    (tmp_path / "motif.jpg").write_bytes(b"another motif")
+    run()
+    assert main.runs == 2
+
+
+def test_unchanged_outputs_are_not_stored(tmp_path, monkeypatch, stage3):
+    run, main = stage3
+    def failing_main():
+        return None     # e.g. a step that failed and left the previous outputs in place
+    run()
+    monkeypatch.setitem(CONFIG, "random_seed", 2)
+    stage_cache.cached_stage(3)(failing_main)()
+    entries = os.listdir(tmp_path / "index" / "stage-cache" / "step3")
+    assert len(entries) == 1
+
+
+def test_prune_keeps_the_most_recently_used(tmp_path, monkeypatch, stage3):
+    run, main = stage3
+    for seed in (1, 2):
+        monkeypatch.setitem(CONFIG, "random_seed", seed)
+        run()
+        time.sleep(0.05)
+    monkeypatch.setitem(CONFIG, "random_seed", 1)
+    run()                   # a hit: seed 1 becomes the most recently used
+    time.sleep(0.05)
+    monkeypatch.setitem(CONFIG, "random_seed", 3)
+    run()                   # a third entry: seed 2, the least recently used, goes
+    assert main.runs == 3
+    assert len(os.listdir(tmp_path / "index" / "stage-cache" / "step3")) == 2
+
+    monkeypatch.setitem(CONFIG, "random_seed", 1)
+    run()
+    assert main.runs == 3
+    monkeypatch.setitem(CONFIG, "random_seed", 2)
+    run()
+    assert main.runs == 4
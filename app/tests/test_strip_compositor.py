@@ -0,0 +1,41 @@
+#StripCompositor: a strip-by-strip TIFF must match pasting every tile in index order on one canvas
+import random
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils_image_io import StripCompositor, StripTiffWriter
+
+
+def random_tiles(rng, width, height, count):
+    """(index, tile, (left, top)) for overlapping tiles, some reaching past the image edges."""
+    tiles = []
+    for index in range(count):
+        tile_width, tile_height = rng.randint(3, 30), rng.randint(3, 30)
+        colour = tuple(rng.randint(0, 255) for _ in range(3))
+        position = (rng.randint(-5, width - 1), rng.randint(-5, height - 1))
+        tiles.append((index, Image.new('RGB', (tile_width, tile_height), colour), position))
+    return tiles
+
+
+@pytest.mark.parametrize("strip_height, bigtiff", [(1, False), (7, False), (16, True), (200, False)])
+def test_strips_match_one_canvas(tmp_path, strip_height, bigtiff):
+    rng = random.Random(strip_height)
+    width, height = 97, 61
+    tiles = random_tiles(rng, width, height, 120)
+
+    canvas = Image.new('RGB', (width, height))
+    for _, tile, position in tiles:
+        canvas.paste(tile, position)
+
+    path = str(tmp_path / "strips.tif")
+    compositor = StripCompositor(StripTiffWriter(path, width, height, strip_height, bigtiff), width, height, strip_height)
+    # as step7 does: tiles arrive by their top edge, overlaps resolved by their index
+    for index, tile, position in sorted(tiles, key=lambda entry: entry[2][1]):
+        compositor.add(index, tile, position)
+    compositor.close()
+
+    with Image.open(path) as written:
+        assert written.size == (width, height)
+        assert np.array_equal(np.asarray(written.convert('RGB')), np.asarray(canvas))
@@ -2,6 +2,7 @@
 import os
 
 import logging
+import numpy as np
 def log_message(message):
     """Log a message to both console and log file."""
     logging.info(message)
@@ -20,6 +21,45 @@ def setup_logging(log_file):
     )
 
 
+def resolve_workers(workers):
+    """Number of worker processes to use; 0 (or None) means one per CPU core."""
+    if not workers:
+        return os.cpu_count() or 1
+    return max(1, int(workers))
+
+
+_file_memo = {}
+
+def file_signature(paths):
+    """(path, size, mtime in ns) of each file, None for a missing file."""
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            signature.append((path, None))
+    return tuple(signature)
+
+def memo_by_files(name, paths, loader):
+    """loader()'s result, reused while the files in paths keep their size and modification time.
+    A step runs once per process, so this pays off in the persistent pipeline worker."""
+    signature = file_signature(paths)
+    cached = _file_memo.get(name)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    value = loader()
+    _file_memo[name] = (signature, value)
+    return value
+
+def clear_file_memo():
+    _file_memo.clear()
+
+def forget_file_memo(name):
+    """Drop one memoised value, e.g. a memory map that must be released before its file is replaced."""
+    _file_memo.pop(name, None)
+
+
 #def get_average_color(image):   #it was previously defined as get_average_color.
 def average_colour_n_fallback(image):
     """Calculate the average color of an image."""
@@ -46,6 +86,35 @@ def calculate_average_color(image):
 """to be called from step2, 3 ,4, 5, 6 and 7"""
 
 
+def batch_colour_stats(stack):
+    """Average and quadrant colours of a stack of same-sized RGB images in one pass.
+
+    stack is a uint8 array of shape (n, height, width, 3). Returns an int array of shape
+    (n, 5, 3) holding the average, top-left, top-right, bottom-left and bottom-right
+    colours, equal to calculate_average_color on each image and on its four quadrant
+    crops; an empty quadrant gives (0, 0, 0)."""
+    n, height, width = stack.shape[:3]
+    h2, w2 = height // 2, width // 2
+    sums = np.empty((n, 5, 3), dtype=np.int64)
+    sums[:, 1] = stack[:, :h2, :w2, :3].sum(axis=(1, 2), dtype=np.int64)
+    sums[:, 2] = stack[:, :h2, w2:, :3].sum(axis=(1, 2), dtype=np.int64)
+    sums[:, 3] = stack[:, h2:, :w2, :3].sum(axis=(1, 2), dtype=np.int64)
+    sums[:, 4] = stack[:, h2:, w2:, :3].sum(axis=(1, 2), dtype=np.int64)
+    sums[:, 0] = sums[:, 1:].sum(axis=1)  # the quadrants tile the whole image
+    counts = np.array([height * width, h2 * w2, h2 * (width - w2),
+                       (height - h2) * w2, (height - h2) * (width - w2)], dtype=np.int64)
+
+    means = np.zeros((n, 5, 3), dtype=np.int64)
+    nonempty = counts > 0
+    means[:, nonempty] = (sums[:, nonempty] / counts[nonempty, None]).astype(np.int64)
+    return means
+
+def colour_stats(pixels):
+    """Average colour and (top-left, top-right, bottom-left, bottom-right) quadrant colours
+    of one RGB image array of shape (height, width, 3), as a tuple of five int tuples."""
+    return tuple(tuple(int(c) for c in colour) for colour in batch_colour_stats(pixels[np.newaxis])[0])
+
+
 # Check if quadrants are non-zero before calculating average color  oversimplified
 def safe_avg(region):
     """Return average color or fallback to (0,0,0) if region is empty."""
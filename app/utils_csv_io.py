@@ -1,6 +1,7 @@
 #this common helper functinon need for each step*.py
 import os
 import csv
+import numpy as np
 
 #common helper functions for this project, utils.py saved in the same folder
 from utils import *
@@ -25,7 +26,9 @@ def parse_row(row):
         'cropable': int(row['Cropable'])
     }
 
-def write_tesserae_index_file(index_file, index_data):
+def write_tesserae_index_file(index_file, index_data, binary=False):
+    """Write tesserae_index.csv; with binary, also its columnar .npy twin (see write_tesserae_index_npy).
+    Without binary, a stale .npy twin is removed so readers never prefer outdated data."""
     os.makedirs(os.path.dirname(index_file), exist_ok=True)
     with open(index_file, 'w', newline='') as csvfile:
         csvwriter = csv.writer(csvfile)
@@ -34,6 +37,102 @@ def write_tesserae_index_file(index_file, index_data):
                            'Priority', 'Cropable'])
         csvwriter.writerows(index_data)
 
+    npy_file = tesserae_index_npy_path(index_file)
+    if binary:
+        write_tesserae_index_npy(npy_file, index_data)
+    elif os.path.exists(npy_file):
+        forget_file_memo(('tesserae', npy_file))
+        os.remove(npy_file)
+
+###binary columnar tesserae index: one structured .npy array, loaded memory-mapped
+TESSERAE_COLOUR_FIELDS = ['average_color', 'top_left_color', 'top_right_color', 'bottom_left_color', 'bottom_right_color']
+TESSERAE_INDEX_FIELDS = ['image_path', 'average_color', 'original_dimensions', 'orientation', 'top_left_color',
+                         'top_right_color', 'bottom_left_color', 'bottom_right_color', 'priority', 'cropable']
+
+def tesserae_index_npy_path(index_file):
+    """Path of the binary twin of a tesserae index CSV (tesserae_index.csv -> tesserae_index.npy)."""
+    return os.path.splitext(index_file)[0] + '.npy'
+
+def write_tesserae_index_npy(npy_file, index_data):
+    """Save index rows (as written to tesserae_index.csv) as a structured array, see tesserae_index_array."""
+    index = tesserae_index_array(index_data)
+    tmp_file = npy_file + '.tmp.npy'
+    np.save(tmp_file, index)
+    forget_file_memo(('tesserae', npy_file))    # a memory-mapped file cannot be replaced on Windows
+    os.replace(tmp_file, npy_file)
+
+def tesserae_index_array(index_data):
+    """Index rows (in tesserae_index.csv column order) as a structured array with typed columns:
+    colours (float, 3), dimensions (int, 2), priority, cropable, orientation and the UTF-8
+    image path table."""
+    paths = [row[0].encode('utf-8') for row in index_data]
+    dtype = np.dtype([
+        ('image_path', f'S{max((len(p) for p in paths), default=1)}'),
+        ('average_color', 'f8', 3),
+        ('original_dimensions', 'i4', 2),
+        ('orientation', 'S9'),
+        ('top_left_color', 'f8', 3),
+        ('top_right_color', 'f8', 3),
+        ('bottom_left_color', 'f8', 3),
+        ('bottom_right_color', 'f8', 3),
+        ('priority', 'i4'),
+        ('cropable', 'i1')
+    ])
+    index = np.zeros(len(index_data), dtype=dtype)
+    if index_data:
+        index['image_path'] = paths
+        for column, name in enumerate(dtype.names[1:], start=1):
+            index[name] = [row[column] for row in index_data]
+    return index
+
+def load_tesserae_index_array(npy_file):
+    """Memory-map the binary tesserae index as a read-only structured array."""
+    return np.load(npy_file, mmap_mode='r')
+
+def tesserae_index_array_to_dicts(index):
+    """Convert the structured array into the list of dictionaries returned by read_tesserae_index_file."""
+    columns = {name: index[name].tolist() for name in index.dtype.names}
+    columns['image_path'] = [p.decode('utf-8') for p in columns['image_path']]
+    columns['orientation'] = [o.decode('ascii') for o in columns['orientation']]
+    for name in TESSERAE_COLOUR_FIELDS + ['original_dimensions']:
+        columns[name] = list(map(tuple, columns[name]))
+    names = list(columns)
+    return [dict(zip(names, values)) for values in zip(*columns.values())]
+
+def tessera_records(index):
+    """A function giving the dictionary (as in tesserae_index_array_to_dicts) of one row of the
+    structured array; each row is converted on first use, so callers that only pick a few
+    tesserae out of a large index never build the rest."""
+    records = {}
+    def record(position):
+        if position not in records:
+            records[position] = tesserae_index_array_to_dicts(index[position:position + 1])[0]
+        return records[position]
+    return record
+
+def read_tesserae_index(index_file):
+    """Read the tesserae index as a read-only structured array (see tesserae_index_array), the
+    binary .npy twin memory-mapped when it is present and not older than the CSV, otherwise
+    built from read_tesserae_index_file. Returns None if neither can be read."""
+    npy_file = tesserae_index_npy_path(index_file)
+    if os.path.exists(npy_file) and (not os.path.exists(index_file) or
+                                     os.path.getmtime(npy_file) >= os.path.getmtime(index_file)):
+        try:
+            index = memo_by_files(('tesserae', npy_file), [npy_file], lambda: load_tesserae_index_array(npy_file))
+            print(f"Successfully read {len(index)} tesserae from {npy_file}")
+            return index
+        except Exception as e:
+            print(f"Error reading binary tesserae index, falling back to CSV: {str(e)}")
+    return memo_by_files(('tesserae', index_file), [index_file], lambda: tesserae_dicts_to_array(read_tesserae_index_file(index_file)))
+
+def tesserae_dicts_to_array(tesserae):
+    """The structured array of the dictionaries read_tesserae_index_file returns (None stays None)."""
+    if tesserae is None:
+        return None
+    index = tesserae_index_array([[tessera[name] for name in TESSERAE_INDEX_FIELDS] for tessera in tesserae])
+    index.flags.writeable = False    # shared through the memo, like the read-only memory map
+    return index
+
 def read_tesserae_index_file(csv_path):
     """
     Reads and parses the tesserae_index.csv file.
@@ -71,11 +170,13 @@ def save_parquet_csv(filtered, csv_path):
     """
     Save the filtered parquet data to a CSV file.
     Args:
-        filtered (list): List of dictionaries containing parquet data.
+        filtered (list): List of dictionaries containing parquet data, or a parquet array.
         csv_path (str): Path to the output CSV file.
     Returns:
         None
     """
+    if isinstance(filtered, np.ndarray):
+        return save_parquet_array(filtered, csv_path)
     with open(csv_path, 'w', newline='') as f:
         writer = csv.DictWriter(f, fieldnames=[
             'x1', 'y1', 'x2', 'y2', 
@@ -122,6 +223,100 @@ def save_parquet_csv(filtered, csv_path):
             })
 
 
+###compact parquet store: one structured array row per parquet instead of a dict of tuples
+PARQUET_COLOUR_FIELDS = ['average_color', 'top_left_color', 'top_right_color', 'bottom_left_color', 'bottom_right_color']
+PARQUET_CSV_FIELDS = [
+    'x1', 'y1', 'x2', 'y2', 'x3', 'y3', 'x4', 'y4',
+    'avg_r', 'avg_g', 'avg_b',
+    'on_the_edge',
+    'orientation',
+    'priority',
+    'tl_r', 'tl_g', 'tl_b',
+    'tr_r', 'tr_g', 'tr_b',
+    'bl_r', 'bl_g', 'bl_b',
+    'br_r', 'br_g', 'br_b'
+]
+PARQUET_DTYPE = np.dtype([
+    ('coordinates', 'f8', (4, 2)),      # top-left, top-right, bottom-right, bottom-left corners
+    ('average_color', 'i4', 3),
+    ('on_the_edge', 'i1'),
+    ('landscape', '?'),                 # orientation: landscape (True) or portrait (False)
+    ('priority', 'i8'),
+    ('top_left_color', 'i4', 3),
+    ('top_right_color', 'i4', 3),
+    ('bottom_left_color', 'i4', 3),
+    ('bottom_right_color', 'i4', 3)
+])
+
+def parquet_array(size):
+    """An all-zero parquet array of the given length."""
+    return np.zeros(size, dtype=PARQUET_DTYPE)
+
+def parquets_to_array(parquets):
+    """Pack a list of parquet dictionaries into a parquet array."""
+    array = parquet_array(len(parquets))
+    if parquets:
+        array['coordinates'] = [p["coordinates"] for p in parquets]
+        for name in PARQUET_COLOUR_FIELDS:
+            array[name] = [p[name] for p in parquets]
+        array['on_the_edge'] = [p["on_the_edge"] for p in parquets]
+        array['landscape'] = [p["orientation"] == "landscape" for p in parquets]
+        array['priority'] = [p["priority"] for p in parquets]
+    return array
+
+def parquet_array_to_dicts(array):
+    """Unpack a parquet array into the list of dictionaries returned by read_parquets_csv."""
+    columns = {
+        "coordinates": [list(map(tuple, c)) for c in array['coordinates'].tolist()],
+        "average_color": list(map(tuple, array['average_color'].tolist()))
+    }
+    for name in PARQUET_COLOUR_FIELDS[1:]:
+        columns[name] = list(map(tuple, array[name].tolist()))
+    columns["on_the_edge"] = array['on_the_edge'].tolist()
+    columns["orientation"] = ["landscape" if l else "portrait" for l in array['landscape'].tolist()]
+    columns["priority"] = array['priority'].tolist()
+    names = list(columns)
+    return [dict(zip(names, values)) for values in zip(*columns.values())]
+
+def parse_parquet_csv(csv_path):
+    """Parse parquets.csv into a parquet array, one column at a time."""
+    with open(csv_path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(reader)
+    column = {name: position for position, name in enumerate(header)}
+    def numbers(names):
+        return np.array([[row[column[name]] for name in names] for row in rows], dtype=np.float64).reshape(len(rows), len(names))
+    array = parquet_array(len(rows))
+    array['coordinates'] = numbers(PARQUET_CSV_FIELDS[:8]).reshape(-1, 4, 2)
+    for name, prefix in zip(PARQUET_COLOUR_FIELDS, ['avg', 'tl', 'tr', 'bl', 'br']):
+        array[name] = numbers([f'{prefix}_r', f'{prefix}_g', f'{prefix}_b'])
+    array['on_the_edge'] = numbers(['on_the_edge'])[:, 0]
+    array['priority'] = numbers(['priority'])[:, 0]
+    array['landscape'] = [row[column['orientation']] == 'landscape' for row in rows]
+    return array
+
+def read_parquet_array(csv_path):
+    """Read parquets.csv into a parquet array (a copy of the parsed file, kept while it is unchanged)."""
+    try:
+        array = memo_by_files(('parquets', csv_path), [csv_path], lambda: parse_parquet_csv(csv_path)).copy()
+        print(f"Successfully read {len(array)} items from {csv_path}")
+        return array
+    except Exception as e:
+        print(f"Error reading CSV: {str(e)}")
+        return None
+
+def save_parquet_array(array, csv_path):
+    """Save a parquet array to parquets.csv, written exactly as save_parquet_csv writes the dictionaries."""
+    columns = [array['coordinates'].reshape(-1, 8).tolist(), array['average_color'].tolist(),
+               array['on_the_edge'].tolist(), array['landscape'].tolist(), array['priority'].tolist()] + \
+              [array[name].tolist() for name in PARQUET_COLOUR_FIELDS[1:]]
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(PARQUET_CSV_FIELDS)
+        for coords, avg, edge, landscape, priority, tl, tr, bl, br in zip(*columns):
+            writer.writerow(coords + avg + [edge, "landscape" if landscape else "portrait", priority] + tl + tr + bl + br)
+
 ###from step4.py reading parquet information, where coordinates are floats
 ### this same applies to step5.py
 def read_csv_with_coordinates(csv_path, coordinate_fields, color_fields, other_fields):
@@ -184,42 +379,18 @@ def read_parquets_csv(csv_path):
 
 ####from step6 this is different from step4  #### coordinates type cast from float to int
 def read_parquets_csv_stepiv(csv_path):
-    """Read parquets CSV and calculate dimensions with tuple parsing"""
-    coordinate_fields = ['x1', 'y1', 'x2', 'y2', 'x3', 'y3', 'x4', 'y4']
-    color_fields = {
-        "avg": ['avg_r', 'avg_g', 'avg_b'],
-        "top_left": ['tl_r', 'tl_g', 'tl_b'],
-        "top_right": ['tr_r', 'tr_g', 'tr_b'],
-        "bottom_left": ['bl_r', 'bl_g', 'bl_b'],
-        "bottom_right": ['br_r', 'br_g', 'br_b']
-    }
-    other_fields = {
-        "on_the_edge": int,
-        "orientation": str,
-        "priority": int
-    }
-    parquets = read_csv_with_coordinates(csv_path, coordinate_fields, color_fields, other_fields)
-    
-    valid_parquets = []
-    for pq in parquets:
-        # Flatten coordinate tuples
-        coords = []
-        for coord_pair in pq['coordinates']:
-            if isinstance(coord_pair, (tuple, list)) and len(coord_pair) == 2:
-                coords.extend([int(coord_pair[0]), int(coord_pair[1])])
-            else:
-                print(f"Invalid coordinate format: {coord_pair}")
-                break
-        else:
-            if len(coords) == 8:
-                # Calculate dimensions
-                x1, y1, x2, y2, x3, y3, x4, y4 = coords
-                pq['width'] = abs(x3 - x1)
-                pq['height'] = abs(y3 - y1)
-                valid_parquets.append(pq)
-            else:
-                print(f"Skipping parquet with incomplete coordinates: {pq['coordinates']}")    
-    return valid_parquets
+    """Read parquets CSV and calculate dimensions (from the coordinates cast to int)"""
+    array = read_parquet_array(csv_path)
+    if array is None:
+        return None
+    parquets = parquet_array_to_dicts(array)
+    corners = array['coordinates'].astype(np.int64)
+    widths = np.abs(corners[:, 2, 0] - corners[:, 0, 0]).tolist()
+    heights = np.abs(corners[:, 2, 1] - corners[:, 0, 1]).tolist()
+    for pq, width, height in zip(parquets, widths, heights):
+        pq['width'] = width
+        pq['height'] = height
+    return parquets
 
 ####from step6 this is different ffrom step4
 
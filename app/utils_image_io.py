@@ -0,0 +1,364 @@
+#image writers that stream to disk instead of holding every frame or the whole canvas in memory
+import io
+import math
+import os
+import struct
+from PIL import Image
+
+
+def _skip_sub_blocks(data, pos):
+    """Position just past a chain of GIF data sub-blocks (ending with a zero-length block)."""
+    while data[pos]:
+        pos += data[pos] + 1
+    return pos + 1
+
+
+def _gif_image_block(frame):
+    """
+    Encode one RGB frame with Pillow and return its image descriptor and LZW data, with the
+    frame's palette moved into a local colour table so the block can be spliced into another
+    GIF stream. The descriptor's position is left at (0, 0).
+    """
+    buffer = io.BytesIO()
+    frame.save(buffer, 'GIF')
+    data = buffer.getvalue()
+
+    packed = data[10]
+    pos = 13
+    global_table = b''
+    if packed & 0x80:
+        table_size = 3 << ((packed & 0x07) + 1)
+        global_table = data[pos:pos + table_size]
+        table_bits = packed & 0x07
+        pos += table_size
+
+    while data[pos] == 0x21:  # skip the frame's own extensions
+        pos = _skip_sub_blocks(data, pos + 2)
+    if data[pos] != 0x2C:
+        raise ValueError("Unexpected GIF block from encoder")
+
+    descriptor = bytearray(data[pos:pos + 10])
+    pos += 10
+    local_table = b''
+    if descriptor[9] & 0x80:
+        local_table = data[pos:pos + (3 << ((descriptor[9] & 0x07) + 1))]
+        pos += len(local_table)
+    elif global_table:
+        descriptor[9] = (descriptor[9] & 0x40) | 0x80 | table_bits
+        local_table = global_table
+    end = _skip_sub_blocks(data, pos + 1)  # LZW minimum code size, then the data sub-blocks
+    return descriptor, local_table + data[pos:end]
+
+
+class StreamingGifWriter:
+    """
+    Animated GIF written frame by frame while a picture is being built up.
+
+    The writer keeps its own canvas at the animation's size: paste() puts a (downscaled)
+    patch on it and add_frame() appends the canvas to the file straight away. With delta
+    frames only the area pasted since the previous frame is encoded, on top of the frames
+    before it, so memory stays at one canvas and each frame costs only its changed area.
+    """
+
+    def __init__(self, path, size, duration=250, loop=0, delta=True, background=(0, 0, 0)):
+        self.path = path
+        self.size = size
+        self.duration = duration
+        self.delta = delta
+        self.canvas = Image.new('RGB', size, background)
+        self.dirty = None
+        self.frames = 0
+        self.file = open(path, 'wb')
+        self.file.write(b'GIF89a' + struct.pack('<HHBBB', size[0], size[1], 0, 0, 0))
+        # NETSCAPE2.0 application extension: loop count
+        self.file.write(b'\x21\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', loop) + b'\x00')
+
+    def paste(self, patch, position):
+        """Paste an image onto the canvas at position (left, top) in canvas pixels."""
+        left, top = position
+        right = min(left + patch.width, self.size[0])
+        bottom = min(top + patch.height, self.size[1])
+        left, top = max(left, 0), max(top, 0)
+        if right <= left or bottom <= top:
+            return
+        self.canvas.paste(patch, position)
+        if self.dirty is None:
+            self.dirty = (left, top, right, bottom)
+        else:
+            d = self.dirty
+            self.dirty = (min(d[0], left), min(d[1], top), max(d[2], right), max(d[3], bottom))
+
+    def add_frame(self):
+        """Append the canvas as the next frame (only its changed area when writing deltas)."""
+        if self.delta and self.frames:
+            box = self.dirty or (0, 0, 1, 1)
+        else:
+            box = (0, 0) + self.size
+        descriptor, image_data = _gif_image_block(self.canvas.crop(box))
+        descriptor[1:5] = struct.pack('<HH', box[0], box[1])
+
+        # graphic control extension: keep each frame in place under the next (disposal 1),
+        # and the frame delay in centiseconds
+        self.file.write(struct.pack('<BBBBHBB', 0x21, 0xF9, 4, 1 << 2,
+                                    int(round(self.duration / 10)), 0, 0))
+        self.file.write(bytes(descriptor) + image_data)
+        self.dirty = None
+        self.frames += 1
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.write(b'\x3b')
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StripTiffWriter:
+    """
+    Uncompressed RGB TIFF written one horizontal strip at a time, top to bottom.
+
+    Pixel data goes to disk as it arrives and the directory (with the strip offsets) is
+    written at the end, so only the current strip is ever in memory. Images too large for
+    32-bit offsets are written as BigTIFF.
+    """
+
+    def __init__(self, path, width, height, rows_per_strip, bigtiff=None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.rows_per_strip = rows_per_strip
+        if bigtiff is None:
+            bigtiff = width * height * 3 > 0xFFFFFFFF - 0x100000  # leave room for the directory
+        self.bigtiff = bigtiff
+        self.rows_written = 0
+        self.strip_offsets = []
+        self.strip_byte_counts = []
+        self.file = open(path, 'wb')
+        if bigtiff:
+            self.file.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+        else:
+            self.file.write(b'II' + struct.pack('<HI', 42, 0))
+
+    def write_strip(self, strip):
+        """Append the next strip: an RGB image as wide as the TIFF, rows_per_strip high
+        (or whatever is left at the bottom)."""
+        rows = min(self.rows_per_strip, self.height - self.rows_written)
+        if strip.size != (self.width, rows):
+            raise ValueError(f"Expected a {self.width}x{rows} strip, got {strip.size[0]}x{strip.size[1]}")
+        data = strip.convert('RGB').tobytes()
+        self.strip_offsets.append(self.file.tell())
+        self.strip_byte_counts.append(len(data))
+        self.file.write(data)
+        self.rows_written += rows
+
+    def _write_directory(self):
+        if self.file.tell() % 2:
+            self.file.write(b'\0')  # TIFF offsets are word aligned
+        ifd_offset = self.file.tell()
+        offset_type = 16 if self.bigtiff else 4  # LONG8 or LONG
+        entries = [
+            (256, 4, [self.width]),                   # ImageWidth
+            (257, 4, [self.height]),                  # ImageLength
+            (258, 3, [8, 8, 8]),                      # BitsPerSample
+            (259, 3, [1]),                            # Compression: none
+            (262, 3, [2]),                            # PhotometricInterpretation: RGB
+            (273, offset_type, self.strip_offsets),   # StripOffsets
+            (277, 3, [3]),                            # SamplesPerPixel
+            (278, 4, [self.rows_per_strip]),          # RowsPerStrip
+            (279, offset_type, self.strip_byte_counts),  # StripByteCounts
+            (284, 3, [1]),                            # PlanarConfiguration: chunky
+        ]
+        formats = {3: 'H', 4: 'I', 16: 'Q'}
+        if self.bigtiff:
+            head_format, entry_format, inline_bytes, next_format = '<Q', '<HHQ', 8, '<Q'
+        else:
+            head_format, entry_format, inline_bytes, next_format = '<H', '<HHI', 4, '<I'
+        entry_size = struct.calcsize(entry_format) + inline_bytes
+        extra_offset = ifd_offset + struct.calcsize(head_format) + len(entries) * entry_size + struct.calcsize(next_format)
+
+        directory = [struct.pack(head_format, len(entries))]
+        extra = []
+        for tag, tag_type, values in entries:
+            payload = struct.pack(f'<{len(values)}{formats[tag_type]}', *values)
+            directory.append(struct.pack(entry_format, tag, tag_type, len(values)))
+            if len(payload) <= inline_bytes:
+                directory.append(payload.ljust(inline_bytes, b'\0'))
+            else:
+                directory.append(struct.pack('<Q' if self.bigtiff else '<I', extra_offset))
+                extra.append(payload)
+                extra_offset += len(payload)
+        directory.append(struct.pack(next_format, 0))
+        self.file.write(b''.join(directory) + b''.join(extra))
+
+        self.file.seek(8 if self.bigtiff else 4)
+        self.file.write(struct.pack('<Q' if self.bigtiff else '<I', ifd_offset))
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.rows_written != self.height:
+            self.file.close()
+            raise ValueError(f"{self.path}: only {self.rows_written} of {self.height} rows written")
+        self._write_directory()
+        self.file.close()
+
+
+class StripCompositor:
+    """
+    Composites pasted tiles one horizontal strip at a time into a strip writer.
+
+    Tiles must arrive in order of their top edge. A strip is finished, written out and
+    dropped as soon as a tile starts below it; tiles that reach into later strips are kept
+    until they have been pasted into all of them. Overlapping tiles are pasted in the order
+    of their index, so the result matches pasting them all in index order on one canvas.
+    """
+
+    def __init__(self, writer, width, height, strip_height, background=(0, 0, 0)):
+        self.writer = writer
+        self.width = width
+        self.height = height
+        self.strip_height = strip_height
+        self.background = background
+        self.strip_top = 0
+        self.active = []  # (index, tile, (left, top))
+
+    def add(self, index, tile, position):
+        """Queue a tile to be pasted at position (left, top) on the full image."""
+        while position[1] >= self.strip_top + self.strip_height and self.strip_top < self.height:
+            self._flush_strip()
+        self.active.append((index, tile, position))
+
+    def _flush_strip(self):
+        rows = min(self.strip_height, self.height - self.strip_top)
+        strip = Image.new('RGB', (self.width, rows), self.background)
+        self.active.sort(key=lambda entry: entry[0])
+        for _, tile, (left, top) in self.active:
+            strip.paste(tile, (left, top - self.strip_top))
+        self.writer.write_strip(strip)
+        self.strip_top += rows
+        self.active = [entry for entry in self.active if entry[2][1] + entry[1].height > self.strip_top]
+
+    def close(self):
+        while self.strip_top < self.height:
+            self._flush_strip()
+        self.writer.close()
+
+
+class DeepZoomWriter:
+    """
+    Deep Zoom (DZI) tile pyramid written from horizontal strips of the full image, top to bottom.
+
+    Each level keeps only the rows it still needs for its current row of tiles; rows are
+    passed on to the next level down in pairs, halved with a 2x2 box filter, so the whole
+    pyramid is built in the same pass without reading the finished image back.
+    Writes <name>.dzi and the tiles under <name>_files/<level>/<column>_<row>.<format>.
+    """
+
+    def __init__(self, dzi_path, width, height, tile_size=254, overlap=1, tile_format='jpg', quality=90):
+        self.dzi_path = dzi_path
+        self.tiles_folder = os.path.splitext(dzi_path)[0] + '_files'
+        self.width = width
+        self.height = height
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.tile_format = tile_format
+        self.quality = quality
+        self.max_level = max(0, math.ceil(math.log2(max(width, height, 1))))
+        self.levels = {}
+        for level in range(self.max_level, -1, -1):
+            scale = 2 ** (self.max_level - level)
+            self.levels[level] = {
+                'width': -(-width // scale),
+                'height': -(-height // scale),
+                'buffer': None,    # rows not yet cut into tiles
+                'buffer_top': 0,   # level row of the buffer's first row
+                'tile_row': 0,     # next row of tiles to cut
+                'carry': None,     # rows waiting for a partner before halving
+            }
+            os.makedirs(os.path.join(self.tiles_folder, str(level)), exist_ok=True)
+
+    def write_strip(self, strip):
+        """Add the next horizontal strip of the full-resolution image."""
+        self._feed(self.max_level, strip.convert('RGB'))
+
+    def _feed(self, level, rows):
+        state = self.levels[level]
+        state['buffer'] = _stack_rows(state['buffer'], rows)
+        self._cut_tiles(level, state)
+        if level > 0:
+            carry = _stack_rows(state['carry'], rows)
+            even = carry.height // 2 * 2
+            state['carry'] = carry.crop((0, even, carry.width, carry.height)) if even < carry.height else None
+            if even:
+                self._feed(level - 1, carry.crop((0, 0, carry.width, even)).reduce(2))
+
+    def _cut_tiles(self, level, state):
+        ts, overlap = self.tile_size, self.overlap
+        width, height = state['width'], state['height']
+        while state['tile_row'] * ts < height:
+            row = state['tile_row']
+            top = max(row * ts - overlap, 0)
+            bottom = min((row + 1) * ts + overlap, height)
+            buffer, buffer_top = state['buffer'], state['buffer_top']
+            if buffer_top + buffer.height < bottom:
+                break
+            for column in range(-(-width // ts)):
+                left = max(column * ts - overlap, 0)
+                right = min((column + 1) * ts + overlap, width)
+                tile = buffer.crop((left, top - buffer_top, right, bottom - buffer_top))
+                tile_path = os.path.join(self.tiles_folder, str(level), f"{column}_{row}.{self.tile_format}")
+                if self.tile_format == 'jpg':
+                    tile.save(tile_path, 'JPEG', quality=self.quality)
+                else:
+                    tile.save(tile_path)
+            state['tile_row'] += 1
+            # keep only the rows from the next row of tiles (with its overlap) on
+            keep_from = min(max((row + 1) * ts - overlap, 0) - buffer_top, buffer.height)
+            state['buffer'] = buffer.crop((0, keep_from, buffer.width, buffer.height))
+            state['buffer_top'] += keep_from
+
+    def close(self):
+        # halve any odd last row into the level below, from the top level down
+        for level in range(self.max_level, 0, -1):
+            carry = self.levels[level]['carry']
+            if carry is not None:
+                self.levels[level]['carry'] = None
+                self._feed(level - 1, carry.reduce(2))
+        with open(self.dzi_path, 'w') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{self.tile_format}" '
+                    f'Overlap="{self.overlap}" TileSize="{self.tile_size}">\n'
+                    f'  <Size Width="{self.width}" Height="{self.height}"/>\n'
+                    '</Image>\n')
+
+
+def _stack_rows(top, bottom):
+    """The rows of bottom appended under those of top (either may be None)."""
+    if top is None:
+        return bottom
+    if bottom is None:
+        return top
+    stacked = Image.new('RGB', (top.width, top.height + bottom.height))
+    stacked.paste(top, (0, 0))
+    stacked.paste(bottom, (0, top.height))
+    return stacked
+
+
+class StripTee:
+    """Hands each strip to several strip writers (e.g. a TIFF and a tile pyramid)."""
+
+    def __init__(self, *writers):
+        self.writers = writers
+
+    def write_strip(self, strip):
+        for writer in self.writers:
+            writer.write_strip(strip)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
@@ -0,0 +1,243 @@
+#tessera matching helpers for step6.py: a usage-aware nearest-colour index over the tesserae
+#and a capacitated min-cost assignment solver
+import heapq
+import math
+import numpy as np
+
+
+class UsageLevelGrid:
+    """Uniform RGB voxel grid of tessera positions, one grid per usage count.
+
+    nearest() looks only at the least-used level and searches outwards from the query's
+    voxel ring by ring, so a lookup touches a few voxels instead of every tessera."""
+
+    BRUTE_FORCE_CELLS = 512  # below this many occupied voxels a level is scanned directly
+
+    def __init__(self, colours, cell_size):
+        self.colours = colours
+        self.cell_size = cell_size
+        self.cells_per_axis = -(-256 // cell_size)
+        self.levels = {}        # usage count -> {voxel: [positions]}
+        self.level_sizes = {}   # usage count -> number of positions
+        self._rings = {}
+
+    def _voxel(self, colour):
+        top = self.cells_per_axis - 1
+        return tuple(min(max(int(c // self.cell_size), 0), top) for c in colour)
+
+    def add(self, position, level):
+        voxel = self._voxel(self.colours[position])
+        self.levels.setdefault(level, {}).setdefault(voxel, []).append(position)
+        self.level_sizes[level] = self.level_sizes.get(level, 0) + 1
+
+    def remove(self, position, level):
+        cells = self.levels[level]
+        voxel = self._voxel(self.colours[position])
+        cells[voxel].remove(position)
+        if not cells[voxel]:
+            del cells[voxel]
+        self.level_sizes[level] -= 1
+        if not self.level_sizes[level]:
+            del self.level_sizes[level]
+            del self.levels[level]
+
+    def _ring(self, r):
+        """Voxel offsets at Chebyshev distance exactly r."""
+        if r not in self._rings:
+            span = range(-r, r + 1)
+            self._rings[r] = [(i, j, k) for i in span for j in span for k in span
+                              if max(abs(i), abs(j), abs(k)) == r]
+        return self._rings[r]
+
+    def _closest_in(self, colour, positions, best):
+        r, g, b = colour
+        colours = self.colours
+        for position in positions:
+            t = colours[position]
+            distance = (r - t[0]) ** 2 + (g - t[1]) ** 2 + (b - t[2]) ** 2
+            if (distance, position) < best:
+                best = (distance, position)
+        return best
+
+    def nearest(self, colour):
+        """(distance, position) of the nearest tessera among the least used ones, ties going
+        to the lowest position; None if the grid is empty."""
+        if not self.level_sizes:
+            return None
+        cells = self.levels[min(self.level_sizes)]
+        best = (math.inf, math.inf)
+
+        if len(cells) <= self.BRUTE_FORCE_CELLS:
+            for positions in cells.values():
+                best = self._closest_in(colour, positions, best)
+            return best
+
+        qi, qj, qk = self._voxel(colour)
+        for r in range(self.cells_per_axis):
+            for i, j, k in self._ring(r):
+                positions = cells.get((qi + i, qj + j, qk + k))
+                if positions:
+                    best = self._closest_in(colour, positions, best)
+            # every voxel further out is at least r whole voxels away
+            if best[0] < (r * self.cell_size) ** 2:
+                break
+        return best
+
+
+class TesseraColourIndex:
+    """Nearest-colour index over priority 0 tesserae with usage-aware lookups.
+
+    Tesserae are positions into colours (average colour per tessera) and cropable, and the
+    index keeps their usage counts itself. find_best_tessera() gives the same answer as
+    step6.find_best_tessera on the same tesserae: the least used group first, then the
+    nearest average colour, ties going to the earlier tessera. A second grid holds only the
+    cropable tesserae, for parquets whose aspect ratio needs cropping."""
+
+    def __init__(self, colours, cropable, cell_size=16):
+        colours = [tuple(colour) for colour in np.asarray(colours, dtype=np.float64).reshape(-1, 3).tolist()]
+        self.cropable = [bool(c) for c in cropable]
+        self.usage = [0] * len(colours)
+        self.all_grid = UsageLevelGrid(colours, cell_size)
+        self.cropable_grid = UsageLevelGrid(colours, cell_size)
+        for position in range(len(colours)):
+            self.all_grid.add(position, 0)
+            if self.cropable[position]:
+                self.cropable_grid.add(position, 0)
+
+    def find_best_tessera(self, parquet_color, cropable_only=False):
+        """Returns (position, distance), or (None, inf) if there is no candidate."""
+        grid = self.cropable_grid if cropable_only else self.all_grid
+        found = grid.nearest(parquet_color)
+        if found is None:
+            return (None, float('inf'))
+        distance, position = found
+        return position, distance
+
+    def add_use(self, position):
+        """Count one more use of the tessera, moving it to the next usage level."""
+        old = self.usage[position]
+        self.usage[position] = old + 1
+        grids = [self.all_grid] + ([self.cropable_grid] if self.cropable[position] else [])
+        for grid in grids:
+            grid.remove(position, old)
+            grid.add(position, old + 1)
+
+
+def nearest_candidates(parquet_colours, tessera_colours, k, cropable_only=None, cropable=None, chunk_size=1024):
+    """For each parquet, the k nearest tesserae as ([tessera positions], [squared distances]),
+    nearest first. Parquets flagged in cropable_only only get tesserae flagged in cropable.
+    Distances are computed a chunk of parquets at a time as |p|^2 + |t|^2 - 2 p.t."""
+    parquet_colours = np.asarray(parquet_colours, dtype=np.float64).reshape(-1, 3)
+    tessera_colours = np.asarray(tessera_colours, dtype=np.float64).reshape(-1, 3)
+    tessera_norms = (tessera_colours ** 2).sum(axis=1)
+    blocked = None
+    if cropable_only is not None:
+        cropable_only = np.asarray(cropable_only, dtype=bool)
+        blocked = ~np.asarray(cropable, dtype=bool)
+
+    candidates = []
+    for start in range(0, len(parquet_colours), chunk_size):
+        chunk = parquet_colours[start:start + chunk_size]
+        distances = (chunk ** 2).sum(axis=1)[:, None] + tessera_norms[None, :] - 2.0 * chunk @ tessera_colours.T
+        np.maximum(distances, 0, out=distances)
+        if blocked is not None:
+            distances[np.ix_(cropable_only[start:start + chunk_size], blocked)] = np.inf
+        kk = min(k, distances.shape[1])
+        if kk == 0:
+            candidates.extend(([], []) for _ in range(len(chunk)))
+            continue
+        nearest = np.argpartition(distances, kk - 1, axis=1)[:, :kk]
+        nearest_d = np.take_along_axis(distances, nearest, axis=1)
+        order = np.lexsort((nearest, nearest_d), axis=1)
+        nearest = np.take_along_axis(nearest, order, axis=1)
+        nearest_d = np.take_along_axis(nearest_d, order, axis=1)
+        for positions, dists in zip(nearest.tolist(), nearest_d.tolist()):
+            keep = [i for i, d in enumerate(dists) if d != math.inf]
+            candidates.append(([positions[i] for i in keep], [dists[i] for i in keep]))
+    return candidates
+
+
+def capacitated_assignment(candidates, capacities, overflow_costs, order=None):
+    """Min-cost assignment of parquets to tesserae, each tessera taking at most its capacity.
+
+    candidates[u] is ([tessera positions], [costs]) for parquet u; overflow_costs[u] is what
+    leaving u over the cap costs. Parquets are added one at a time along a shortest augmenting
+    path (Dijkstra on reduced costs, successive shortest paths), so earlier parquets can give
+    up their tessera when a later parquet needs it more. The search stops at the first free
+    tessera or overflow, which keeps the paths short on sparse k-nearest candidate edges.
+    Returns the tessera position per parquet, -1 for the ones left over the cap."""
+    n, m = len(candidates), len(capacities)
+    sink = n + m
+    potential = [0.0] * (n + m + 1)
+    assigned = [-1] * n
+    assigned_cost = [0.0] * n
+    members = [{} for _ in range(m)]
+    load = [0] * m
+
+    for source in (range(n) if order is None else order):
+        dist = {source: 0.0}
+        pred = {}
+        heap = [(0.0, source)]
+        settled = []
+        done = set()
+        while heap:
+            d, v = heapq.heappop(heap)
+            if v in done:
+                continue
+            done.add(v)
+            settled.append((v, d))
+            if v == sink:
+                break
+            if v < n:
+                # parquet: forward to its other candidates, or over the cap
+                pv = potential[v]
+                current = assigned[v]
+                targets = [(n + j, c) for j, c in zip(*candidates[v]) if j != current]
+                if current != -1 or v == source:
+                    targets.append((sink, overflow_costs[v]))
+            else:
+                # tessera: back to a parquet holding it, or on to the sink if it has room
+                pv = potential[v]
+                j = v - n
+                targets = [(u, -assigned_cost[u]) for u in members[j]]
+                if load[j] < capacities[j]:
+                    targets.append((sink, 0.0))
+            for w, c in targets:
+                nd = d + c + pv - potential[w]
+                if nd < dist.get(w, math.inf):
+                    dist[w] = nd
+                    pred[w] = v
+                    heapq.heappush(heap, (nd, w))
+
+        if sink not in done:
+            continue  # no candidates and no overflow cost: leave the parquet out
+        reach = dist[sink]
+        for v, d in settled:
+            potential[v] += d - reach
+
+        # walk the path back from the sink, moving each parquet onto its new tessera
+        v = pred[sink]
+        if v < n:
+            # the last parquet on the path goes over the cap
+            _move(v, -1, 0.0, assigned, assigned_cost, members, load)
+            v = pred[v] if v != source else None
+        while v is not None:
+            u = pred[v]
+            j = v - n
+            cost = candidates[u][1][candidates[u][0].index(j)]
+            previous = assigned[u]
+            _move(u, j, cost, assigned, assigned_cost, members, load)
+            v = None if u == source else n + previous
+    return assigned
+
+
+def _move(u, j, cost, assigned, assigned_cost, members, load):
+    previous = assigned[u]
+    if previous != -1:
+        del members[previous][u]
+        load[previous] -= 1
+    assigned[u] = j
+    assigned_cost[u] = cost
+    if j != -1:
+        members[j][u] = None
+        load[j] += 1
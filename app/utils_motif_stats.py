@@ -0,0 +1,128 @@
+#motif statistics for steps 3, 4 and 5: per-channel summed-area tables of the motif, so the
+#average colour of any axis-aligned rectangle (and of its four quadrants) costs O(1)
+import os
+import numpy as np
+from PIL import Image
+
+
+class MotifStats:
+    """
+    Summed-area tables (integral images) of an RGB motif.
+
+    Rectangles are given as crop boxes (x1, y1, x2, y2) and are rounded the way Pillow's
+    crop() rounds them; pixels outside the motif count as black, as in a crop. Means are
+    floored per channel like average_colour_n_fallback, so they equal the crop-and-average
+    results the steps used before. Sums of squares (for variance) are built on first use.
+
+    The sum tables are uint32 (12 rather than 24 bytes a pixel): they wrap around on big
+    motifs, but a rectangle's sum stays exact while it is under 2**32, i.e. for any box
+    under 16.8 million pixels. The sums of squares keep int64.
+    """
+
+    def __init__(self, image):
+        pixels = np.asarray(image.convert('RGB'))
+        self.height, self.width = pixels.shape[:2]
+        self.sums = self._integral(pixels, np.uint32)
+        self._pixels = pixels
+        self._square_sums = None
+
+    @staticmethod
+    def _integral(values, dtype):
+        height, width = values.shape[:2]
+        table = np.zeros((height + 1, width + 1, 3), dtype=dtype)
+        np.cumsum(values, axis=0, dtype=dtype, out=table[1:, 1:])
+        np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+        return table
+
+    def image(self):
+        """A new RGB image of the motif, without decoding the file again."""
+        return Image.fromarray(self._pixels)
+
+    @property
+    def square_sums(self):
+        if self._square_sums is None:
+            self._square_sums = self._integral(self._pixels.astype(np.int64) ** 2, np.int64)
+        return self._square_sums
+
+    def _region_sums(self, table, x1, y1, x2, y2):
+        """Per-channel sums over integer boxes (arrays), clipped to the motif."""
+        cx1, cx2 = np.clip(x1, 0, self.width), np.clip(x2, 0, self.width)
+        cy1, cy2 = np.clip(y1, 0, self.height), np.clip(y2, 0, self.height)
+        cx2, cy2 = np.maximum(cx2, cx1), np.maximum(cy2, cy1)
+        # in the table's own dtype: uint32 differences wrap around to the exact sum
+        sums = table[cy2, cx2] - table[cy1, cx2] - table[cy2, cx1] + table[cy1, cx1]
+        return sums.astype(np.int64)
+
+    def _floored_means(self, x1, y1, x2, y2):
+        counts = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        sums = self._region_sums(self.sums, x1, y1, x2, y2)
+        return np.where(counts[..., None] > 0, sums // np.maximum(counts, 1)[..., None], 0)
+
+    def mean_colour(self, box):
+        """Average (r, g, b) of a crop box, (0, 0, 0) if it is empty."""
+        x1, y1, x2, y2 = (np.array(round(v)) for v in box)
+        return tuple(int(c) for c in self._floored_means(x1, y1, x2, y2))
+
+    def variance(self, box):
+        """Per-channel variance (r, g, b) of a crop box, (0.0, 0.0, 0.0) if it is empty."""
+        x1, y1, x2, y2 = (round(v) for v in box)
+        count = max(x2 - x1, 0) * max(y2 - y1, 0)
+        if count == 0:
+            return (0.0, 0.0, 0.0)
+        sums = self._region_sums(self.sums, x1, y1, x2, y2)
+        squares = self._region_sums(self.square_sums, x1, y1, x2, y2)
+        return tuple(float(v) for v in squares / count - (sums / count) ** 2)
+
+    def batch_parquet_colours(self, boxes):
+        """
+        Average, top-left, top-right, bottom-left and bottom-right colours of many crop
+        boxes at once: an int array of shape (n, 5, 3) for an (n, 4) array of boxes. The
+        quadrants split each rounded box at width // 2 and height // 2, like cropping the
+        parquet and then its quarters.
+        """
+        boxes = np.rint(np.asarray(boxes, dtype=np.float64).reshape(-1, 4)).astype(np.int64)
+        x1, y1, x2, y2 = boxes.T
+        xm = x1 + np.maximum(x2 - x1, 0) // 2
+        ym = y1 + np.maximum(y2 - y1, 0) // 2
+        regions = [
+            (x1, y1, x2, y2),   # whole parquet
+            (x1, y1, xm, ym),   # top left
+            (xm, y1, x2, ym),   # top right
+            (x1, ym, xm, y2),   # bottom left
+            (xm, ym, x2, y2),   # bottom right
+        ]
+        return np.stack([self._floored_means(*region) for region in regions], axis=1)
+
+    def fill_parquet_colours(self, parquets, boxes):
+        """Set the five colour fields of each parquet (dicts, or rows of a parquet array) from its crop box, in one batch."""
+        if len(parquets) == 0:
+            return
+        if isinstance(parquets, np.ndarray):
+            colours = self.batch_parquet_colours(boxes)
+            for k, name in enumerate(['average_color', 'top_left_color', 'top_right_color',
+                                      'bottom_left_color', 'bottom_right_color']):
+                parquets[name] = colours[:, k]
+            return
+        colours = self.batch_parquet_colours(boxes).tolist()
+        for parquet, (avg, tl, tr, bl, br) in zip(parquets, colours):
+            parquet["average_color"] = tuple(avg)
+            parquet["top_left_color"] = tuple(tl)
+            parquet["top_right_color"] = tuple(tr)
+            parquet["bottom_left_color"] = tuple(bl)
+            parquet["bottom_right_color"] = tuple(br)
+
+    def parquet_colours(self, box):
+        """(average, top_left, top_right, bottom_left, bottom_right) colour tuples of one crop box."""
+        return tuple(tuple(int(c) for c in colour) for colour in self.batch_parquet_colours([box])[0])
+
+
+_loaded = {}
+
+def load_motif_stats(image_path):
+    """MotifStats of the motif file, reused while the file is unchanged."""
+    key = (os.path.abspath(image_path), os.path.getmtime(image_path))
+    if key not in _loaded:
+        _loaded.clear()
+        with Image.open(image_path) as img:
+            _loaded[key] = MotifStats(img)
+    return _loaded[key]